@@ -3,50 +3,85 @@ import asyncio
 import json
 import base64
 import re
-from typing import Optional, Dict, Any, List
+import struct
+import sys
+from typing import Optional, Dict, Any, List, Union
 import importlib
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-# robust import for models_loader: try several module names depending on execution context
-models_mod = None
-for _name in ('models_loader', 'scripts.models_loader', '.models_loader'):
-    try:
-        models_mod = importlib.import_module(_name)
-        break
-    except Exception:
-        models_mod = None
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-if not models_mod:
-    # try loading from file path as last resort (works when running as script)
-    try:
-        from importlib.machinery import SourceFileLoader
-        import pathlib
-        base = pathlib.Path(__file__).resolve().parent
-        mod_path = str(base.joinpath('models_loader.py'))
-        models_mod = SourceFileLoader('models_loader', mod_path).load_module()
-    except Exception as e:
-        raise ImportError('could not import models_loader (tried models_loader, scripts.models_loader, .models_loader)') from e
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger('breaker_service')
+
+def _resolve(names, filename: str):
+    """Devuelve el primer módulo importable de `names`.
+
+    Consulta primero sys.modules (evita recorrer sys.path y cargar dos copias
+    del mismo archivo bajo nombres distintos); solo si ningún nombre existe
+    carga `filename` desde la carpeta de este script.
+    """
+    for n in names:
+        mod = sys.modules.get(n)
+        if mod is not None:
+            return mod
+    for n in names:
+        try:
+            return importlib.import_module(n)
+        except ModuleNotFoundError as e:
+            # si lo que falta es una dependencia interna del módulo, no enmascararlo
+            if e.name not in (n, n.partition('.')[0]):
+                raise
+    from importlib.machinery import SourceFileLoader
+    import pathlib
+    mod_path = str(pathlib.Path(__file__).resolve().parent.joinpath(filename))
+    modname = filename.rsplit('.', 1)[0]
+    mod = SourceFileLoader(modname, mod_path).load_module()
+    sys.modules.setdefault(modname, mod)
+    return mod
+
+
+def _candidates(modname: str):
+    names = [f'{__package__}.{modname}'] if __package__ else []
+    return tuple(names + [n for n in (modname, f'scripts.{modname}') if n not in names])
+
+
+# robust import for models_loader: try several module names depending on execution context
+try:
+    models_mod = _resolve(_candidates('models_loader'), 'models_loader.py')
+except Exception as e:
+    raise ImportError('could not import models_loader (tried models_loader, scripts.models_loader, .models_loader)') from e
 
 get_breaker = getattr(models_mod, 'get_breaker')
 set_breaker_state = getattr(models_mod, 'set_breaker_state')
 toggle_breaker = getattr(models_mod, 'toggle_breaker')
 load_data = getattr(models_mod, 'load_data')
 save_data = getattr(models_mod, 'save_data')
-update_breaker_fields = getattr(models_mod, 'update_breaker_fields', None)
+save_breakers_patch = getattr(models_mod, 'save_breakers_patch')
+get_tarjeta_for_breaker = getattr(models_mod, 'get_tarjeta_for_breaker')
 
 # tuya client fallbacks
 try:
-    from .tuya_client import perform_action as _tuya_action, perform_pulse as _tuya_pulse
+    _tuya_mod = _resolve(_candidates('tuya_client'), 'tuya_client.py')
+    _tuya_action = _tuya_mod.perform_action
+    _tuya_pulse = _tuya_mod.perform_pulse
+    _tuya_pulse_async = getattr(_tuya_mod, 'perform_pulse_async', None)
 except Exception:
-    try:
-        from scripts.tuya_client import perform_action as _tuya_action, perform_pulse as _tuya_pulse
-    except Exception:
-        try:
-            from tuya_client import perform_action as _tuya_action, perform_pulse as _tuya_pulse
-        except Exception:
-            def _tuya_action(device_id: str, action: str):
-                return False, 'tuya_client not available'
-            def _tuya_pulse(device_id: str, duration_ms: int = 500):
-                return False, 'tuya_client not available'
+    def _tuya_action(device_id: str, action: str):
+        return False, 'tuya_client not available'
+    def _tuya_pulse(device_id: str, duration_ms: int = 500):
+        return False, 'tuya_client not available'
+    _tuya_pulse_async = None
 
 try:
     from .config import HA_URL, HA_TOKEN
@@ -58,29 +93,100 @@ except Exception:
         HA_TOKEN = os.getenv('HA_TOKEN')
 
 
-async def _call_ha_service(entity_id: str, svc: str) -> Dict[str, Any]:
-    """Call Home Assistant switch service and return result dict."""
+# Sesión HTTP compartida con Home Assistant (keep-alive + caché DNS).
+# Se crea perezosamente en el primer uso y se reutiliza mientras viva el event loop.
+_HA_SESSION: Optional[Any] = None
+_HA_SESSION_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_ha_session():
+    """Devuelve la ClientSession compartida, creándola si no existe o si cambió el loop.
+
+    web_ui la usa también para sus consultas REST: un único pool de conexiones a HA."""
+    global _HA_SESSION, _HA_SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if _HA_SESSION is None or _HA_SESSION.closed or _HA_SESSION_LOOP is not loop:
+        _discard_session(_HA_SESSION, _HA_SESSION_LOOP)
+        _HA_SESSION = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60),
+        )
+        _HA_SESSION_LOOP = loop
+    return _HA_SESSION
+
+
+def _discard_session(session, old_loop) -> None:
+    """Cerrar la sesión de un loop anterior sin bloquear (get_ha_session es síncrona)."""
+    if session is None or session.closed:
+        return
+    if old_loop is not None and old_loop.is_running():
+        # su loop sigue vivo (otro hilo): cerrarla allí
+        asyncio.run_coroutine_threadsafe(session.close(), old_loop)
+        return
+    # loop terminado: soltar el conector (la sesión queda cerrada, sin aviso de
+    # 'Unclosed client session') y cerrarlo aquí; sus transportes murieron con el loop
+    connector = session.connector
+    session.detach()
+    if connector is None:
+        return
+    try:
+        closing = connector.close()
+    except Exception:
+        return
+    if inspect.isawaitable(closing):  # según la versión de aiohttp close() es async
+        asyncio.ensure_future(_close_quietly(closing))
+
+
+async def _close_quietly(closing) -> None:
+    try:
+        await closing
+    except Exception:
+        pass
+
+
+async def close_ha_session() -> None:
+    """Cerrar la sesión compartida (para hooks de apagado)."""
+    global _HA_SESSION, _HA_SESSION_LOOP
+    session = _HA_SESSION
+    _HA_SESSION = None
+    _HA_SESSION_LOOP = None
+    if session is not None and not session.closed:
+        await session.close()
+
+
+async def _call_ha_service(entity_id: Union[str, List[str]], svc: str) -> Dict[str, Any]:
+    """Call Home Assistant switch service and return result dict.
+
+    `entity_id` puede ser una lista: HA aplica el servicio a todas en un solo POST.
+    """
     if not (HA_URL and HA_TOKEN and entity_id):
         return {'ok': False, 'error': 'ha_not_configured_or_entity_missing'}
+    if aiohttp is None:
+        return {'ok': False, 'error': 'aiohttp_not_available'}
     url = f"{HA_URL}/api/services/switch/{svc}"
     headers = {'Authorization': f'Bearer {HA_TOKEN}', 'Content-Type': 'application/json'}
     try:
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json={'entity_id': entity_id}) as resp:
-                try:
-                    j = await resp.json()
-                except Exception:
-                    j = {'status': resp.status}
-                return {'ok': True, 'result': j}
+        session = get_ha_session()
+        async with session.post(url, headers=headers, json={'entity_id': entity_id}) as resp:
+            try:
+                j = await resp.json()
+            except Exception:
+                j = {'status': resp.status}
+            return {'ok': True, 'result': j}
     except Exception as e:
         return {'ok': False, 'error': str(e)}
 
 
+# Pool dedicado para las llamadas bloqueantes a Tuya/HA (tinytuya, urllib), separado
+# del executor por defecto. Tamaño configurable con TUYA_POOL_SIZE.
+_TUYA_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('TUYA_POOL_SIZE', '16')), thread_name_prefix='tuya')
+
+
+# Resultado con forma fija {'success', 'msg', 'action'}; los llamadores no normalizan
 async def _run_tuya_action(device_id: str, action: str) -> Dict[str, Any]:
     loop = asyncio.get_running_loop()
     try:
-        ok, msg = await loop.run_in_executor(None, lambda: _tuya_action(device_id or '', action))
+        ok, msg = await loop.run_in_executor(_TUYA_EXECUTOR, partial(_tuya_action, device_id or '', action))
         return {'success': bool(ok), 'msg': msg, 'action': action}
     except Exception as e:
         return {'success': False, 'msg': str(e), 'action': action}
@@ -89,12 +195,28 @@ async def _run_tuya_action(device_id: str, action: str) -> Dict[str, Any]:
 async def _run_tuya_pulse(device_id: str, duration_ms: int = 500) -> Dict[str, Any]:
     loop = asyncio.get_running_loop()
     try:
-        ok, msg = await loop.run_in_executor(None, lambda: _tuya_pulse(device_id or '', duration_ms))
+        if _tuya_pulse_async is not None:
+            # la espera del pulso no retiene un hilo del executor
+            ok, msg = await _tuya_pulse_async(device_id or '', duration_ms, executor=_TUYA_EXECUTOR)
+        else:
+            ok, msg = await loop.run_in_executor(_TUYA_EXECUTOR, partial(_tuya_pulse, device_id or '', duration_ms))
         return {'success': bool(ok), 'msg': msg, 'action': 'pulse'}
     except Exception as e:
         return {'success': False, 'msg': str(e), 'action': 'pulse'}
 
 
+def _device_target(br: Dict[str, Any]) -> tuple:
+    """Identificador a accionar para un breaker y si es una entidad de HA.
+
+    Prioriza entity_id cuando es una entidad de HA válida (dominio.objeto);
+    si no, usa el primer identificador Tuya disponible.
+    """
+    entity_id = br.get('entity_id')
+    if entity_id and '.' in str(entity_id):
+        return entity_id, True
+    return (br.get('device_id') or br.get('tuya_device') or br.get('tuya_id') or br.get('tuya') or entity_id or ''), False
+
+
 async def set_breaker(path: str, breaker_id: str, state: bool) -> Dict[str, Any]:
     """Persist state, then attempt Tuya and HA actions. Returns a summary dict."""
     br = set_breaker_state(path, breaker_id, state)
@@ -106,21 +228,12 @@ async def set_breaker(path: str, breaker_id: str, state: bool) -> Dict[str, Any]
 
     # Priorizar entity_id si parece una entidad de HA (contiene punto)
     # Esto permite que el control vía HA funcione correctamente desde la UI
-    entity_id = br.get('entity_id')
-    if entity_id and '.' in str(entity_id):
-        device_id = entity_id
-        print(f"set_breaker: using HA entity_id={entity_id} for breaker {breaker_id}")
-    else:
-        device_id = (br.get('device_id') or br.get('tuya_device') or br.get('tuya_id') or br.get('tuya') or entity_id)
-        print(f"set_breaker: using device_id={device_id} for breaker {breaker_id} (not HA entity)")
+    device_id, is_ha = _device_target(br)
+    log.debug("set_breaker: using %s=%s for breaker %s", 'HA entity_id' if is_ha else 'device_id', device_id, breaker_id)
     if not device_id:
-        print(f"set_breaker: no device identifier found for breaker {breaker_id}; breaker data keys={list(br.keys())}")
+        log.warning("set_breaker: no device identifier found for breaker %s; breaker data keys=%s", breaker_id, list(br.keys()))
     action = 'encender' if state else 'apagar'
-    tuya_res = await _run_tuya_action(device_id or '', action)
-    # normalize older 'ok' key if present
-    if isinstance(tuya_res, dict) and 'ok' in tuya_res:
-        tuya_res['success'] = bool(tuya_res.pop('ok'))
-    tuya_res.setdefault('action', action)
+    tuya_res = await _run_tuya_action(device_id, action)
     res['tuya'] = tuya_res
 
     # home assistant
@@ -135,17 +248,65 @@ async def set_breaker(path: str, breaker_id: str, state: bool) -> Dict[str, Any]
         try:
             tarjeta = get_tarjeta_for_breaker(path, br)
             if tarjeta and 'saldo' in tarjeta:
-                # persistir saldo y max_saldo en el breaker
-                if update_breaker_fields:
-                    updated = update_breaker_fields(path, breaker_id, saldo=tarjeta.get('saldo'), max_saldo=tarjeta.get('saldo'))
-                    if updated is not None:
-                        res['breaker'] = updated
+                # saldo/max_saldo solo en la respuesta: el saldo persistido vive en la tarjeta
+                res['breaker'] = {**res['breaker'], 'saldo': tarjeta.get('saldo'), 'max_saldo': tarjeta.get('saldo')}
         except Exception:
             pass
 
     return res
 
 
+async def set_breakers_bulk(path: str, ids: List[str], state: bool) -> Dict[str, Any]:
+    """Persistir el mismo estado en varios breakers agrupando las llamadas a HA.
+
+    Los breakers con entidad de HA se accionan con un único POST (lista de entity_id);
+    el resto (o todos, si HA no está configurado) va por Tuya en paralelo, con el
+    mismo destino que set_breaker.
+    """
+    svc = 'turn_on' if state else 'turn_off'
+    action = 'encender' if state else 'apagar'
+    updated: List[Dict[str, Any]] = []
+    unknown: List[str] = []
+    for bid in dict.fromkeys(ids):  # sin repetidos, en orden
+        br = set_breaker_state(path, bid, state)
+        if br:
+            updated.append(br)
+        else:
+            unknown.append(bid)
+
+    use_ha = bool(HA_URL and HA_TOKEN)
+    entities: List[str] = []
+    tuya_targets: List[tuple] = []
+    for br in updated:
+        target, is_ha = _device_target(br)
+        if is_ha and use_ha:
+            if target not in entities:
+                entities.append(target)
+            continue
+        if not target:
+            log.warning("set_breakers_bulk: no device identifier found for breaker %s; breaker data keys=%s", br.get('id'), list(br.keys()))
+        tuya_targets.append((br, target))
+
+    res: Dict[str, Any] = {'ok': True, 'breakers': updated, 'unknown': unknown, 'tuya': {}, 'ha': None}
+    if tuya_targets:
+        results = await asyncio.gather(*(_run_tuya_action(target, action) for _, target in tuya_targets))
+        res['tuya'] = {br.get('id'): r for (br, _), r in zip(tuya_targets, results)}
+    if entities:
+        res['ha'] = await _call_ha_service(entities, svc)
+
+    # Al encender, saldo/max_saldo de cada breaker desde su tarjeta (solo en la respuesta,
+    # como set_breaker: el saldo persistido vive en la tarjeta)
+    if state:
+        for i, br in enumerate(updated):
+            try:
+                tarjeta = get_tarjeta_for_breaker(path, br)
+                if tarjeta and 'saldo' in tarjeta:
+                    updated[i] = {**br, 'saldo': tarjeta.get('saldo'), 'max_saldo': tarjeta.get('saldo')}
+            except Exception:
+                pass
+    return res
+
+
 async def toggle_breaker_service(path: str, breaker_id: str) -> Dict[str, Any]:
     # read current breaker and flip state explicitly to avoid ambiguity across imports
     br = get_breaker(path, breaker_id)
@@ -158,17 +319,9 @@ async def toggle_breaker_service(path: str, breaker_id: str) -> Dict[str, Any]:
     if not updated:
         return {'ok': False, 'error': 'failed_to_persist'}
     # Priorizar entity_id si es una entidad de HA válida
-    entity_id = updated.get('entity_id')
-    if entity_id and '.' in str(entity_id):
-        device_for_tuya = entity_id
-        print(f"breaker_service.toggle: using HA entity_id={entity_id} for breaker {breaker_id} -> {new_state}")
-    else:
-        device_for_tuya = (updated.get('device_id') or updated.get('tuya_device') or updated.get('tuya_id') or updated.get('tuya') or entity_id or '')
-        print(f"breaker_service.toggle: using device_for_tuya={device_for_tuya} (not HA entity) for breaker {breaker_id} -> {new_state}")
+    device_for_tuya, is_ha = _device_target(updated)
+    log.debug("breaker_service.toggle: using %s=%s for breaker %s -> %s", 'HA entity_id' if is_ha else 'device_for_tuya', device_for_tuya, breaker_id, new_state)
     tuya = await _run_tuya_action(device_for_tuya, 'encender' if new_state else 'apagar')
-    if isinstance(tuya, dict) and 'ok' in tuya:
-        tuya['success'] = bool(tuya.pop('ok'))
-    tuya.setdefault('action', 'toggle')
     ha = None
     if updated.get('entity_id') and HA_URL and HA_TOKEN:
         svc = 'turn_on' if new_state else 'turn_off'
@@ -177,14 +330,13 @@ async def toggle_breaker_service(path: str, breaker_id: str) -> Dict[str, Any]:
     if new_state:
         try:
             tarjeta = get_tarjeta_for_breaker(path, updated)
-            if tarjeta and 'saldo' in tarjeta and update_breaker_fields:
-                updated2 = update_breaker_fields(path, breaker_id, saldo=tarjeta.get('saldo'), max_saldo=tarjeta.get('saldo'))
-                if updated2 is not None:
-                    updated = updated2
+            if tarjeta and 'saldo' in tarjeta:
+                # saldo/max_saldo solo en la respuesta: el saldo persistido vive en la tarjeta
+                updated = {**updated, 'saldo': tarjeta.get('saldo'), 'max_saldo': tarjeta.get('saldo')}
         except Exception:
             pass
     # debug
-    print(f"toggle_breaker_service: breaker={breaker_id} {current} -> {new_state} tuya_success={tuya.get('success')} msg={tuya.get('msg')}")
+    log.info("toggle_breaker_service: breaker=%s %s -> %s tuya_success=%s msg=%s", breaker_id, current, new_state, tuya.get('success'), tuya.get('msg'))
     return {'ok': True, 'breaker': updated, 'tuya': tuya, 'ha': ha}
 
 
@@ -193,19 +345,186 @@ async def pulse_breaker_service(path: str, breaker_id: str, duration_ms: int = 5
     if not br:
         return {'ok': False, 'error': 'unknown_breaker'}
     # Priorizar entity_id si es una entidad de HA válida
-    entity_id = br.get('entity_id')
-    if entity_id and '.' in str(entity_id):
-        device_id = entity_id
-        print(f"breaker_service.pulse: using HA entity_id={entity_id} duration_ms={duration_ms} (breaker id={breaker_id})")
-    else:
-        device_id = (br.get('device_id') or br.get('tuya_device') or br.get('tuya_id') or br.get('tuya') or entity_id or '')
-        print(f"breaker_service.pulse: using device_id={device_id} (not HA entity) duration_ms={duration_ms} (breaker id={breaker_id})")
+    device_id, is_ha = _device_target(br)
+    log.debug("breaker_service.pulse: using %s=%s duration_ms=%s (breaker id=%s)", 'HA entity_id' if is_ha else 'device_id', device_id, duration_ms, breaker_id)
     tuya_res = await _run_tuya_pulse(device_id, duration_ms)
-    print(f"breaker_service.pulse: tuya_res={tuya_res}")
+    log.info("breaker_service.pulse: tuya_res=%s", tuya_res)
     return {'ok': True, 'breaker': br, 'tuya': tuya_res}
 
 
-async def sync_all_breakers_from_ha(path: str) -> Dict[str, Any]:
+# Número inicial en cadenas con unidades ("123.4V", "10,5 A")
+_NUM_RE = re.compile(r'^\s*([0-9]+(?:[\.,][0-9]+)?)')
+# Valor de atributo con apariencia de payload base64 (DPs Tuya)
+_B64_RE = re.compile(r'[A-Za-z0-9+/=]+')
+
+
+# Helper: coerción numérica (acepta "123.4V", "10A", etc.)
+def _coerce(val) -> Optional[float]:
+    if val is None:
+        return None
+    if isinstance(val, (int, float)):
+        return float(val)
+    if isinstance(val, str):
+        # solo dígitos con decimal opcional: sin signo, exponente ni 'nan'/'inf'
+        m = _NUM_RE.match(val)
+        if not m:
+            return None
+        txt = m.group(1).replace(',', '.')
+        try:
+            return float(txt)
+        except ValueError:
+            return None
+    return None
+
+
+# Sufijos de sensores candidatos por métrica (sensor.<base>_<sufijo>), incluye
+# variantes trifásicas (phase_a) para cubrir sensores con nombres distintos
+_METRIC_SUFFIXES = {
+    'power': ('power', 'active_power', 'current_power', 'power_w', 'phase_a_power', 'phase_a_active_power'),
+    'voltage': ('voltage', 'voltage_v', 'phase_a_voltage', 'phase_a_phase_voltage'),
+    'current': ('current', 'current_a', 'phase_a_current', 'phase_a_i'),
+    'energy': ('energy', 'energy_total', 'total_energy', 'energy_kwh', 'phase_a_energy'),
+}
+_METRIC_SUFFIX_ITEMS = tuple(_METRIC_SUFFIXES.items())
+# Atributos genéricos del estado HA donde buscar cada métrica
+_METRIC_ATTR_KEYS = {
+    'power': ('power', 'current_power_w', 'power_w', 'instant_power', 'active_power'),
+    'energy': ('energy', 'today_energy_kwh', 'energy_kwh', 'total_energy', 'total_energy_kwh'),
+    'voltage': ('voltage', 'voltage_v', 'current_voltage'),
+    'current': ('current', 'current_a', 'current_ma'),
+}
+_METRIC_ATTR_ITEMS = tuple(_METRIC_ATTR_KEYS.items())
+_METRIC_ENTITY_KEYS = ('power_entity', 'energy_entity', 'voltage_entity', 'current_entity')
+# Orden de métricas del breaker y las que aporta el payload base64
+_METRIC_ORDER = ('power', 'energy', 'voltage', 'current')
+_METRIC_COUNT = len(_METRIC_ORDER)
+_B64_METRICS = ('power', 'voltage', 'current')
+
+
+# Decodificador Tuya base64 (DP): dpid(1) type(1) len(2) value(len)
+_TUYA_HDR = struct.Struct('>BBH')
+_TUYA_U32 = struct.Struct('>I')
+# dpid -> (métrica, divisor). Sin round(): un entero dividido por una potencia de 10
+# ya da el double más cercano al decimal exacto (igual a lo que devolvía round)
+_DPID_MAP = {
+    18: ('current', 1000.0),  # corriente mA
+    19: ('power', 10.0),      # potencia deci-W
+    20: ('voltage', 10.0),    # voltaje deci-V
+}
+_DPID_ENERGY = (101, 102, 21)
+
+
+def _decode_tuya_b64(b64_text: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    try:
+        raw = base64.b64decode(b64_text)
+    except Exception:
+        return out
+    mv = memoryview(raw)
+    n = len(raw)
+    i = 0
+    while i + 4 <= n:
+        dpid, dtype, ln = _TUYA_HDR.unpack_from(mv, i)
+        start = i + 4
+        end = start + ln
+        if end > n:
+            break
+        i = end
+        if dtype not in (0x02, 0x04, 0x00):  # solo valores enteros
+            continue
+        val = _TUYA_U32.unpack_from(mv, start)[0] if ln == 4 else int.from_bytes(mv[start:end], 'big')
+        spec = _DPID_MAP.get(dpid)
+        if spec is not None:
+            name, div = spec
+            out[name] = val / div
+        elif dpid in _DPID_ENERGY:  # energía (heurística)
+            # 21 a veces Wh acumulados; 101/102 centésimas kWh
+            if val > 100000:  # grande -> Wh
+                out['energy'] = val / 1000.0
+            else:
+                out['energy'] = val / 100.0
+    return out
+
+
+# Escritura diferida tras sync: como máximo una cada SAVE_MIN_INTERVAL_S. Los cambios
+# de sincronizaciones intermedias se acumulan y se aplican sobre el JSON recién leído
+# al escribir. Solo métricas y entidades descubiertas: el estado no se difiere.
+SAVE_MIN_INTERVAL_S = 2.0
+_SAVE_STATE: Dict[str, Any] = {'pending': {}, 'path': None, 'last': None, 'handle': None, 'task': None}
+
+
+async def _save_coalesced(path: str, patches: Dict[str, Dict[str, Any]]) -> None:
+    """Persistir `patches` fuera del event loop, coalesciendo escrituras frecuentes."""
+    loop = asyncio.get_running_loop()
+    if _SAVE_STATE['path'] not in (None, path):
+        await flush_pending_save()
+    # leer tras el flush: _write_pending reemplaza el dict pendiente
+    pending = _SAVE_STATE['pending']
+    for bid, fields in patches.items():
+        pending.setdefault(bid, {}).update(fields)
+    _SAVE_STATE['path'] = path
+    if _SAVE_STATE['handle'] is not None:
+        return  # ya hay una escritura programada; se llevará estos cambios
+    last = _SAVE_STATE['last']
+    remaining = 0.0 if last is None else SAVE_MIN_INTERVAL_S - (loop.time() - last)
+    if remaining <= 0:
+        await flush_pending_save()
+    else:
+        _SAVE_STATE['handle'] = loop.call_later(remaining, _start_deferred_save)
+
+
+def _start_deferred_save() -> None:
+    _SAVE_STATE['handle'] = None
+    task = asyncio.ensure_future(_write_pending())
+    _SAVE_STATE['task'] = task  # referencia fuerte; flush_pending_save la espera
+    task.add_done_callback(_deferred_save_done)
+
+
+def _deferred_save_done(task: asyncio.Future) -> None:
+    if _SAVE_STATE['task'] is task:
+        _SAVE_STATE['task'] = None
+    if not task.cancelled() and task.exception() is not None:
+        log.error("deferred sync save failed", exc_info=task.exception())
+
+
+async def _write_pending() -> None:
+    pending = _SAVE_STATE['pending']
+    path = _SAVE_STATE['path']
+    if not pending or path is None:
+        return
+    _SAVE_STATE['pending'] = {}
+    loop = asyncio.get_running_loop()
+    _SAVE_STATE['last'] = loop.time()
+    await loop.run_in_executor(None, save_breakers_patch, path, pending)
+
+
+async def flush_pending_save() -> None:
+    """Escribir inmediatamente los cambios de sync pendientes (p.ej. al apagar)."""
+    handle = _SAVE_STATE['handle']
+    if handle is not None:
+        handle.cancel()
+        _SAVE_STATE['handle'] = None
+    task = _SAVE_STATE['task']
+    if task is not None:
+        # escritura diferida en curso: esperarla para no dejarla suelta ni reordenar
+        try:
+            await task
+        except Exception:
+            pass  # ya registrada en _deferred_save_done
+    await _write_pending()
+
+
+async def _fetch_states(session, headers: Dict[str, str]) -> List[Dict[str, Any]]:
+    """GET /api/states; lanza RuntimeError('status_<code>') si HA no responde 200."""
+    async with session.get(f"{HA_URL}/api/states", headers=headers) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f'status_{resp.status}')
+        if orjson is not None:
+            return orjson.loads(await resp.read())
+        return await resp.json()
+
+
+async def sync_all_breakers_from_ha(path: str, session: Optional[Any] = None) -> Dict[str, Any]:
     """Obtiene todos los estados via /api/states y sincroniza breakers locales.
 
     Devuelve: {
@@ -216,114 +535,81 @@ async def sync_all_breakers_from_ha(path: str) -> Dict[str, Any]:
     """
     if not (HA_URL and HA_TOKEN):
         return {'ok': False, 'error': 'ha_not_configured'}
-    import aiohttp
+    if aiohttp is None:
+        return {'ok': False, 'error': 'aiohttp_not_available'}
     headers = {'Authorization': f'Bearer {HA_TOKEN}', 'Content-Type': 'application/json'}
+    # GET a HA y lectura del JSON local son independientes: solaparlas
+    loop = asyncio.get_running_loop()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{HA_URL}/api/states", headers=headers) as resp:
-                if resp.status != 200:
-                    return {'ok': False, 'error': f'status_{resp.status}'}
-                states = await resp.json()
+        session = session or get_ha_session()
+        states_task = asyncio.create_task(_fetch_states(session, headers))
     except Exception as e:
         return {'ok': False, 'error': str(e)}
+    try:
+        data = await loop.run_in_executor(None, load_data, path)
+        states = await states_task
+    except Exception as e:
+        # cancelar la consulta pendiente y recoger su resultado (sin avisos de tarea suelta)
+        states_task.cancel()
+        states_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return {'ok': False, 'error': str(e)}
 
-    data = load_data(path)
-    breakers: List[Dict[str, Any]] = data.get('breakers', [])
+    # copias superficiales: load_data devuelve el dict en caché y aquí solo se calculan parches
+    breakers: List[Dict[str, Any]] = [dict(b) for b in data.get('breakers', [])]
     updated_list: List[Dict[str, Any]] = []
-    dirty = False
-
-    # Índice rápido de estados por entity_id
-    states_index: Dict[str, Dict[str, Any]] = {s.get('entity_id'): s for s in states if s.get('entity_id')}
-
-    # Helper: coerción numérica (acepta "123.4V", "10A", etc.)
-    num_re = re.compile(r'^\s*([0-9]+(?:[\.,][0-9]+)?)')
-    def _coerce(val):
-        if val is None:
-            return None
-        if isinstance(val, (int, float)):
-            return float(val)
-        if isinstance(val, str):
-            m = num_re.match(val)
-            if not m:
-                return None
-            txt = m.group(1).replace(',', '.')
-            try:
-                return float(txt)
-            except Exception:
-                return None
-        return None
-
-    # Decodificador Tuya base64 (DP): dpid(1) type(1) len(2) value(len)
-    def _decode_tuya_b64(b64_text: str) -> Dict[str, float]:
-        out: Dict[str, float] = {}
-        try:
-            raw = base64.b64decode(b64_text)
-        except Exception:
-            return out
-        i = 0
-        while i + 4 <= len(raw):
-            dpid = raw[i]
-            dtype = raw[i+1]
-            ln = int.from_bytes(raw[i+2:i+4], 'big')
-            start = i + 4
-            end = start + ln
-            if end > len(raw):
-                break
-            val_bytes = raw[start:end]
-            i = end
-            val = None
-            if dtype in (0x02, 0x04, 0x00):  # value entero
-                try:
-                    val = int.from_bytes(val_bytes, 'big')
-                except Exception:
-                    val = None
-            if val is None:
-                continue
-            if dpid == 18:  # corriente mA
-                out['current'] = round(val / 1000.0, 3)
-            elif dpid == 19:  # potencia deci-W
-                out['power'] = round(val / 10.0, 2)
-            elif dpid == 20:  # voltaje deci-V
-                out['voltage'] = round(val / 10.0, 2)
-            elif dpid in (101, 102, 21):  # energía (heurística)
-                # 21 a veces Wh acumulados; 101/102 centésimas kWh
-                if val > 100000:  # grande -> Wh
-                    out['energy'] = round(val / 1000.0, 3)
-                else:
-                    out['energy'] = round(val / 100.0, 3)
-        return out
+    # cambios por breaker id, para persistirlos sin pisar escrituras concurrentes
+    patches: Dict[str, Dict[str, Any]] = {}
+    # cambios de estado vistos en HA: se escriben ya, no con la escritura diferida
+    # (un parche atrasado podría revertir un toggle hecho entretanto)
+    estado_patches: Dict[str, Dict[str, Any]] = {}
 
+    # Entidades que realmente se consultan: principal, *_entity y candidatos auto-descubribles.
     # Auto-descubrimiento de sensores relacionados si no se definieron explicitamente
     # Regla: partir del nombre base del switch (switch.xxx) => buscar sensor.xxx_power / _voltage etc
+    wanted = set()
+    discovery: List[tuple] = []  # (breaker, {metric: [candidatos]})
     for b in breakers:
         base_entity = b.get('entity_id')
-        if not base_entity or '.' not in base_entity:
-            continue
-        base_name = base_entity.split('.', 1)[1]
-        # Si ya hay métricas cargadas, saltar (se actualizarán abajo igualmente)
-        # Localizar sensores candidatos
-        # Añadimos sufijos comunes y variantes trifásicas (phase_a) para cubrir sensores con nombres distintos
-        for metric, suffixes in {
-            'power': ['power', 'active_power', 'current_power', 'power_w', 'phase_a_power', 'phase_a_active_power'],
-            'voltage': ['voltage', 'voltage_v', 'phase_a_voltage', 'phase_a_phase_voltage'],
-            'current': ['current', 'current_a', 'phase_a_current', 'phase_a_i'],
-            'energy': ['energy', 'energy_total', 'total_energy', 'energy_kwh', 'phase_a_energy']
-        }.items():
-            explicit_key = f'{metric}_entity'
-            if b.get(explicit_key):
-                continue  # ya configurado manualmente
-            for suf in suffixes:
-                cand = f'sensor.{base_name}_{suf}'
-                if cand in states_index:
-                    b[explicit_key] = cand
-                    dirty = True
-                    break
+        if base_entity:
+            wanted.add(base_entity)
+        for key in _METRIC_ENTITY_KEYS:
+            ent = b.get(key)
+            if ent:
+                wanted.add(ent)
+        if base_entity and '.' in base_entity:
+            base_name = base_entity.split('.', 1)[1]
+            candidates = {
+                metric: [f'sensor.{base_name}_{suf}' for suf in suffixes]
+                for metric, suffixes in _METRIC_SUFFIX_ITEMS
+                if not b.get(f'{metric}_entity')  # ya configurado manualmente
+            }
+            if candidates:
+                discovery.append((b, candidates))
+                for cands in candidates.values():
+                    wanted.update(cands)
+
+    # Índice rápido de estados por entity_id (solo las entidades de interés)
+    states_index: Dict[str, Dict[str, Any]] = {eid: s for s in states if (eid := s.get('entity_id')) in wanted}
+
+    present = states_index.keys()
+    for b, candidates in discovery:
+        for metric, cands in candidates.items():
+            hit = next((c for c in cands if c in present), None)
+            if hit is not None:
+                explicit_key = f'{metric}_entity'
+                b[explicit_key] = hit
+                patches.setdefault(b.get('id'), {})[explicit_key] = hit
 
     # Ahora iterar nuevamente para actualizar estado y métricas
     for b in breakers:
         changed = False
         metrics_changed: Dict[str, Any] = {}
         primary_entity = b.get('entity_id')
+        power_ent = b.get('power_entity')
+        energy_ent = b.get('energy_entity')
+        voltage_ent = b.get('voltage_entity')
+        current_ent = b.get('current_entity')
+        spec_entities = (('power', power_ent), ('energy', energy_ent), ('voltage', voltage_ent), ('current', current_ent))
         # Actualizar estado desde la entidad primaria si existe
         st_primary = states_index.get(primary_entity)
         if st_primary:
@@ -331,12 +617,14 @@ async def sync_all_breakers_from_ha(path: str) -> Dict[str, Any]:
             new_estado = True if new_state_val == 'on' else False
             if b.get('estado') != new_estado:
                 b['estado'] = new_estado
+                estado_patches[b.get('id')] = {'estado': new_estado}
                 changed = True
         # Recolectar métricas de entidades específicas y fallback atributos del switch
         candidate_entities = [primary_entity]
-        for key in ('power_entity', 'energy_entity', 'voltage_entity', 'current_entity'):
-            ent = b.get(key)
-            if ent and ent not in candidate_entities:
+        seen = {primary_entity}
+        for ent in (power_ent, energy_ent, voltage_ent, current_ent):
+            if ent and ent not in seen:
+                seen.add(ent)
                 candidate_entities.append(ent)
         collected: Dict[str, Any] = {}
         for ent in candidate_entities:
@@ -345,20 +633,17 @@ async def sync_all_breakers_from_ha(path: str) -> Dict[str, Any]:
                 continue
             attrs = st.get('attributes') or {}
             # Prioridad: si la entidad es específica de la métrica, tomar su state directo
-            for metric in ('power', 'energy', 'voltage', 'current'):
-                spec_key = f'{metric}_entity'
-                if b.get(spec_key) == ent:
+            for metric, spec_ent in spec_entities:
+                if spec_ent == ent:
                     val = _coerce(st.get('state')) or _coerce(attrs.get(metric))
                     if val is not None:
                         collected[metric] = val
+            # Con las cuatro métricas reunidas, las demás entidades solo pueden aportar
+            # por la prioridad anterior: saltar los escaneos de atributos
+            if len(collected) == _METRIC_COUNT:
+                continue
             # Atributos genéricos
-            mapping = {
-                'power': ['power', 'current_power_w', 'power_w', 'instant_power', 'active_power'],
-                'energy': ['energy', 'today_energy_kwh', 'energy_kwh', 'total_energy', 'total_energy_kwh'],
-                'voltage': ['voltage', 'voltage_v', 'current_voltage'],
-                'current': ['current', 'current_a', 'current_ma'],
-            }
-            for metric, keys in mapping.items():
+            for metric, keys in _METRIC_ATTR_ITEMS:
                 if metric in collected:
                     continue
                 for k in keys:
@@ -371,7 +656,7 @@ async def sync_all_breakers_from_ha(path: str) -> Dict[str, Any]:
                             collected[metric] = val
                             break
             # Intentar extraer de cadenas con unidades
-            for metric in ('power', 'energy', 'voltage', 'current'):
+            for metric in _METRIC_ORDER:
                 if metric in collected:
                     continue
                 for k, v in attrs.items():
@@ -381,27 +666,29 @@ async def sync_all_breakers_from_ha(path: str) -> Dict[str, Any]:
                             collected[metric] = num
                             break
             # Base64 fallback (buscar valor que parezca base64 largo)
-            if not all(m in collected for m in ('power', 'voltage', 'current')):
+            if not all(m in collected for m in _B64_METRICS):
                 for k, v in attrs.items():
                     if not isinstance(v, str) or len(v) < 16:
                         continue
-                    if re.fullmatch(r'[A-Za-z0-9+/=]+', v):
+                    if _B64_RE.fullmatch(v):
                         decoded = _decode_tuya_b64(v)
                         for mk, mv in decoded.items():
                             collected.setdefault(mk, mv)
-                        if all(m in collected for m in ('power', 'voltage', 'current')):
+                        if all(m in collected for m in _B64_METRICS):
                             break
         # Aplicar métricas recogidas
-        for metric in ('power', 'energy', 'voltage', 'current'):
-            if metric in collected and collected[metric] is not None:
-                if b.get(metric) != collected[metric]:
-                    b[metric] = collected[metric]
-                    metrics_changed[metric] = collected[metric]
-                    changed = True
+        for metric, val in collected.items():
+            if b.get(metric) != val:
+                b[metric] = val
+                metrics_changed[metric] = val
+                changed = True
         if changed:
-            dirty = True
+            if metrics_changed:
+                patches.setdefault(b.get('id'), {}).update(metrics_changed)
             updated_list.append({'id': b.get('id'), 'estado': b.get('estado'), **metrics_changed})
 
-    if dirty:
-        save_data(path, data)
+    if estado_patches:
+        await loop.run_in_executor(None, save_breakers_patch, path, estado_patches)
+    if patches:
+        await _save_coalesced(path, patches)
     return {'ok': True, 'updated': updated_list}
@@ -12,9 +12,11 @@ Responsabilidades:
 """
 from typing import Dict, Any, Callable
 import asyncio
+import threading
 import time
 import logging
 import importlib
+import inspect
 
 log = logging.getLogger('consumption_manager')
 # Configuración de logging por defecto (solo si no hay handlers configurados)
@@ -30,18 +32,19 @@ save_data = getattr(models_mod, 'save_data')
 update_breaker_fields = getattr(models_mod, 'update_breaker_fields')
 get_tarjeta_for_breaker = getattr(models_mod, 'get_tarjeta_for_breaker')
 set_breaker_state = getattr(models_mod, 'set_breaker_state')
-adjust_tarjeta_saldo = getattr(models_mod, 'adjust_tarjeta_saldo', None)
-# importar clase Tarjeta para callbacks
-models_py = importlib.import_module('scripts.models')
-TarjetaClass = getattr(models_py, 'Tarjeta')
+flush_pending = getattr(models_mod, 'flush_pending')
+data_lock = getattr(models_mod, 'data_lock')
+normalize_power = getattr(importlib.import_module('scripts.power_utils'), 'normalize_power')
 try:
     bs_mod = importlib.import_module('scripts.breaker_service')
-    async_set_breaker = getattr(bs_mod, 'set_breaker', None)
+    async_set_breakers_bulk = getattr(bs_mod, 'set_breakers_bulk', None)
 except Exception:
-    async_set_breaker = None
+    async_set_breakers_bulk = None
 
 # Broadcaster global (inyectado por web_ui). Debe estar disponible SIEMPRE.
-_broadcaster: Callable[[dict], Any] | None = None
+# Se guarda como una sola tupla (callback, es_async) para que _emit lea ambos
+# valores de forma consistente sin lock aunque se re-registre desde otro hilo.
+_broadcaster: tuple | None = None
 
 def set_broadcaster(cb: Callable[[dict], Any]):
     """Registrar una función (sincrónica o async) para emitir eventos a la UI.
@@ -49,47 +52,104 @@ def set_broadcaster(cb: Callable[[dict], Any]):
     La función recibirá un diccionario con el payload a enviar por WebSocket.
     """
     global _broadcaster
-    _broadcaster = cb
+    _broadcaster = (cb, inspect.iscoroutinefunction(cb))
 
-def _emit(msg: dict):
+# referencias a tareas en segundo plano hasta que terminen (el loop solo guarda referencias débiles)
+_bg_tasks: set = set()
+
+def _spawn_bg(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
+
+def _emit(msg: dict, spawn: Callable[[Any], Any] = _spawn_bg):
     """Intentar emitir un mensaje usando el broadcaster si está disponible."""
-    global _broadcaster
-    if _broadcaster is None:
+    snapshot = _broadcaster
+    if snapshot is None:
         return
+    cb, is_async = snapshot
     try:
-        res = _broadcaster(msg)
-        # si es coroutine, agendar
-        if asyncio.iscoroutine(res):
-            asyncio.create_task(res)
+        if is_async:
+            spawn(cb(msg))
+        else:
+            res = cb(msg)
+            # callback sync que igualmente devuelve una coroutine
+            if asyncio.iscoroutine(res):
+                spawn(res)
     except Exception:
         # no romper el loop por errores de UI
         pass
 
 
-def _strip_breaker_saldo(data: Dict[str, Any]) -> None:
-    """Eliminar campos `saldo` y `max_saldo` de los breakers."""
-    try:
-        for bb in data.get('breakers', []):
-            if 'saldo' in bb:
-                bb.pop('saldo', None)
-            if 'max_saldo' in bb:
-                bb.pop('max_saldo', None)
-    except Exception:
-        pass
+def _strip_breaker_saldo(data: Dict[str, Any]) -> bool:
+    """Eliminar campos `saldo` y `max_saldo` de los breakers. Devuelve True si quitó alguno."""
+    stripped = False
+    for bb in data.get('breakers', []):
+        if 'saldo' in bb or 'max_saldo' in bb:
+            bb.pop('saldo', None)
+            bb.pop('max_saldo', None)
+            stripped = True
+    return stripped
 
 INTERVAL_SECONDS = 1.0
+MAX_ELAPSED_SECONDS = 5 * INTERVAL_SECONDS
+
+
+def _deduct_saldo(tarjeta: Dict[str, Any], energy_ws: float) -> float:
+    """Descuenta energy_ws del saldo de la tarjeta (in situ, mínimo 0) y devuelve el nuevo saldo."""
+    try:
+        current = float(tarjeta.get('saldo') or 0.0)
+    except (TypeError, ValueError):
+        current = 0.0
+    nuevo = round(max(0.0, current - energy_ws), 6)
+    tarjeta['saldo'] = nuevo
+    return nuevo
+
 
 class ConsumptionManager:
     def __init__(self, path: str):
         self.path = path
         self._task = None
         self._running = False
+        self._ev_loop: asyncio.AbstractEventLoop | None = None
+        self._bg_tasks: set = set()
+        # breakers con un apagado por saldo en curso (evita repetirlo en cada tick)
+        self._forced_off_ids: set = set()
+        # despierta el loop antes de INTERVAL_SECONDS (ver poke())
+        self._wakeup = asyncio.Event()
+        # breaker id -> {'ws', 'power'} del último tick (también va en breakers:consumption)
+        self.last_consumption: Dict[str, Dict[str, Any]] = {}
+
+    async def flush(self) -> None:
+        # los descuentos se escriben en cada tick; solo quedan cambios de breakers en write-behind
+        flush_pending(self.path)
+
+    def _spawn(self, coro):
+        """Crear una tarea en el loop del manager y retener la referencia hasta que termine."""
+        loop = self._ev_loop
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                coro.close()  # sin loop (p.ej. _tick desde los scripts de demo)
+                raise
+        task = loop.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
+
+    def poke(self) -> None:
+        """Forzar un tick inmediato (p.ej. tras encender un breaker o recargar saldo)."""
+        self._wakeup.set()
 
     def start(self):
         if self._running:
             return
+        assert self._task is None or self._task.done(), 'consumption_manager ya iniciado'
         self._running = True
-        self._task = asyncio.create_task(self._loop())
+        self._ev_loop = asyncio.get_running_loop()
+        self._task = self._spawn(self._loop())
         log.info('consumption_manager started')
 
     async def stop(self):
@@ -103,215 +163,156 @@ class ConsumptionManager:
                 await t
             except asyncio.CancelledError:
                 pass
+        # dejar terminar los apagados/broadcasts en curso
+        pending = [bt for bt in self._bg_tasks if bt is not t]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self.flush()
         log.info('consumption_manager stopped')
 
     async def _loop(self):
-        # mantiene un timestamp para integracion
-        last = time.time()
+        # mantiene un timestamp para integracion (monotónico: inmune a ajustes de reloj/NTP)
+        last = time.monotonic()
         try:
             while self._running:
-                now = time.time()
-                elapsed = now - last
+                now = time.monotonic()
+                # acotar saltos anómalos (p.ej. equipo suspendido) para no vaciar saldos de golpe
+                elapsed = min(now - last, MAX_ELAPSED_SECONDS)
                 last = now
                 try:
                     self._tick(elapsed)
                 except Exception as e:
                     log.exception('tick error')
-                await asyncio.sleep(INTERVAL_SECONDS)
+                remaining = INTERVAL_SECONDS - (time.monotonic() - now)
+                if self._wakeup.is_set() or remaining <= 0:
+                    # poke durante el tick o tick más largo que el intervalo: solo ceder
+                    # el turno al loop (sleep(0) no arma timer) y recalcular enseguida
+                    await asyncio.sleep(0)
+                else:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
         except asyncio.CancelledError:
             return
 
     def _tick(self, elapsed_seconds: float):
-        data = load_data(self.path)
-        changed = False
-        for b in data.get('breakers', []):
-            # solo descontar si el breaker está encendido
-            if not bool(b.get('estado')):
-                continue
-            # obtener potencia reportada
-            power = b.get('power')
-            v = b.get('voltage')
-            i = b.get('current')
-            # intentar inferir potencia desde voltage * current si está disponible
-            inferred = None
-            try:
-                if v is not None and i is not None:
-                    inferred = float(v) * float(i)
-            except Exception:
-                inferred = None
-
-            # Normalizar power a vatios. Algunos sensores/reportes usan kW (p.ej. 0.059)
-            # o ya vienen en W (p.ej. 59). Regla heurística:
-            # - Si power es None, usar inferred si existe.
-            # - Si power < 10 y inferred is not None and inferred > power * 10, es probable que power esté en kW -> convertir a W (power*1000).
-            # - Si power < 10 y inferred is None, también puede ser kW: convertir a W si parece razonable (multiplicar por 1000).
+        # leer-modificar-guardar sobre el dict compartido de models_loader y bajo su lock:
+        # los saldos que fijen otros escritores (handlers, hilos del executor) se ven en el
+        # acto y ninguna copia vieja pisa a otra. Una escritura por tick con cambios.
+        with data_lock():
+            data = load_data(self.path)
+            dirty = _strip_breaker_saldo(data)  # datos antiguos con saldo copiado al breaker
+            events, to_turn_off, changed = self._deduct(data, elapsed_seconds)
+            if dirty or changed:
+                save_data(self.path, data)
+        # apagado físico de los breakers sin saldo, todos en una llamada (el estado ya
+        # quedó persistido); no apilar otro apagado si el anterior sigue en curso
+        off_ids = [bid for bid in to_turn_off if bid not in self._forced_off_ids]
+        if off_ids and async_set_breakers_bulk is not None:
             try:
-                if power is None:
-                    power = inferred
-                else:
-                    power = float(power)
-                    if inferred is not None:
-                        # si la inferred es mucho mayor que power, ajustar escala
-                        if inferred > power * 10 and power < 10:
-                            # probable kW -> pasar a W
-                            power = power * 1000.0
-                    else:
-                        # no hay inferred; si power es pequeño (<10) asumimos kW
-                        if power < 10:
-                            power = power * 1000.0
+                task = self._spawn(async_set_breakers_bulk(self.path, off_ids, False))
             except Exception:
-                power = inferred
+                log.exception('error scheduling set_breakers_bulk OFF')
+            else:
+                self._forced_off_ids.update(off_ids)
+                task.add_done_callback(lambda _t: self._forced_off_ids.difference_update(off_ids))
+        # un único mensaje por tick con todos los eventos
+        if events:
+            _emit({'type': 'breakers:tick', 'events': events, 't': time.time()}, self._spawn)
 
+    def _deduct(self, data: Dict[str, Any], elapsed_seconds: float):
+        """Descuenta en `data` el consumo del intervalo y apaga (en memoria) los breakers
+        sin saldo. Devuelve (eventos, ids a apagar físicamente, hubo cambios)."""
+        events: list = []
+        # Fase 1: potencia normalizada (W) de los breakers encendidos
+        on_breakers = []
+        for b in data.get('breakers', []):
+            get = b.get
+            if get('estado'):
+                on_breakers.append((b, get('id'), normalize_power(get('power'), get('voltage'), get('current'))))
+        if not on_breakers:
+            return events, [], False
+        tarjeta_by_id = {t.get('id'): t for t in data.get('tarjetas', []) if t.get('id')}
+        log_debug, log_info = log.debug, log.info
+        last_consumption = self.last_consumption
+        # Fase 2: agrupar consumo por tarjeta
+        by_tarjeta: Dict[Any, tuple] = {}  # tarjeta id -> (tarjeta, [(breaker, id, W, W·s)])
+        for b, bid, power in on_breakers:
             if power is None:
                 # no hay forma de saber la potencia
-                try:
-                    log.debug(f"[tick consumo] breaker={b.get('id')} sin potencia disponible (no se descuenta)")
-                except Exception:
-                    pass
+                log_debug("[tick consumo] breaker=%s sin potencia disponible (no se descuenta)", bid)
                 # también enviar un ping de consumo sin potencia para trazabilidad en UI
-                try:
-                    _emit({'type': 'breakers:consumption', 'id': b.get('id'), 'power': None, 'ws': 0.0})
-                except Exception:
-                    pass
+                events.append({'type': 'breakers:consumption', 'id': bid, 'power': None, 'ws': 0.0})
                 continue
 
-            # restar del saldo asociado usando helper centralizado
-            tarjeta = get_tarjeta_for_breaker(self.path, b)
+            # tarjeta asociada
+            tarjeta = tarjeta_by_id.get(b.get('tarjeta'))
             if tarjeta is None:
                 continue
-            saldo = tarjeta.get('saldo') or 0.0
-            nuevo_saldo = float(saldo)
-            # Si el saldo ya es 0 o menos y el breaker está ON, apagarlo de inmediato
-            if nuevo_saldo <= 0.0 and b.get('estado'):
-                try:
-                    b['estado'] = False
-                    _strip_breaker_saldo(data)
-                    save_data(self.path, data)
-                except Exception:
-                    pass
-                try:
-                    if async_set_breaker is not None:
-                        # ejecutar apagado físico vía servicio asíncrono (Tuya/HA)
-                        asyncio.create_task(async_set_breaker(self.path, b.get('id'), False))
-                except Exception:
-                    log.exception('error scheduling async_set_breaker OFF')
-                try:
-                    log.info(f"[tick consumo] breaker={b.get('id')} tarjeta={tarjeta.get('id')} saldo=0 -> forzar OFF")
-                except Exception:
-                    pass
-                # avisar a la UI
-                try:
-                    _emit({'type': 'breakers:update', 'id': b.get('id'), 'state': 'off', 'reason': 'saldo=0'})
-                except Exception:
-                    pass
-                changed = True
-                # nada más que hacer para este breaker en este tick
-                continue
-
             # ahora power está en W. energy en W·s por elapsed: W * s
-            energy_ws = (float(power) * elapsed_seconds)
+            energy_ws = power * elapsed_seconds
+            tid = tarjeta['id']
+            entry = by_tarjeta.get(tid)
+            if entry is None:
+                entry = by_tarjeta[tid] = (tarjeta, [])
+            entry[1].append((b, bid, power, energy_ws))
+
+        # Fase 3: un único descuento por tarjeta (varios breakers pueden compartirla)
+        to_turn_off: list = []  # (breaker, id, tarjeta id, motivo)
+        changed = False
+        for tid, (tarjeta, members) in by_tarjeta.items():
             try:
-                log.debug(f"tick breaker={b.get('id')} powerW={power:.3f} elapsed={elapsed_seconds:.3f}s energyWs={energy_ws:.3f} tarjeta={tarjeta.get('id')} saldo_before={saldo}")
-            except Exception:
-                pass
-            if adjust_tarjeta_saldo is not None:
-                # delta negativo
-                t_upd = adjust_tarjeta_saldo(self.path, tarjeta.get('id'), -energy_ws)
-                if t_upd is not None:
-                    try:
-                        nuevo_saldo = float(t_upd.get('saldo') or 0.0)
-                    except Exception:
-                        nuevo_saldo = 0.0
-                    # recargar data tras persistencia para mantener consistencia
-                    data = load_data(self.path)
-                    # re-vincular 'b' al breaker dentro del nuevo data
-                    try:
-                        bid = b.get('id')
-                        for bb in data.get('breakers', []):
-                            if bb.get('id') == bid:
-                                b = bb
-                                break
-                    except Exception:
-                        pass
-                try:
-                    log.info(
-                        f"[tick consumo] breaker={b.get('id')} tarjeta={tarjeta.get('id')} "
-                        f"W={float(power):.2f} Ws={energy_ws:.2f} saldo {float(saldo):.2f} -> {float(nuevo_saldo):.2f}"
-                    )
-                    _emit({'type': 'breakers:consumption', 'id': b.get('id'), 'power': round(float(power), 6), 'ws': round(energy_ws, 6), 'tarjeta': tarjeta.get('id'), 'saldo_before': float(saldo), 'saldo_after': float(nuevo_saldo)})
-                except Exception:
-                    pass
-                changed = True
-            else:
-                # Fallback con clase Tarjeta si helper no disponible
-                tmp_tar = TarjetaClass(tarjeta.get('id'))
-                tmp_tar.saldo = float(saldo)
-                def _on_empty_closure(tid=tarjeta.get('id')):
-                    try:
-                        for bb in data.get('breakers', []):
-                            if bb.get('tarjeta') == tid and bb.get('estado'):
-                                bb['estado'] = False
-                                try:
-                                    set_breaker_state(self.path, bb.get('id'), False)
-                                except Exception:
-                                    log.exception('on_empty: set_breaker_state error')
-                    except Exception:
-                        log.exception('on_empty closure error')
-                tmp_tar.on_empty = _on_empty_closure
-                tmp_tar.consumir(energy_ws)
-                nuevo_saldo = round(float(tmp_tar.saldo), 6)
-                if nuevo_saldo != float(saldo):
-                    for t in data.get('tarjetas', []):
-                        if t.get('id') == tarjeta.get('id'):
-                            t['saldo'] = nuevo_saldo
-                            changed = True
-                            break
-                try:
-                    log.info(
-                        f"[tick consumo] (fallback) breaker={b.get('id')} tarjeta={tarjeta.get('id')} "
-                        f"W={float(power):.2f} Ws={energy_ws:.2f} saldo {float(saldo):.2f} -> {float(nuevo_saldo):.2f}"
-                    )
-                    _emit({'type': 'breakers:consumption', 'id': b.get('id'), 'power': round(float(power), 6), 'ws': round(energy_ws, 6), 'tarjeta': tarjeta.get('id'), 'saldo_before': float(saldo), 'saldo_after': float(nuevo_saldo)})
-                except Exception:
-                    pass
-            # marcar consumo actual (en W·s por intervalo) y potencia
-            b['consumption_last_ws'] = round(energy_ws, 6)
-            b['consumption_power_w'] = power
-            changed = True
-            # si saldo agotado, apagar breaker (si está encendido).
-            # Nota: adjust_tarjeta_saldo ya intenta sincronizar breakers según saldo,
-            # pero reforzamos aquí por seguridad si el estado quedó inconsistente.
-            if nuevo_saldo <= 0 and b.get('estado'):
-                try:
-                    # reflejar en archivo y disparar apagado físico
-                    b['estado'] = False
-                    _strip_breaker_saldo(data)
-                    save_data(self.path, data)
-                    if async_set_breaker is not None:
-                        asyncio.create_task(async_set_breaker(self.path, b.get('id'), False))
-                    # reload to reflect external change
-                    data = load_data(self.path)
-                except Exception:
-                    log.exception('error apagando breaker tras saldo agotado')
-                try:
-                    log.warning(f"saldo agotado -> breaker OFF id={b.get('id')} tarjeta={tarjeta.get('id')}")
-                except Exception:
-                    pass
-                try:
-                    _emit({'type': 'breakers:update', 'id': b.get('id'), 'state': 'off', 'reason': 'saldo agotado'})
-                except Exception:
-                    pass
+                saldo = float(tarjeta.get('saldo') or 0.0)
+            except (TypeError, ValueError):
+                saldo = 0.0
+            # Si el saldo ya es 0 o menos, apagar de inmediato sus breakers encendidos
+            if saldo <= 0.0:
+                to_turn_off.extend((b, bid, tid, 'saldo=0') for b, bid, _, _ in members)
+                continue
+
+            total_ws = sum(m[3] for m in members)
+            nuevo_saldo = _deduct_saldo(tarjeta, total_ws)
+            changed = changed or nuevo_saldo != saldo
+            for b, bid, power, energy_ws in members:
+                log_debug("tick breaker=%s powerW=%.3f elapsed=%.3fs energyWs=%.3f tarjeta=%s saldo_before=%s",
+                          bid, power, elapsed_seconds, energy_ws, tid, saldo)
+                log_info("[tick consumo] breaker=%s tarjeta=%s W=%.2f Ws=%.2f saldo %.2f -> %.2f",
+                         bid, tid, power, energy_ws, saldo, nuevo_saldo)
+                events.append({'type': 'breakers:consumption', 'id': bid, 'power': round(power, 6), 'ws': round(energy_ws, 6), 'tarjeta': tid, 'saldo_before': saldo, 'saldo_after': nuevo_saldo})
+                # último consumo (W·s por intervalo) y potencia: telemetría en memoria, no se persiste
+                last_consumption[bid] = {'ws': round(energy_ws, 6), 'power': power}
+            # si saldo agotado, apagar los breakers de la tarjeta
+            if nuevo_saldo <= 0:
+                to_turn_off.extend((b, bid, tid, 'saldo agotado') for b, bid, _, _ in members)
+
+        # Fase 4: apagados por saldo (en memoria; _tick persiste y lanza el apagado físico)
+        for b, bid, tid, reason in to_turn_off:
+            if b.get('estado'):
+                b['estado'] = False
                 changed = True
-        if changed:
-            _strip_breaker_saldo(data)
-            save_data(self.path, data)
+            log.warning("%s -> breaker OFF id=%s tarjeta=%s", reason, bid, tid)
+            events.append({'type': 'breakers:update', 'id': bid, 'state': 'off', 'reason': reason})
+        return events, [bid for _b, bid, _tid, _reason in to_turn_off], changed
 
 
 # helper factory
 _manager = None
 
+def poke() -> None:
+    """Despertar al manager global, si existe."""
+    if _manager is not None:
+        _manager.poke()
+
+
+_manager_lock = threading.Lock()
+
 def create_manager(path: str) -> ConsumptionManager:
     global _manager
     if _manager is None:
-        _manager = ConsumptionManager(path)
+        with _manager_lock:
+            # doble comprobación: dos llamadas concurrentes no deben crear dos managers (doble descuento)
+            if _manager is None:
+                _manager = ConsumptionManager(path)
     return _manager
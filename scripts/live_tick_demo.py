@@ -10,31 +10,7 @@ if ROOT not in sys.path:
 
 from scripts.consumption_manager import ConsumptionManager
 from scripts import models_loader
-
-
-def normalize_power(report, v, i):
-    """Misma heurística que en consumption_manager para obtener W."""
-    inferred = None
-    try:
-        if v is not None and i is not None:
-            inferred = float(v) * float(i)
-    except Exception:
-        inferred = None
-    power = report
-    try:
-        if power is None:
-            power = inferred
-        else:
-            power = float(power)
-            if inferred is not None:
-                if inferred > power * 10 and power < 10:
-                    power = power * 1000.0
-            else:
-                if power < 10:
-                    power = power * 1000.0
-    except Exception:
-        power = inferred
-    return power
+from scripts.power_utils import normalize_power
 
 
 def print_state(prefix, data):
@@ -68,6 +44,7 @@ if __name__ == '__main__':
         print('\n=== Tick', it + 1, '===')
         # mostrar lo que se calcula antes
         data_before = models_loader.load_data(DATA_P)
+        tarjetas_by_id = {t.get('id'): t for t in data_before.get('tarjetas', [])}
         for b in data_before.get('breakers', []):
             rep = b.get('power')
             v = b.get('voltage')
@@ -77,7 +54,7 @@ if __name__ == '__main__':
             if norm is not None:
                 energy_ws = round(float(norm) * 1.0, 6)
             tar = b.get('tarjeta')
-            tar_obj = next((t for t in data_before.get('tarjetas', []) if t.get('id') == tar), None)
+            tar_obj = tarjetas_by_id.get(tar)
             saldo_before = tar_obj.get('saldo') if tar_obj else None
             print(f"Breaker {b.get('id')[:8]}: reported={rep}, inferred={v}*{i}={round(v*i,6) if v and i else None}, normalized_W={norm}, energy_ws(1s)={energy_ws}, tarjeta={tar}, saldo_before={saldo_before}")
 
@@ -86,13 +63,15 @@ if __name__ == '__main__':
 
         # leer estado después y mostrar diferencias
         data_after = models_loader.load_data(DATA_P)
+        tarjetas_by_id = {t.get('id'): t for t in data_after.get('tarjetas', [])}
         for b in data_after.get('breakers', []):
             cid = b.get('id')
-            cons = b.get('consumption_last_ws')
-            pwr = b.get('consumption_power_w')
+            last = cm.last_consumption.get(cid, {})
+            cons = last.get('ws')
+            pwr = last.get('power')
             estado = b.get('estado')
             tar = b.get('tarjeta')
-            tar_obj = next((t for t in data_after.get('tarjetas', []) if t.get('id') == tar), None)
+            tar_obj = tarjetas_by_id.get(tar)
             saldo_after = tar_obj.get('saldo') if tar_obj else None
             print(f"After Breaker {cid[:8]}: consumption_last_ws={cons}, consumption_power_w={pwr}, estado={estado}, tarjeta_saldo_after={saldo_after}")
 
@@ -3,29 +3,30 @@ from typing import List, Optional, Callable
 import time
 
 
-@dataclass
+@dataclass(slots=True)
 class Arduino:
     id: str = ""
-    w_por_segundo = 0
+    w_por_segundo: float = 0.0
     es_estacion_carga: bool = True
 
     def calcular_carga(self, tiempo_ms: int) -> float:
         return self.w_por_segundo * (tiempo_ms / 1000)
 
-def hora_actual_ms() -> int:
-    return int(time.time() * 1000)
+def hora_actual_ms(_now_ns=time.monotonic_ns) -> int:
+    # reloj monotónico: solo se usa para medir duraciones de carga
+    return _now_ns() // 1_000_000
 
-@dataclass
+@dataclass(slots=True)
 class Tarjeta:
     id: str = ""
-    saldo = 0.0
+    saldo: float = 0.0
 
     cargando_tarjeta_en: Optional[Arduino] = None
     cargando_tarjeta_desde: Optional[int] = None
     carga_acumulada: float = 0.0
     # callbacks
-    on_carga: Optional = None
-    on_empty: Optional = None
+    on_carga: Optional[Callable[[], None]] = None
+    on_empty: Optional[Callable[[], None]] = None
     
     def comenzar_carga(self, punto_carga: Arduino) -> None:
         if not punto_carga.es_estacion_carga:
@@ -69,7 +70,7 @@ class Tarjeta:
         if punto_carga.es_estacion_carga:
             return
         self.cargar(self.carga_acumulada)
-        carga_acumulada = 0
+        self.carga_acumulada = 0.0
 
 
     # abona carga a la tarjeta y gatilla eventos
@@ -104,26 +105,21 @@ class Tarjeta:
 
 
 
-@dataclass
+@dataclass(slots=True)
 class Breaker:
     id: str = ""
-    tarjeta: Optional[Tarjeta] = None	
+    tarjeta: Optional[Tarjeta] = None
     estado: bool = True
 
     on_apagar: Optional[Callable[[], None]] = None
     on_encender: Optional[Callable[[], None]] = None
 
-    def __init__(self, id, tarjeta, estado, on_apagar, on_encender) -> None:
-        self.id = id
-        self.tarjeta = tarjeta
-        self.estado = estado
-        self.on_apagar = on_apagar
-        self.on_encender = on_encender
+    def __post_init__(self) -> None:
         # encender cuando la tarjeta se carga
-        if tarjeta:
-            tarjeta.on_carga = self.encender
-            tarjeta.on_empty = self.apagar
-            
+        if self.tarjeta:
+            self.tarjeta.on_carga = self.encender
+            self.tarjeta.on_empty = self.apagar
+
     def apagar(self) -> None:
         self.estado = False
         if self.on_apagar:
@@ -1,89 +1,363 @@
+import atexit
 import json
-from typing import Dict, Any, List, Optional
+import os
+import tempfile
+import threading
+from functools import wraps
+from typing import Any, Dict, List, Optional
+
+try:
+    import orjson
+except ImportError:  # opcional: serialización más rápida
+    orjson = None
+
+
+# Caché del JSON parseado por ruta: path -> [sello, data, índices]. El sello incluye el
+# inodo porque toda escritura reemplaza el archivo con os.replace. Es la única copia en
+# memoria de data.json del proceso: web_ui y el consumption manager trabajan sobre ella.
+_CACHE: Dict[str, list] = {}
+_CACHE_LOCK = threading.RLock()
+# path -> contador que sube con cada recarga o guardado (caducar derivados: índices, JSON)
+_VERSIONS: Dict[str, int] = {}
+
+# Write-behind: los cambios de breakers (estado, métricas) se agrupan y se escriben
+# una vez pasados WRITE_BEHIND_SECONDS; mientras tanto load_data devuelve el dict pendiente.
+WRITE_BEHIND_SECONDS = 0.05
+_PENDING: Dict[str, Dict[str, Any]] = {}
+_FLUSH_TIMERS: Dict[str, threading.Timer] = {}
+
+
+def _cache_locked(fn):
+    """Serializa leer-modificar-guardar sobre el dict en caché (hilos del executor y web_ui)."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _CACHE_LOCK:
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def data_lock() -> threading.RLock:
+    """Lock de leer-modificar-guardar: quien modifique in situ el dict de load_data
+    fuera de estas funciones (consumption manager) debe hacerlo tomándolo."""
+    return _CACHE_LOCK
+
+
+def data_version(path: str) -> int:
+    """Versión del dict de load_data(path): cambia al recargarlo o al guardarlo."""
+    return _VERSIONS.get(path, 0)
+
+
+def _bump(path: str) -> None:
+    _VERSIONS[path] = _VERSIONS.get(path, 0) + 1
+
+
+def _empty() -> Dict[str, Any]:
+    return {"tarjetas": [], "breakers": [], "arduinos": []}
+
+
+def _stamp(path: str) -> tuple:
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
 
 
 def load_data(path: str) -> Dict[str, Any]:
-    """Carga y devuelve el contenido JSON desde path. Si falla, devuelve estructuras vacías."""
+    """Carga y devuelve el contenido JSON desde path. Si falla, devuelve estructuras vacías.
+
+    Mientras el archivo no cambie (mtime/tamaño/inodo) devuelve el mismo dict en caché:
+    quien lo modifique debe persistirlo con save_data, o trabajar sobre una copia.
+    """
+    with _CACHE_LOCK:
+        pending = _PENDING.get(path)
+        if pending is not None:
+            return pending
+        try:
+            stamp = _stamp(path)
+        except OSError:
+            _CACHE.pop(path, None)
+            return _empty()
+        entry = _CACHE.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        except Exception:
+            # posible escritura a medias de otro proceso: no cachear
+            _CACHE.pop(path, None)
+            return _empty()
+        _CACHE[path] = [stamp, data, None]
+        _bump(path)
+        return data
+
+
+def _dumps(data: Dict[str, Any], compact: bool = False) -> bytes:
+    if orjson is not None:
+        opts = orjson.OPT_NON_STR_KEYS if compact else orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        try:
+            return orjson.dumps(data, option=opts)
+        except TypeError:
+            pass  # objetos no nativos: usar json estándar
+    if compact:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf8')
+    return json.dumps(data, ensure_ascii=False, indent=2).encode('utf8')
+
+
+def save_data(path: str, data: Dict[str, Any], compact: bool = False, durable: bool = False) -> None:
+    """Guarda el diccionario en path como JSON (escritura atómica vía archivo temporal).
+
+    compact=True omite la indentación (snapshots internos: archivo más chico y rápido).
+    durable=True hace fsync del archivo y del directorio: solo para cambios de saldo,
+    no para el ir y venir de estados de breakers.
+    """
+    with _CACHE_LOCK:
+        pending = _PENDING.get(path)
+        if pending is not None and pending is not data:
+            # otro dict con cambios aún en write-behind: escribirlo antes, no descartarlo
+            flush_pending(path)
+        else:
+            _cancel_pending(path)  # esta escritura reemplaza a la diferida
+        # serializar bajo el lock: el orden de las instantáneas es el de las escrituras
+        payload = _dumps(data, compact)
+        _write_atomic(path, payload, durable)
+        _bump(path)
+        entry = _CACHE.get(path)
+        if entry is not None and entry[1] is data:
+            # se guardó el dict en caché (modificado in situ): basta con renovar el sello
+            entry[0] = _stamp(path)
+        else:
+            _CACHE.pop(path, None)
+
+
+def save_data_deferred(path: str, data: Dict[str, Any]) -> None:
+    """Marca `data` como pendiente de guardar y agenda una única escritura para path."""
+    with _CACHE_LOCK:
+        _PENDING[path] = data
+        _bump(path)
+        if path not in _FLUSH_TIMERS:
+            timer = threading.Timer(WRITE_BEHIND_SECONDS, flush_pending, args=(path,))
+            timer.daemon = True
+            _FLUSH_TIMERS[path] = timer
+            timer.start()
+
+
+def _cancel_pending(path: str) -> Optional[Dict[str, Any]]:
+    timer = _FLUSH_TIMERS.pop(path, None)
+    if timer is not None:
+        timer.cancel()
+    return _PENDING.pop(path, None)
+
+
+def flush_pending(path: Optional[str] = None) -> None:
+    """Escribe ya los cambios diferidos de path (o de todos). Llamar antes de leer
+    data.json por fuera de load_data."""
+    with _CACHE_LOCK:
+        for p in ([path] if path is not None else list(_PENDING)):
+            data = _cancel_pending(p)
+            if data is not None:
+                save_data(p, data)
+
+
+atexit.register(flush_pending)
+
+
+def _write_atomic(path: str, payload: bytes, durable: bool = False) -> None:
+    # temporal único por escritor: hilos del executor y otros procesos escriben el mismo archivo
+    dirname = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=dirname)
     try:
-        with open(path, 'r', encoding='utf8') as f:
-            return json.load(f)
-    except Exception:
-        return {"tarjetas": [], "breakers": [], "arduinos": []}
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            os.chmod(tmp, os.stat(path).st_mode & 0o777)  # mkstemp crea con 0600
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    if durable:
+        _fsync_dir(dirname)
+
+
+def _fsync_dir(dirname: str) -> None:
+    """Persistir la entrada del directorio tras os.replace (no soportado en Windows)."""
+    try:
+        dfd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dfd)
+    except OSError:
+        pass
+    finally:
+        os.close(dfd)
+
+
+def _build_index(data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    breakers: Dict[str, Any] = {}
+    tarjetas: Dict[str, Any] = {}
+    by_tarjeta: Dict[str, List[Dict[str, Any]]] = {}
+    for b in data.get('breakers') or []:
+        # 'estado' siempre bool y presente: los helpers comparan con `is` sin .get()
+        est = b.get('estado')
+        if est is not True and est is not False:
+            b['estado'] = bool(est)
+        bid = b.get('id')
+        if bid not in breakers:  # ids duplicados: gana el primero, como el recorrido lineal
+            breakers[bid] = b
+        tid = b.get('tarjeta')
+        if tid:
+            by_tarjeta.setdefault(tid, []).append(b)
+    for t in data.get('tarjetas') or []:
+        tid = t.get('id')
+        if tid not in tarjetas:
+            tarjetas[tid] = t
+    return {'breakers': breakers, 'tarjetas': tarjetas, 'by_tarjeta': by_tarjeta}
+
+
+def _index(path: str, data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Índices id -> objeto de `data`; si es el dict en caché se construyen una vez por carga."""
+    entry = _CACHE.get(path)
+    if entry is None or entry[1] is not data:
+        return _build_index(data)
+    if entry[2] is None:
+        entry[2] = _build_index(data)
+    return entry[2]
+
+
+def _drop_index(path: str) -> None:
+    entry = _CACHE.get(path)
+    if entry is not None:
+        entry[2] = None
+
 
+@_cache_locked
+def save_breakers_patch(path: str, patches: Dict[str, Dict[str, Any]]) -> int:
+    """Aplica {breaker_id: {campo: valor}} sobre el JSON actual y persiste.
 
-def save_data(path: str, data: Dict[str, Any]) -> None:
-    """Guarda el diccionario en path como JSON."""
-    with open(path, 'w', encoding='utf8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    Revalida la caché (sello del archivo) justo antes de escribir para no pisar
+    cambios de otros procesos. Solo escribe si algún breaker cambió; devuelve cuántos se tocaron.
+    """
+    if not patches:
+        return 0
+    data = load_data(path)
+    touched = 0
+    by_id = _index(path, data)['breakers']
+    for bid, fields in patches.items():
+        b = by_id.get(bid)
+        if b is not None and fields and any(b.get(k) != v for k, v in fields.items()):
+            b.update(fields)
+            touched += 1
+    if touched:
+        save_data_deferred(path, data)
+    return touched
 
 
 def get_models(path: str) -> Dict[str, List[Dict[str, Any]]]:
     return load_data(path)
 
 
+@_cache_locked
 def get_breaker(path: str, breaker_id: str) -> Optional[Dict[str, Any]]:
     data = load_data(path)
-    for b in data.get('breakers', []):
-        if b.get('id') == breaker_id:
-            return b
-    return None
+    return _index(path, data)['breakers'].get(breaker_id)
 
 
+@_cache_locked
 def set_breaker_state(path: str, breaker_id: str, state: bool) -> Optional[Dict[str, Any]]:
     """Setea estado del breaker y persiste en el JSON. Devuelve el breaker modificado o None."""
     data = load_data(path)
-    modified = False
-    for b in data.get('breakers', []):
-        if b.get('id') == breaker_id:
-            b['estado'] = bool(state)
-            modified = True
-            break
-    if modified:
-        save_data(path, data)
-        return b
-    return None
+    b = _index(path, data)['breakers'].get(breaker_id)
+    if b is None:
+        return None
+    state = bool(state)
+    if b['estado'] is state:
+        return b  # sin cambios: no reescribir
+    b['estado'] = state
+    save_data_deferred(path, data)
+    return b
 
 
+@_cache_locked
 def toggle_breaker(path: str, breaker_id: str) -> Optional[Dict[str, Any]]:
     data = load_data(path)
-    for b in data.get('breakers', []):
-        if b.get('id') == breaker_id:
-            b['estado'] = not bool(b.get('estado', False))
-            save_data(path, data)
-            return b
-    return None
+    b = _index(path, data)['breakers'].get(breaker_id)
+    if b is None:
+        return None
+    b['estado'] = not b['estado']
+    save_data_deferred(path, data)
+    return b
 
 
+@_cache_locked
 def get_tarjeta_for_breaker(path: str, breaker: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """Si el breaker referencia una tarjeta por id, devolverla."""
     tarjeta_id = breaker.get('tarjeta')
     if not tarjeta_id:
         return None
     data = load_data(path)
-    for t in data.get('tarjetas', []):
-        if t.get('id') == tarjeta_id:
-            return t
-    return None
+    return _index(path, data)['tarjetas'].get(tarjeta_id)
 
 
+@_cache_locked
+def get_breakers_for_tarjeta(path: str, tarjeta_id: str) -> List[Dict[str, Any]]:
+    """Breakers asociados a la tarjeta (desde el índice, sin releer el archivo)."""
+    data = load_data(path)
+    return list(_index(path, data)['by_tarjeta'].get(tarjeta_id, ()))
+
+
+@_cache_locked
 def update_breaker_fields(path: str, breaker_id: str, **fields) -> Optional[Dict[str, Any]]:
     """Actualiza campos arbitrarios del breaker y persiste.
 
     Devuelve el breaker actualizado o None si no existe.
     """
     data = load_data(path)
-    updated = None
-    for b in data.get('breakers', []):
-        if b.get('id') == breaker_id:
-            for k, v in fields.items():
-                b[k] = v
-            updated = b
-            break
-    if updated is not None:
-        save_data(path, data)
+    updated = _index(path, data)['breakers'].get(breaker_id)
+    if updated is None:
+        return None
+    if all(k in updated and updated[k] == v for k, v in fields.items()):
+        return updated  # sin cambios: no reescribir
+    updated.update(fields)
+    if 'id' in fields or 'tarjeta' in fields:
+        _drop_index(path)
+    save_data_deferred(path, data)
     return updated
 
 
+def _set_breakers_state_inplace(breakers, state: bool) -> int:
+    """Ajusta 'estado' de los breakers dados sin tocar disco. Devuelve cuántos cambiaron."""
+    changed = 0
+    for b in breakers:
+        if b['estado'] is not state:
+            b['estado'] = state
+            changed += 1
+    return changed
+
+
+def _commit_tarjeta_saldo(path: str, data: Dict[str, Any], idx: Dict[str, Dict[str, Any]],
+                          t: Dict[str, Any], new_val: float) -> Dict[str, Any]:
+    """Fija el saldo de `t`, enciende/apaga sus breakers según saldo > 0 y persiste
+    (una sola escritura, con fsync) solo si algo cambió."""
+    new_saldo = round(new_val, 6)
+    changed = t.get('saldo') != new_saldo
+    t['saldo'] = new_saldo
+    # toggle breakers asociados (en memoria; se persiste una sola vez abajo)
+    desired_on = new_saldo > 0.0  # coherente con el saldo guardado
+    changed = _set_breakers_state_inplace(idx['by_tarjeta'].get(t.get('id'), ()), desired_on) or changed
+    if changed:
+        save_data(path, data, durable=True)
+    return t
+
+
+@_cache_locked
 def set_tarjeta_saldo(path: str, tarjeta_id: str, nuevo_saldo: float) -> Optional[Dict[str, Any]]:
     """Establece el saldo absoluto de una tarjeta y sincroniza breakers asociados.
 
@@ -92,30 +366,18 @@ def set_tarjeta_saldo(path: str, tarjeta_id: str, nuevo_saldo: float) -> Optiona
     Devuelve la tarjeta actualizada o None si no existe.
     """
     data = load_data(path)
-    tarjetas = data.get('tarjetas', [])
-    t = None
-    for tt in tarjetas:
-        if tt.get('id') == tarjeta_id:
-            t = tt
-            break
+    idx = _index(path, data)
+    t = idx['tarjetas'].get(tarjeta_id)
     if t is None:
         return None
     try:
         val = float(nuevo_saldo)
     except Exception:
         val = 0.0
-    t['saldo'] = round(val, 6)
-    # toggle breakers asociados
-    desired_on = t['saldo'] > 0.0
-    for b in data.get('breakers', []):
-        if b.get('tarjeta') == tarjeta_id:
-            if bool(b.get('estado')) != desired_on:
-                # actualizar estado y persistir vía helper existente
-                set_breaker_state(path, b.get('id'), desired_on)
-    save_data(path, data)
-    return t
+    return _commit_tarjeta_saldo(path, data, idx, t, val)
 
 
+@_cache_locked
 def adjust_tarjeta_saldo(path: str, tarjeta_id: str, delta: float) -> Optional[Dict[str, Any]]:
     """Ajusta el saldo de una tarjeta sumando 'delta' (puede ser negativo).
 
@@ -124,12 +386,8 @@ def adjust_tarjeta_saldo(path: str, tarjeta_id: str, delta: float) -> Optional[D
     - Persiste y devuelve la tarjeta actualizada
     """
     data = load_data(path)
-    tarjetas = data.get('tarjetas', [])
-    t = None
-    for tt in tarjetas:
-        if tt.get('id') == tarjeta_id:
-            t = tt
-            break
+    idx = _index(path, data)
+    t = idx['tarjetas'].get(tarjeta_id)
     if t is None:
         return None
     try:
@@ -140,12 +398,4 @@ def adjust_tarjeta_saldo(path: str, tarjeta_id: str, delta: float) -> Optional[D
         d = float(delta)
     except Exception:
         d = 0.0
-    new_val = max(0.0, current + d)
-    t['saldo'] = round(new_val, 6)
-    desired_on = new_val > 0.0
-    for b in data.get('breakers', []):
-        if b.get('tarjeta') == tarjeta_id:
-            if bool(b.get('estado')) != desired_on:
-                set_breaker_state(path, b.get('id'), desired_on)
-    save_data(path, data)
-    return t
+    return _commit_tarjeta_saldo(path, data, idx, t, max(0.0, current + d))
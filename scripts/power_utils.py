@@ -0,0 +1,40 @@
+"""Normalización de potencia compartida por consumption_manager y live_tick_demo."""
+from typing import Optional
+
+_NUM = (int, float)
+
+
+def _to_float(x) -> Optional[float]:
+    if x is None:
+        return None
+    if isinstance(x, _NUM):
+        return float(x)
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_power(power, v, i) -> Optional[float]:
+    """Normalizar la potencia reportada a vatios (None si no hay forma de saberla).
+
+    Algunos sensores/reportes usan kW (p.ej. 0.059) o ya vienen en W (p.ej. 59). Regla heurística:
+    - Si power es None, usar inferred (voltage * current) si existe.
+    - Si power < 10 y inferred > power * 10, es probable que power esté en kW -> convertir a W (power*1000).
+    - Si power < 10 y no hay inferred, también puede ser kW: convertir a W (multiplicar por 1000).
+    """
+    # caso común: lectura numérica ya en W (>= 10): ninguna rama de la heurística la cambia
+    if isinstance(power, _NUM) and power >= 10:
+        return float(power)
+    inferred = None
+    if v is not None and i is not None:
+        fv = _to_float(v)
+        fi = _to_float(i)
+        if fv is not None and fi is not None:
+            inferred = fv * fi
+    p = _to_float(power)
+    if p is None:
+        return inferred
+    if p < 10 and (inferred is None or inferred > p * 10):
+        return p * 1000.0
+    return p
@@ -1,7 +1,7 @@
 """Script de conveniencia para ejecutar un tick de consumo (1 s) y mostrar antes/después.
 Usar desde la raíz del repo con `python scripts/run_tick.py`.
 """
-import shutil, json, os, sys
+import shutil, os, sys
 
 # asegurar que la raíz del repo está en sys.path para importar el paquete scripts
 ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -9,25 +9,37 @@ if ROOT not in sys.path:
     sys.path.insert(0, ROOT)
 
 from scripts.consumption_manager import ConsumptionManager
+from scripts.models_loader import load_data
 
 P = os.path.join(os.path.dirname(__file__), 'data.json')
 BACKUP = P + '.bak'
-shutil.copyfile(P, BACKUP)
+# campos a mostrar: se recorren estas pocas claves en vez de todos los items de cada breaker
+KEYS_BEFORE = ('id', 'saldo', 'max_saldo', 'estado', 'power', 'voltage', 'current')
+KEYS_AFTER = ('id', 'estado')
+# save_data reemplaza el archivo (os.replace) en vez de reescribirlo: un hardlink
+# conserva el contenido original sin copiar bytes
+if os.path.exists(BACKUP):
+    os.remove(BACKUP)
+try:
+    os.link(P, BACKUP)
+except OSError:  # FS sin hardlinks
+    shutil.copyfile(P, BACKUP)
 print('Backup creado:', BACKUP)
-with open(P, 'r', encoding='utf8') as f:
-    before = json.load(f)
+before = load_data(P)
 print('Antes tarjetas:', before.get('tarjetas'))
-print('Antes breakers (saldo keys if any):', [{k: v for k, v in b.items() if k in ('id','saldo','max_saldo','estado','power','voltage','current')} for b in before.get('breakers', [])])
+print('Antes breakers (saldo keys if any):', [{k: b[k] for k in KEYS_BEFORE if k in b} for b in before.get('breakers', [])])
 
 cm = ConsumptionManager(P)
 cm._tick(1.0)
 
-with open(P, 'r', encoding='utf8') as f:
-    after = json.load(f)
+after = load_data(P)
 print('\nDespués tarjetas:', after.get('tarjetas'))
-print('Después breakers (relevantes):', [{k: v for k, v in b.items() if k in ('id','estado','consumption_last_ws','consumption_power_w')} for b in after.get('breakers', [])])
+print('Después breakers (relevantes):', [{k: b[k] for k in KEYS_AFTER if k in b} for b in after.get('breakers', [])])
+print('Consumo del tick (en memoria):', cm.last_consumption)
 
 # restaurar backup para que no queden cambios permanentes a menos que el usuario lo quiera
-shutil.copyfile(BACKUP, P)
-os.remove(BACKUP)
+if os.path.samefile(BACKUP, P):
+    os.remove(BACKUP)  # nada se escribió; rename entre enlaces del mismo inodo no hace nada
+else:
+    os.replace(BACKUP, P)
 print('\nRestaurado backup. Si quieres que el cambio persista, elimina la restauración en este script.')
\ No newline at end of file
@@ -1,4 +1,12 @@
+import asyncio
 import os
+import threading
+import time
+
+try:
+    import requests
+except ImportError:  # sin requests: urllib (una conexión nueva por llamada)
+    requests = None
 
 TUYA_ENABLED = os.environ.get('TUYA_ENABLED', '0') in ('1','true','True')
 TUYA_TOKEN = os.environ.get('TUYA_TOKEN')
@@ -13,6 +21,35 @@ except Exception:
         HA_URL = os.environ.get('HA_URL')
         HA_TOKEN = os.environ.get('HA_TOKEN')
 
+_HA_HEADERS = {'Authorization': f'Bearer {HA_TOKEN}', 'Content-Type': 'application/json'}
+_VALID_ACTIONS = frozenset(('encender', 'apagar', 'on', 'off'))
+_ON_ACTIONS = frozenset(('encender', 'on'))
+
+# Sesión HTTP con HA por hilo: reutiliza la conexión TCP/TLS entre llamadas
+# (perform_pulse hace dos seguidas). requests.Session no es segura entre hilos y
+# perform_action corre en los hilos del executor: cada uno crea la suya al primer uso.
+_HA_LOCAL = threading.local()
+
+
+def _ha_session():
+    s = getattr(_HA_LOCAL, 'session', None)
+    if s is None:
+        s = requests.Session()
+        s.headers.update(_HA_HEADERS)
+        _HA_LOCAL.session = s
+    return s
+
+
+def _ha_call_service(svc: str, device_id: str) -> int:
+    """POST /api/services/switch/<svc>; devuelve el status HTTP."""
+    url = f"{HA_URL}/api/services/switch/{svc}"
+    if requests is not None:
+        return _ha_session().post(url, json={'entity_id': device_id}, timeout=10).status_code
+    import urllib.request, json
+    req = urllib.request.Request(url, data=json.dumps({'entity_id': device_id}).encode('utf8'), headers=_HA_HEADERS)
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return resp.getcode()
+
 
 def perform_action(device_id: str, action: str) -> (bool, str):
     """
@@ -21,24 +58,20 @@ def perform_action(device_id: str, action: str) -> (bool, str):
     Retorna (success: bool, message: str).
     """
     action = action.lower()
-    if action not in ('encender', 'apagar', 'on', 'off'):
+    if action not in _VALID_ACTIONS:
         return False, f"acción desconocida {action}"
+    turn_on = action in _ON_ACTIONS
 
     if not TUYA_ENABLED:
         # if device_id looks like a Home Assistant entity (contains a dot)
         # and HA_TOKEN is available, call HA service instead of emulating
         if device_id and '.' in device_id and HA_URL and HA_TOKEN:
-            svc = 'turn_on' if action in ('encender', 'on') else 'turn_off'
+            svc = 'turn_on' if turn_on else 'turn_off'
             try:
-                import urllib.request, json
-                url = f"{HA_URL}/api/services/switch/{svc}"
-                req = urllib.request.Request(url, data=json.dumps({'entity_id': device_id}).encode('utf8'),
-                                             headers={'Authorization': f'Bearer {HA_TOKEN}', 'Content-Type': 'application/json'})
                 print(f"tuya_client: calling HA service {svc} for entity {device_id}")
-                with urllib.request.urlopen(req, timeout=10) as resp:
-                    code = resp.getcode()
-                    print(f"tuya_client: HA service response code={code}")
-                    return (200 <= code < 300), f'called HA service {svc} status={code}'
+                code = _ha_call_service(svc, device_id)
+                print(f"tuya_client: HA service response code={code}")
+                return (200 <= code < 300), f'called HA service {svc} status={code}'
             except Exception as e:
                 print(f"tuya_client: HA call error: {e}")
                 return False, f'ha call error: {e}'
@@ -49,17 +82,17 @@ def perform_action(device_id: str, action: str) -> (bool, str):
     except Exception as e:
         return False, f'tinytuya import error: {e}'
 
-    # prefer device-specific env vars if provided
-    token = os.environ.get('TUYA_TOKEN') or TUYA_TOKEN
-    device_ip = os.environ.get('TUYA_DEVICE_IP') or TUYA_DEVICE_IP
-    device_id = os.environ.get('TUYA_DEVICE_ID') or TUYA_DEVICE_ID or device_id
+    # prefer device-specific env vars if provided (leídas una vez al importar)
+    token = TUYA_TOKEN
+    device_ip = TUYA_DEVICE_IP
+    device_id = TUYA_DEVICE_ID or device_id
 
     if not all((token, device_ip, device_id)):
         return False, 'missing TUYA_TOKEN/TUYA_DEVICE_ID/TUYA_DEVICE_IP'
 
     try:
         d = tinytuya.BulbDevice(device_id, device_ip, token)
-        if action in ('encender', 'on'):
+        if turn_on:
             d.turn_on()
         else:
             d.turn_off()
@@ -68,24 +101,37 @@ def perform_action(device_id: str, action: str) -> (bool, str):
         return False, f'tinytuya call error: {e}'
 
 
+def _pulse_result(device_id: str, on: tuple, off: tuple) -> (bool, str):
+    ok_on, msg_on = on
+    ok_off, msg_off = off
+    success = ok_on and ok_off
+    msg = f'on: {msg_on}; off: {msg_off}'
+    print(f"tuya_client.perform_pulse: device={device_id} result success={success} msg={msg}")
+    return success, msg
+
+
 def perform_pulse(device_id: str, duration_ms: int = 500) -> (bool, str):
     """Enciende el dispositivo, espera duration_ms milisegundos y lo apaga.
     Retorna (success, message) donde success es True si ambos comandos (on y off)
     fueron exitosos (o emulados) y message contiene info.
+    Bloquea el hilo durante la espera; desde asyncio usar perform_pulse_async.
     """
     # encender
     print(f"tuya_client.perform_pulse: device={device_id} duration_ms={duration_ms} - starting pulse")
-    ok_on, msg_on = perform_action(device_id, 'encender')
+    on = perform_action(device_id, 'encender')
     # esperar
-    try:
-        import time
-        time.sleep(max(0, duration_ms) / 1000.0)
-    except Exception:
-        pass
+    time.sleep(max(0, duration_ms) / 1000.0)
     # apagar
-    ok_off, msg_off = perform_action(device_id, 'apagar')
+    off = perform_action(device_id, 'apagar')
+    return _pulse_result(device_id, on, off)
 
-    success = ok_on and ok_off
-    msg = f'on: {msg_on}; off: {msg_off}'
-    print(f"tuya_client.perform_pulse: device={device_id} result success={success} msg={msg}")
-    return success, msg
+
+async def perform_pulse_async(device_id: str, duration_ms: int = 500, executor=None) -> (bool, str):
+    """Como perform_pulse, pero la espera es asyncio.sleep: solo las llamadas on/off
+    ocupan un hilo de `executor`, así muchos pulsos simultáneos no se serializan."""
+    loop = asyncio.get_running_loop()
+    print(f"tuya_client.perform_pulse: device={device_id} duration_ms={duration_ms} - starting pulse")
+    on = await loop.run_in_executor(executor, perform_action, device_id, 'encender')
+    await asyncio.sleep(max(0, duration_ms) / 1000.0)
+    off = await loop.run_in_executor(executor, perform_action, device_id, 'apagar')
+    return _pulse_result(device_id, on, off)
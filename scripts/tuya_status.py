@@ -4,6 +4,20 @@ import asyncio
 import aiohttp
 import websockets
 
+try:
+    import orjson
+except ImportError:  # opcional: parseo más rápido de /api/states y de los eventos WS
+    orjson = None
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()  # websockets envía str como frame de texto
+else:
+    _loads = json.loads
+    _dumps = json.dumps
+
 # ----------------------------
 # Config
 # ----------------------------
@@ -19,16 +33,16 @@ async def rest_get_states():
     async with aiohttp.ClientSession() as session:
         async with session.get(f"{HA_URL}/api/states", headers=headers) as resp:
             resp.raise_for_status()
-            return await resp.json()
+            return _loads(await resp.read())
 
 async def rest_call_service(domain: str, service: str, data: dict):
     """Ej: rest_call_service('switch', 'turn_on', {'entity_id': 'switch.tuya_plug_1'})"""
     headers = {"Authorization": f"Bearer {HA_TOKEN}", "Content-Type": "application/json"}
     url = f"{HA_URL}/api/services/{domain}/{service}"
     async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, data=json.dumps(data)) as resp:
+        async with session.post(url, headers=headers, data=_dumps(data)) as resp:
             resp.raise_for_status()
-            return await resp.json()
+            return _loads(await resp.read())
 
 # ----------------------------
 # WebSocket helpers (tiempo real)
@@ -39,28 +53,47 @@ class HAWebSocketClient:
         self.token = token
         self._msg_id = 1
         self.ws = None
+        self._subscribe_id = None  # id del subscribe_events enviado sin esperar el ack
+        # despacho por 'type' del mensaje; None = ignorar
+        self._handlers = {"event": self._on_event, "result": self._on_result, "pong": None}
 
     def _next_id(self) -> int:
         self._msg_id += 1
         return self._msg_id
 
-    async def connect(self):
-        self.ws = await websockets.connect(self.ws_url, ping_interval=5, ping_timeout=20)
+    async def connect(self, subscribe: bool = False):
+        """Conecta y autentica. Con subscribe=True envía subscribe_events(state_changed)
+        a continuación sin esperar el ack: HA lo responde en orden y listen_forever lo valida."""
+        self.ws = await websockets.connect(self.ws_url, ping_interval=5, ping_timeout=20, compression=None)
         # handshake
-        hello = json.loads(await self.ws.recv())  # 'auth_required'
+        hello = _loads(await self.ws.recv())  # 'auth_required'
         if hello.get("type") != "auth_required":
             raise RuntimeError(f"WS inesperado: {hello}")
-        await self.ws.send(json.dumps({"type": "auth", "access_token": self.token}))
-        auth_ok = json.loads(await self.ws.recv())
+        await self.ws.send(_dumps({"type": "auth", "access_token": self.token}))
+        auth_ok = _loads(await self.ws.recv())
         if auth_ok.get("type") != "auth_ok":
             raise RuntimeError(f"Auth WS falló: {auth_ok}")
         print("✅ WebSocket autenticado.")
+        if subscribe:
+            self._subscribe_id = self._next_id()
+            await self.ws.send(_dumps({"id": self._subscribe_id, "type": "subscribe_events", "event_type": "state_changed"}))
+
+    async def _await_result(self, msg_id: int) -> dict:
+        """Lee hasta el `result` con id msg_id. Lo que llegue antes (el ack del subscribe
+        enviado por connect, eventos) pasa por los handlers de siempre."""
+        while True:
+            evt = _loads(await self.ws.recv())
+            if evt.get("type") == "result" and evt.get("id") == msg_id:
+                return evt
+            handler = self._handlers.get(evt.get("type"))
+            if handler is not None:
+                handler(evt)
 
     async def subscribe_state_changed(self):
         msg = {"id": self._next_id(), "type": "subscribe_events", "event_type": "state_changed"}
-        await self.ws.send(json.dumps(msg))
-        ack = json.loads(await self.ws.recv())
-        if ack.get("type") != "result" or not ack.get("success"):
+        await self.ws.send(_dumps(msg))
+        ack = await self._await_result(msg["id"])
+        if not ack.get("success"):
             raise RuntimeError(f"No se pudo suscribir: {ack}")
         print("🔔 Suscrito a eventos state_changed.")
 
@@ -72,21 +105,43 @@ class HAWebSocketClient:
             "service": service,
             "service_data": service_data,
         }
-        await self.ws.send(json.dumps(msg))
-        resp = json.loads(await self.ws.recv())
-        if resp.get("type") != "result" or not resp.get("success"):
+        await self.ws.send(_dumps(msg))
+        resp = await self._await_result(msg["id"])
+        if not resp.get("success"):
             raise RuntimeError(f"call_service falló: {resp}")
         return resp
 
+    def _on_event(self, evt: dict):
+        event = evt.get("event") or {}
+        if event.get("event_type") != "state_changed":
+            return
+        data = event["data"]
+        new_state = data["new_state"]
+        state = new_state.get("state") if new_state else None
+        print(f"🛰  {data['entity_id']} → {state}")
+
+    def _on_result(self, evt: dict):
+        if self._subscribe_id is not None and evt.get("id") == self._subscribe_id:
+            self._subscribe_id = None
+            if not evt.get("success"):
+                raise RuntimeError(f"No se pudo suscribir: {evt}")
+            print("🔔 Suscrito a eventos state_changed.")
+            return
+        if not evt.get("success"):
+            print(f"⚠️  resultado con error (id={evt.get('id')}): {evt.get('error')}")
+
     async def listen_forever(self):
         try:
             async for raw in self.ws:
-                evt = json.loads(raw)
-                if evt.get("type") == "event" and evt.get("event", {}).get("event_type") == "state_changed":
-                    entity_id = evt["event"]["data"]["entity_id"]
-                    new_state = evt["event"]["data"]["new_state"]
-                    state = new_state.get("state") if new_state else None
-                    print(f"🛰  {entity_id} → {state}")
+                # pre-filtro barato: solo se parsean eventos state_changed y resultados
+                if isinstance(raw, bytes):
+                    raw = raw.decode()
+                if "state_changed" not in raw and "result" not in raw:
+                    continue
+                evt = _loads(raw)
+                handler = self._handlers.get(evt.get("type"))
+                if handler is not None:
+                    handler(evt)
         except websockets.ConnectionClosed:
             print("WS cerrado.")
 
@@ -114,10 +169,11 @@ async def main():
 
     # 3) WS: conectar, suscribirse y (opcional) llamar servicios en tiempo real
     client = HAWebSocketClient(HA_WS, HA_TOKEN)
-    await client.connect()
-    await client.subscribe_state_changed()
+    await client.connect(subscribe=True)
 
-    # Ejemplo: alternar un switch Tuya local (ajusta el entity_id a uno real tuyo)
+    # Ejemplo: alternar un switch Tuya local (ajusta el entity_id a uno real tuyo).
+    # call_service espera la respuesta con su propio id: el ack del subscribe pendiente
+    # se procesa por el camino y no se confunde con ella.
     # await client.call_service("switch", "toggle", {"entity_id": "switch.tuya_plug_1"})
     print("Escuchando cambios de estado (Ctrl+C para salir)…")
     await client.listen_forever()
@@ -9,45 +9,80 @@
 """
 import os
 import re
+import hashlib
 import json
 import time
 import asyncio
-from typing import Set
+import functools
+import inspect
+from typing import Dict
 
 from aiohttp import web
 import websockets
 
+try:
+    import orjson
+except ImportError:  # opcional: (de)serialización más rápida en broadcast, HA y data.json
+    orjson = None
+
+
+def _dumps_bytes(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # claves no str u objetos no nativos
+    return json.dumps(obj, ensure_ascii=False).encode('utf8')
+
+
+def _dumps(obj) -> str:
+    return _dumps_bytes(obj).decode()
+
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+try:
+    from watchfiles import awatch
+except ImportError:  # opcional: sin watchfiles, watch_data_file sondea cada 5 s
+    awatch = None
+
 # --------- Imports con fallbacks ---------
 try:
     from .models_loader import (
         get_models, get_breaker, toggle_breaker, set_breaker_state,
-        get_tarjeta_for_breaker, update_breaker_fields,
-        set_tarjeta_saldo, adjust_tarjeta_saldo
+        get_tarjeta_for_breaker, get_breakers_for_tarjeta, update_breaker_fields,
+        set_tarjeta_saldo, adjust_tarjeta_saldo, flush_pending,
+        load_data, save_data, save_data_deferred, data_version, data_lock
     )
 except Exception:
     try:
         from scripts.models_loader import (
             get_models, get_breaker, toggle_breaker, set_breaker_state,
-            get_tarjeta_for_breaker, update_breaker_fields,
-            set_tarjeta_saldo, adjust_tarjeta_saldo
+            get_tarjeta_for_breaker, get_breakers_for_tarjeta, update_breaker_fields,
+            set_tarjeta_saldo, adjust_tarjeta_saldo, flush_pending,
+            load_data, save_data, save_data_deferred, data_version, data_lock
         )
     except Exception:
         from models_loader import (
             get_models, get_breaker, toggle_breaker, set_breaker_state,
-            get_tarjeta_for_breaker, update_breaker_fields,
-            set_tarjeta_saldo, adjust_tarjeta_saldo
+            get_tarjeta_for_breaker, get_breakers_for_tarjeta, update_breaker_fields,
+            set_tarjeta_saldo, adjust_tarjeta_saldo, flush_pending,
+            load_data, save_data, save_data_deferred, data_version, data_lock
         )
 
 try:
-    from .breaker_service import set_breaker, toggle_breaker_service, pulse_breaker_service
+    from .breaker_service import set_breaker, set_breakers_bulk, toggle_breaker_service, pulse_breaker_service, get_ha_session
 except Exception:
     try:
-        from breaker_service import set_breaker, toggle_breaker_service, pulse_breaker_service
+        from breaker_service import set_breaker, set_breakers_bulk, toggle_breaker_service, pulse_breaker_service, get_ha_session
     except Exception:
+        get_ha_session = None
         async def toggle_breaker_service(*args, **kwargs):
             return {'ok': False, 'error': 'breaker_service unavailable'}
         async def set_breaker(*args, **kwargs):
             return {'ok': False, 'error': 'breaker_service unavailable'}
+        async def set_breakers_bulk(*args, **kwargs):
+            return {'ok': False, 'error': 'breaker_service unavailable'}
         async def pulse_breaker_service(*args, **kwargs):
             return {'ok': False, 'error': 'breaker_service unavailable'}
 
@@ -67,34 +102,95 @@ DATA_PATH = os.path.join(BASE_DIR, 'data.json')
 USAGE_LIMITS_PATH = os.path.join(BASE_DIR, 'usage_limits.json')
 HA_URL = CFG_HA_URL
 HA_TOKEN = CFG_HA_TOKEN
+# consultas simultáneas a HA al refrescar un breaker
+REFRESH_CONCURRENCY = 32
+# tope del backoff de reconexión del listener WS de HA (empieza en 1 s)
+HA_RECONNECT_MAX_SECONDS = 60
+# mensajes en cola por cliente WS antes de desconectarlo por lento
+WS_SEND_QUEUE = 64
+# segundos máximos por envío WS antes de desconectar al cliente
+WS_SEND_TIMEOUT = 5.0
 HA_WS = os.getenv('HA_WS') or (HA_URL.replace('http', 'ws') + '/api/websocket')
 
 # --------- Estado y utilidades ---------
 class ServerState:
     def __init__(self):
-        self.websockets: Set[web.WebSocketResponse] = set()
+        # socket -> cola de frames pendientes; una tarea escritora por socket la vacía
+        self.websockets: Dict[web.WebSocketResponse, asyncio.Queue] = {}
+        # cierres de clientes desbordados en curso (el loop solo guarda referencias débiles)
+        self._close_tasks: set = set()
+
+    def add(self, ws: web.WebSocketResponse) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=WS_SEND_QUEUE)
+        self.websockets[ws] = queue
+        return queue
+
+    def discard(self, ws: web.WebSocketResponse) -> None:
+        self.websockets.pop(ws, None)
+
+    def publish(self, message: dict) -> None:
+        """Encola el mensaje para todos los clientes sin bloquear (ni crear tareas)."""
+        if not self.websockets:
+            return
+        # UTF-8 una sola vez; cada socket solo antepone la cabecera del frame
+        self.publish_bytes(_dumps_bytes(message))
+
+    def publish_bytes(self, payload: bytes) -> None:
+        """Como publish, con el mensaje ya serializado."""
+        # encolar no bloquea: un cliente lento solo llena su propia cola y, si se
+        # desborda, se lo desconecta en vez de frenar al resto
+        for ws, queue in tuple(self.websockets.items()):
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                self.discard(ws)
+                task = asyncio.create_task(ws.close())
+                self._close_tasks.add(task)
+                task.add_done_callback(self._close_done)
+
+    def _close_done(self, task: asyncio.Task) -> None:
+        self._close_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print('ws close error', task.exception())
+
+    def publish_batch(self, events: list) -> None:
+        """Varios eventos de una misma acción en un único frame {'type': 'batch', 'events': [...]}."""
+        if not self.websockets or not events:
+            return
+        self.publish(events[0] if len(events) == 1 else {'type': 'batch', 'events': events})
 
     async def broadcast(self, message: dict):
-        txt = json.dumps(message, ensure_ascii=False)
-        stale = []
-        for ws in list(self.websockets):
-            try:
-                await ws.send_str(txt)
-            except Exception:
-                stale.append(ws)
-        for ws in stale:
-            self.websockets.discard(ws)
+        # versión awaitable (consumption_manager y los avisos de estado de HA)
+        self.publish(message)
+
+
+async def _ws_writer(ws: web.WebSocketResponse, queue: asyncio.Queue):
+    try:
+        while True:
+            payload = await queue.get()
+            # un envío que no drena en WS_SEND_TIMEOUT es un cliente colgado
+            await asyncio.wait_for(ws.send_bytes(payload), WS_SEND_TIMEOUT)
+    except Exception:
+        state.discard(ws)
+        await ws.close()  # termina el async for del handler
 
 
 state = ServerState()
 
 
+# data.json vive en la caché de models_loader (un solo dict por proceso, compartido con
+# el consumption manager). Aquí solo se guardan derivados de la versión vigente: índices
+# y JSON serializado, que caducan cuando data_version cambia.
+_MODELS_CACHE = {'data': None, 'version': None, 'index': None, 'json': None}
+
+
 def load_models():
     try:
-        with open(DATA_PATH, 'r', encoding='utf8') as f:
-            return json.load(f)
+        data = load_data(DATA_PATH)
     except Exception:
         return {"tarjetas": [], "breakers": [], "arduinos": []}
+    _MODELS_CACHE['data'] = data
+    return data
 
 
 def load_usage_limits():
@@ -128,27 +224,136 @@ def save_usage_limits(limits: dict):
         return False
 
 
+def _strip_breaker_saldo(models: dict) -> None:
+    # la fuente de verdad del saldo es `tarjetas`: no persistir copias en los breakers
+    try:
+        for bb in models.get('breakers', []):
+            bb.pop('saldo', None)
+            bb.pop('max_saldo', None)
+    except Exception:
+        pass
+
+
 def save_models(models: dict):
     """Persistir models en DATA_PATH atomically."""
     try:
-        # antes de persistir, eliminar campos de saldo en breakers para que
-        # la fuente de verdad del saldo siga siendo `tarjetas`.
-        try:
-            for bb in models.get('breakers', []):
-                bb.pop('saldo', None)
-                bb.pop('max_saldo', None)
-        except Exception:
-            pass
-        tmp = DATA_PATH + '.tmp'
-        with open(tmp, 'w', encoding='utf8') as f:
-            json.dump(models, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, DATA_PATH)
+        _strip_breaker_saldo(models)
+        save_data(DATA_PATH, models)
         return True
     except Exception as e:
         print('save_models error', e)
         return False
 
 
+_ENTITY_KEYS = ('entity_id', 'power_entity', 'energy_entity', 'voltage_entity', 'current_entity')
+
+# métrica -> (palabras clave en entity_id es/en, atributos HA de respaldo en orden)
+_METRIC_HINTS = (
+    ('power', ('potencia', 'power'), ('power', 'current_power_w', 'power_w')),
+    ('energy', ('energia', 'energy'), ('energy', 'today_energy_kwh', 'energy_kwh')),
+    ('voltage', ('tension', 'voltage'), ('voltage', 'voltage_v')),
+    ('current', ('corriente', 'current'), ('current', 'current_a')),
+)
+
+
+# states de HA sin valor: frecuentes y nunca numéricos
+_NO_VALUE_STATES = frozenset(('unknown', 'unavailable', ''))
+
+
+def _extract_numeric(val):
+    """Valor numérico de un state/atributo HA, o None si no es convertible."""
+    if val is None or isinstance(val, (int, float)):
+        return val
+    if isinstance(val, str):
+        if val in _NO_VALUE_STATES:
+            return None  # sin pasar por la excepción de float()
+        try:
+            return float(val)
+        except ValueError:
+            return None
+    try:
+        return float(str(val))
+    except (TypeError, ValueError):
+        return None
+
+
+def _build_models_index(models: dict) -> dict:
+    idx = {'breakers': {}, 'tarjetas': {}, 'arduinos': {}, 'by_tarjeta': {}, 'entity': {}}
+    for kind in ('breakers', 'tarjetas', 'arduinos'):
+        by_id = idx[kind]
+        for item in models.get(kind, []):
+            by_id.setdefault(item.get('id'), item)  # ids duplicados: gana el primero
+    by_tarjeta, entity = idx['by_tarjeta'], idx['entity']
+    for b in models.get('breakers', []):
+        if b.get('tarjeta'):
+            by_tarjeta.setdefault(b.get('tarjeta'), []).append(b)
+        ids = {b.get(k) for k in _ENTITY_KEYS if isinstance(b.get(k), str)}
+        extra = b.get('entities') or []
+        if isinstance(extra, list):
+            ids.update(e for e in extra if isinstance(e, str))
+        for eid in ids:
+            entity.setdefault(eid, []).append(b)
+    return idx
+
+
+def _cached_derived(models: dict):
+    """Entrada de _MODELS_CACHE si models es el dict vigente, al día con data_version."""
+    if models is not _MODELS_CACHE['data']:
+        return None
+    version = data_version(DATA_PATH)
+    if _MODELS_CACHE['version'] != version:
+        _MODELS_CACHE['version'] = version
+        _MODELS_CACHE['index'] = _MODELS_CACHE['json'] = None
+    return _MODELS_CACHE
+
+
+def models_index(models: dict) -> dict:
+    """Índices por id (breakers/tarjetas/arduinos), breakers por tarjeta y por entidad HA.
+
+    Para el dict en caché se construyen una vez por carga/guardado de data.json.
+    """
+    cache = _cached_derived(models)
+    if cache is None:
+        return _build_models_index(models)
+    if cache['index'] is None:
+        cache['index'] = _build_models_index(models)
+    return cache['index']
+
+
+def models_json(models: dict) -> bytes:
+    """models serializado; para el dict en caché se serializa una vez por versión."""
+    cache = _cached_derived(models)
+    if cache is None:
+        return _dumps_bytes(models)
+    if cache['json'] is None:
+        cache['json'] = _dumps_bytes(models)
+    return cache['json']
+
+
+def _known_entities():
+    """entity_id -> breakers según los modelos en caché, o None si aún no hay caché."""
+    models = _MODELS_CACHE['data']
+    if models is None:
+        return None
+    return models_index(models)['entity']
+
+
+def _models_message(models: dict) -> bytes:
+    # {"type":"models","data":...} armado sobre los bytes en caché, sin re-serializar
+    return b'{"type":"models","data":' + models_json(models) + b'}'
+
+
+async def aload_models():
+    """load_models fuera del event loop (lectura/parseo en un hilo si el archivo cambió)."""
+    return await asyncio.to_thread(load_models)
+
+
+def _mark_dirty(models: dict) -> None:
+    """Agenda el guardado de models con el write-behind de models_loader (agrupa ráfagas)."""
+    _strip_breaker_saldo(models)
+    save_data_deferred(DATA_PATH, models)
+
+
 def init_models_startup():
     """Cargar y registrar un resumen de data.json al iniciar la app.
     Crea el archivo si no existe."""
@@ -161,67 +366,126 @@ def init_models_startup():
     return models
 
 
-async def watch_data_file(app):
-    # snapshot previo para diffs de tarjetas
-    prev = None
-    try:
-        prev = load_models()
-    except Exception:
-        prev = None
+async def _data_file_changes(app):
+    """Genera los modelos recargados cada vez que cambia data.json.
+
+    Con watchfiles espera eventos del kernel (inotify/FSEvents) sobre el directorio:
+    data.json se reemplaza con os.replace, así que vigilar el archivo perdería el inodo.
+    Sin watchfiles sondea cada 5 s.
+    """
+    if awatch is not None:
+        target = os.path.abspath(DATA_PATH)
+        async for _ in awatch(os.path.dirname(target), stop_event=app['stop_ev'], recursive=False,
+                              debounce=200, watch_filter=lambda _change, p: os.path.abspath(p) == target):
+            try:
+                yield await aload_models()
+            except Exception:
+                continue
+        return
     while True:
         await asyncio.sleep(5)  # Reducido a 5 segundos para menos carga
         # cargar siempre: en Windows la resolución de mtime puede ser gruesa y perder cambios rápidos
         try:
-            models = load_models()
+            yield await aload_models()
         except Exception:
             continue
+
+
+async def watch_data_file(app):
+    # snapshot previo de saldos para diffs de tarjetas (valores, no el dict: load_models
+    # devuelve el mismo objeto en caché y los handlers lo modifican in situ)
+    def _saldos(models):
+        out = {}
+        for t in models.get('tarjetas', []):
+            try:
+                out[t.get('id')] = float(t.get('saldo') or 0.0)
+            except Exception:
+                pass
+        return out
+
+    try:
+        prev = _saldos(await aload_models())
+    except Exception:
+        prev = {}
+    async for models in _data_file_changes(app):
         # diffs de tarjetas (saldo) - solo broadcast si hay cambios
+        has_changes = False
         try:
-            prev_t = {t.get('id'): t for t in (prev.get('tarjetas', []) if prev else [])}
-            cur_t = {t.get('id'): t for t in models.get('tarjetas', [])}
-            has_changes = False
-            for tid, cur in cur_t.items():
-                pv = prev_t.get(tid)
-                if pv is None:
-                    continue
-                try:
-                    if float(cur.get('saldo') or 0.0) != float(pv.get('saldo') or 0.0):
-                        asyncio.create_task(state.broadcast({'type': 'tarjetas:update', 'id': tid, 'tarjeta': cur}))
-                        has_changes = True
-                except Exception:
-                    pass
-            prev = models
+            cur = _saldos(models)
+            for t in models.get('tarjetas', []):
+                tid = t.get('id')
+                if tid in prev and tid in cur and cur[tid] != prev[tid]:
+                    state.publish({'type': 'tarjetas:update', 'id': tid, 'tarjeta': t})
+                    has_changes = True
+            prev = cur
         except Exception:
-            prev = models
+            pass
         # broadcast completo del modelo SOLO si hay clientes conectados y no se envió tarjetas:update
         if state.websockets and not has_changes:
-            await state.broadcast({'type': 'models', 'data': models})
+            state.publish_bytes(_models_message(models))
+
+
+STATIC_PAGES = ('index.html', 'display.html')
+
+
+def _load_static_pages() -> dict:
+    """Lee las páginas de static/ una vez: nombre -> (bytes, ETag)."""
+    pages = {}
+    for name in STATIC_PAGES:
+        with open(os.path.join(BASE_DIR, 'static', name), 'rb') as f:
+            body = f.read()
+        pages[name] = (body, '"%s"' % hashlib.blake2b(body, digest_size=8).hexdigest())
+    return pages
+
+
+def _static_page(request, name: str):
+    body, etag = request.app['pages'][name]
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=60'}
+    if etag in request.headers.get('If-None-Match', ''):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='text/html', charset='utf-8', headers=headers)
+
+
+_FORM_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+
+async def _read_body(request) -> dict:
+    """Cuerpo del POST como dict: formulario según Content-Type, si no JSON (con
+    respaldo a formulario para clientes que no envían la cabecera)."""
+    if request.content_type in _FORM_TYPES:
+        return dict(await request.post())
+    try:
+        return await request.json(loads=_loads)
+    except Exception:
+        return dict(await request.post())
 
 
 async def index(request):
-    return web.FileResponse(os.path.join(BASE_DIR, 'static', 'index.html'))
+    return _static_page(request, 'index.html')
 
 
 async def display(request):
-    return web.FileResponse(os.path.join(BASE_DIR, 'static', 'display.html'))
+    return _static_page(request, 'display.html')
 
 
 async def models_handler(request):
-    models = load_models()
-    return web.json_response(models)
+    models = await aload_models()
+    return web.Response(body=models_json(models), content_type='application/json')
 
 
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
-    state.websockets.add(ws)
-    await ws.send_str(json.dumps({'type': 'models', 'data': load_models()}, ensure_ascii=False))
-    await ws.send_str(json.dumps({'type': 'info', 'msg': 'cliente conectado'}, ensure_ascii=False))
+    queue = state.add(ws)
+    writer = asyncio.create_task(_ws_writer(ws, queue))
     try:
+        await queue.put(_models_message(await aload_models()))
+        await queue.put(_dumps_bytes({'type': 'info', 'msg': 'cliente conectado'}))
         async for _ in ws:
             pass
     finally:
-        state.websockets.discard(ws)
+        state.discard(ws)
+        writer.cancel()
     return ws
 
 
@@ -231,290 +495,294 @@ async def rfid_post(request):
         key = request.headers.get('X-API-KEY')
         if not key or key != API_KEY:
             return web.json_response({'ok': False, 'error': 'invalid api key'}, status=401)
-    try:
-        data = await request.json()
-    except Exception:
-        data = await request.post()
-        data = dict(data)
+    data = await _read_body(request)
 
     # aceptar diferentes nombres desde distintos arduinos/firmwares
     uid = data.get('uid') or data.get('rfid') or data.get('nfc') or data.get('card') or data.get('tag')
     origen = data.get('origen') or data.get('arduino') or data.get('arduino_id') or data.get('id')
 
     # log completo
-    print('RFID received:', json.dumps(data, ensure_ascii=False))
+    print('RFID received:', _dumps(data))
 
     # guardar ultimo dato en el arduino si existe
     matched = None
     if origen:
         try:
-            models = load_models()
-            arduinos = models.get('arduinos', [])
-            for ad in arduinos:
-                if ad.get('id') == origen:
-                    matched = ad
-                    break
-            if matched is None:
-                for ad in arduinos:
-                    if ad.get('id') == data.get('arduino'):
-                        matched = ad
-                        break
-            if matched is not None:
-                if bool(matched.get('es_estacion_carga')):
-                    # Estación de carga: actualizar 'charging' (lista de sesiones) y 'last'
-                    now_ms = int(time.time() * 1000)
-                    payload = dict(data)
-                    payload.setdefault('ts', now_ms)
-                    matched['last'] = payload
-                    uid_seen = payload.get('uid') or payload.get('rfid') or payload.get('nfc')
-                    # inicializar lista de sesiones si no existe
-                    charging = matched.get('charging')
-                    if not isinstance(charging, list):
-                        charging = []
-                        matched['charging'] = charging
-                    if uid_seen:
-                        # Buscar la tarjeta correspondiente
-                        tarjetas = models.get('tarjetas', [])
-                        tarjeta = next((t for t in tarjetas if t.get('id') == uid_seen), None)
+            await aload_models()  # recarga/parseo en un hilo si data.json cambió
+            # leer-modificar-_mark_dirty bajo el lock de models_loader: el timer del
+            # write-behind serializa este mismo dict desde su hilo
+            with data_lock():
+                models = load_models()
+                idx = models_index(models)
+                arduinos = models.get('arduinos', [])
+                matched = idx['arduinos'].get(origen)
+                if matched is None:
+                    matched = idx['arduinos'].get(data.get('arduino'))
+                if matched is not None:
+                    if bool(matched.get('es_estacion_carga')):
+                        # Estación de carga: actualizar 'charging' (lista de sesiones) y 'last'
+                        now_ms = int(time.time() * 1000)
+                        payload = dict(data)
+                        payload.setdefault('ts', now_ms)
+                        matched['last'] = payload
+                        uid_seen = payload.get('uid') or payload.get('rfid') or payload.get('nfc')
+                        # inicializar lista de sesiones si no existe
+                        charging = matched.get('charging')
+                        if not isinstance(charging, list):
+                            charging = []
+                            matched['charging'] = charging
+                        if uid_seen:
+                            # Buscar la tarjeta correspondiente
+                            tarjeta = idx['tarjetas'].get(uid_seen)
                         
-                        # Si la tarjeta estaba en otra estación de carga, liquidar carga y transferir a saldo
-                        for other_arduino in arduinos:
-                            if other_arduino.get('id') == origen:
-                                continue  # skip current arduino
-                            if not bool(other_arduino.get('es_estacion_carga')):
-                                continue
-                            other_charging = other_arduino.get('charging') if isinstance(other_arduino.get('charging'), list) else []
-                            for other_sess in other_charging[:]:
-                                if other_sess.get('uid') == uid_seen:
-                                    # Calcular carga actual y sumar directo al saldo
-                                    try:
-                                        wps = float(other_sess.get('wps') or other_arduino.get('w_por_segundo') or 0.0)
-                                        started = int(other_sess.get('started_ms') or now_ms)
-                                        elapsed_ms = max(0, now_ms - started)
-                                        carga_actual = wps * (elapsed_ms / 1000.0)
+                            # Si la tarjeta estaba en otra estación de carga, liquidar carga y transferir a saldo
+                            for other_arduino in arduinos:
+                                if other_arduino.get('id') == origen:
+                                    continue  # skip current arduino
+                                if not bool(other_arduino.get('es_estacion_carga')):
+                                    continue
+                                other_charging = other_arduino.get('charging') if isinstance(other_arduino.get('charging'), list) else []
+                                for other_sess in other_charging[:]:
+                                    if other_sess.get('uid') == uid_seen:
+                                        # Calcular carga actual y sumar directo al saldo
+                                        try:
+                                            wps = float(other_sess.get('wps') or other_arduino.get('w_por_segundo') or 0.0)
+                                            started = int(other_sess.get('started_ms') or now_ms)
+                                            elapsed_ms = max(0, now_ms - started)
+                                            carga_actual = wps * (elapsed_ms / 1000.0)
                                         
-                                        if tarjeta:
-                                            current_saldo = float(tarjeta.get('saldo') or 0.0)
-                                            nuevo_saldo = current_saldo + carga_actual
+                                            if tarjeta:
+                                                current_saldo = float(tarjeta.get('saldo') or 0.0)
+                                                nuevo_saldo = current_saldo + carga_actual
                                             
-                                            # Aplicar límite máximo
-                                            limits = load_usage_limits()
-                                            max_carga = float(limits.get('max_carga_por_tarjeta') or 2000)
-                                            if nuevo_saldo > max_carga:
-                                                tarjeta['saldo'] = float(max_carga)
-                                                print(f'[Transferencia] Saldo de {uid_seen} reseteado a {max_carga} W (pasó el límite)')
-                                            else:
-                                                tarjeta['saldo'] = round(nuevo_saldo, 6)
-                                    except Exception as e:
-                                        print(f'Error transferring charge: {e}')
-                                    # Remover sesión de la otra estación
-                                    other_charging.remove(other_sess)
-                            other_arduino['charging'] = other_charging
+                                                # Aplicar límite máximo
+                                                limits = load_usage_limits()
+                                                max_carga = float(limits.get('max_carga_por_tarjeta') or 2000)
+                                                if nuevo_saldo > max_carga:
+                                                    tarjeta['saldo'] = float(max_carga)
+                                                    print(f'[Transferencia] Saldo de {uid_seen} reseteado a {max_carga} W (pasó el límite)')
+                                                else:
+                                                    tarjeta['saldo'] = round(nuevo_saldo, 6)
+                                        except Exception as e:
+                                            print(f'Error transferring charge: {e}')
+                                        # Remover sesión de la otra estación
+                                        other_charging.remove(other_sess)
+                                other_arduino['charging'] = other_charging
                         
-                        # buscar sesión existente por UID en la estación actual
-                        sess = None
-                        for s in charging:
-                            if s.get('uid') == uid_seen:
-                                sess = s
-                                break
-                        if sess is None:
-                            # crear nueva sesión
-                            try:
-                                wps = float(matched.get('w_por_segundo') or 0.0)
-                            except Exception:
-                                wps = 0.0
-                            sess = {
-                                'uid': uid_seen,
-                                'started_ms': int(payload.get('ts') or payload.get('timestamp') or now_ms),
-                                'wps': wps,
-                                'last': payload,
-                            }
-                            charging.append(sess)
+                            # buscar sesión existente por UID en la estación actual
+                            sess = None
+                            for s in charging:
+                                if s.get('uid') == uid_seen:
+                                    sess = s
+                                    break
+                            if sess is None:
+                                # crear nueva sesión
+                                try:
+                                    wps = float(matched.get('w_por_segundo') or 0.0)
+                                except Exception:
+                                    wps = 0.0
+                                sess = {
+                                    'uid': uid_seen,
+                                    'started_ms': int(payload.get('ts') or payload.get('timestamp') or now_ms),
+                                    'wps': wps,
+                                    'last': payload,
+                                }
+                                charging.append(sess)
                             
-                            # Apagar el breaker asociado al empezar a cargar
-                            if tarjeta:
-                                breakers = models.get('breakers', [])
-                                for b in breakers:
-                                    if b.get('tarjeta') == uid_seen and b.get('estado'):
+                                # Apagar los breakers asociados al empezar a cargar (una sola llamada)
+                                if tarjeta:
+                                    off_ids = [b.get('id') for b in idx['by_tarjeta'].get(uid_seen, ()) if b.get('estado')]
+                                    if off_ids:
                                         try:
-                                            # Apagar breaker físicamente
-                                            asyncio.create_task(set_breaker(DATA_PATH, b.get('id'), False))
-                                            print(f"[Carga iniciada] Apagando breaker {b.get('id')} de tarjeta {uid_seen}")
+                                            asyncio.create_task(set_breakers_bulk(DATA_PATH, off_ids, False))
+                                            print(f"[Carga iniciada] Apagando breakers {off_ids} de tarjeta {uid_seen}")
                                         except Exception as e:
                                             print(f'Error apagando breaker al cargar: {e}')
-                        else:
-                            # actualizar última lectura, no pisar started_ms si ya existe
-                            sess['last'] = payload
-                            if not sess.get('started_ms'):
-                                sess['started_ms'] = int(payload.get('ts') or payload.get('timestamp') or now_ms)
-                            if 'wps' not in sess or sess.get('wps') in (None, 0, 0.0):
-                                try:
-                                    sess['wps'] = float(matched.get('w_por_segundo') or 0.0)
-                                except Exception:
-                                    sess['wps'] = 0.0
+                            else:
+                                # actualizar última lectura, no pisar started_ms si ya existe
+                                sess['last'] = payload
+                                if not sess.get('started_ms'):
+                                    sess['started_ms'] = int(payload.get('ts') or payload.get('timestamp') or now_ms)
+                                if 'wps' not in sess or sess.get('wps') in (None, 0, 0.0):
+                                    try:
+                                        sess['wps'] = float(matched.get('w_por_segundo') or 0.0)
+                                    except Exception:
+                                        sess['wps'] = 0.0
                     
-                    if save_models(models):
-                        asyncio.create_task(state.broadcast({'type': 'arduinos:update', 'id': matched.get('id'), 'arduino': matched}))
+                        _mark_dirty(models)
+                        state.publish({'type': 'arduinos:update', 'id': matched.get('id'), 'arduino': matched})
                         if tarjeta:
-                            asyncio.create_task(state.broadcast({'type': 'tarjetas:update', 'id': uid_seen, 'tarjeta': tarjeta}))
-                else:
-                    # Lector normal: liquidar carga sumando directamente al saldo
-                    uid_seen = data.get('uid') or data.get('rfid') or data.get('nfc')
-                    if uid_seen:
-                        total_carga_actual = 0.0
-                        now_ms = int(time.time() * 1000)
+                            state.publish({'type': 'tarjetas:update', 'id': uid_seen, 'tarjeta': tarjeta})
+                    else:
+                        # Lector normal: liquidar carga sumando directamente al saldo
+                        uid_seen = data.get('uid') or data.get('rfid') or data.get('nfc')
+                        if uid_seen:
+                            total_carga_actual = 0.0
+                            now_ms = int(time.time() * 1000)
                         
-                        # Buscar la tarjeta
-                        tarjetas = models.get('tarjetas', [])
-                        tarjeta = next((t for t in tarjetas if t.get('id') == uid_seen), None)
+                            # Buscar la tarjeta
+                            tarjeta = idx['tarjetas'].get(uid_seen)
                         
-                        for ad in arduinos:
-                            try:
-                                if not bool(ad.get('es_estacion_carga')):
-                                    continue
-                                # Liquidar sesiones en lista 'charging' que coincidan con uid
-                                charging = ad.get('charging') if isinstance(ad.get('charging'), list) else []
-                                remaining = []
-                                for s in charging:
-                                    try:
-                                        if s.get('uid') != uid_seen:
-                                            remaining.append(s)
-                                            continue
-                                        wps = float(s.get('wps') if s.get('wps') is not None else (ad.get('w_por_segundo') or 0.0))
-                                        started = int(s.get('started_ms') or now_ms)
-                                        elapsed_ms = max(0, now_ms - started)
-                                        total_carga_actual += wps * (elapsed_ms / 1000.0)
-                                    except Exception:
-                                        # si hay problema, no sumar y descartar sesión para evitar loops
-                                        pass
-                                if remaining or ('charging' in ad):
-                                    ad['charging'] = remaining
-                                # fallback adicional por 'last' si no había sesión (retrocompatibilidad)
-                                if not charging:
-                                    last = ad.get('last') or {}
-                                    nfc = last.get('nfc') or last.get('uid') or last.get('rfid')
-                                    if nfc == uid_seen:
-                                        try:
-                                            ts = int(last.get('ts') or last.get('timestamp') or (now_ms - 1000))
-                                        except Exception:
-                                            ts = now_ms - 1000
-                                        elapsed_ms = max(0, now_ms - ts)
+                            for ad in arduinos:
+                                try:
+                                    if not bool(ad.get('es_estacion_carga')):
+                                        continue
+                                    # Liquidar sesiones en lista 'charging' que coincidan con uid
+                                    charging = ad.get('charging') if isinstance(ad.get('charging'), list) else []
+                                    remaining = []
+                                    for s in charging:
                                         try:
-                                            wps_fb = float(ad.get('w_por_segundo') or 0.0)
+                                            if s.get('uid') != uid_seen:
+                                                remaining.append(s)
+                                                continue
+                                            wps = float(s.get('wps') if s.get('wps') is not None else (ad.get('w_por_segundo') or 0.0))
+                                            started = int(s.get('started_ms') or now_ms)
+                                            elapsed_ms = max(0, now_ms - started)
+                                            total_carga_actual += wps * (elapsed_ms / 1000.0)
                                         except Exception:
-                                            wps_fb = 0.0
-                                        total_carga_actual += wps_fb * (elapsed_ms / 1000.0)
-                                        ad['last'] = None
-                            except Exception:
-                                continue
+                                            # si hay problema, no sumar y descartar sesión para evitar loops
+                                            pass
+                                    if remaining or ('charging' in ad):
+                                        ad['charging'] = remaining
+                                    # fallback adicional por 'last' si no había sesión (retrocompatibilidad)
+                                    if not charging:
+                                        last = ad.get('last') or {}
+                                        nfc = last.get('nfc') or last.get('uid') or last.get('rfid')
+                                        if nfc == uid_seen:
+                                            try:
+                                                ts = int(last.get('ts') or last.get('timestamp') or (now_ms - 1000))
+                                            except Exception:
+                                                ts = now_ms - 1000
+                                            elapsed_ms = max(0, now_ms - ts)
+                                            try:
+                                                wps_fb = float(ad.get('w_por_segundo') or 0.0)
+                                            except Exception:
+                                                wps_fb = 0.0
+                                            total_carga_actual += wps_fb * (elapsed_ms / 1000.0)
+                                            ad['last'] = None
+                                except Exception:
+                                    continue
                         
-                        # Sumar carga calculada directo al saldo (sin carga_acumulada)
-                        if tarjeta is not None:
-                            try:
-                                current_saldo = float(tarjeta.get('saldo') or 0.0)
+                            # Sumar carga calculada directo al saldo (sin carga_acumulada)
+                            if tarjeta is not None:
+                                try:
+                                    current_saldo = float(tarjeta.get('saldo') or 0.0)
                                 
-                                # Aplicar límite máximo de carga
-                                limits = load_usage_limits()
-                                max_carga = float(limits.get('max_carga_por_tarjeta') or 2000)
+                                    # Aplicar límite máximo de carga
+                                    limits = load_usage_limits()
+                                    max_carga = float(limits.get('max_carga_por_tarjeta') or 2000)
                                 
-                                # Si el saldo + carga pasa el límite, resetear a max_carga
-                                nuevo_saldo = current_saldo + total_carga_actual
-                                if nuevo_saldo > max_carga:
-                                    tarjeta['saldo'] = float(max_carga)
-                                    print(f'[Liquidación] Saldo de {uid_seen} reseteado a {max_carga} W (pasó el límite)')
-                                else:
-                                    tarjeta['saldo'] = round(nuevo_saldo, 6)
+                                    # Si el saldo + carga pasa el límite, resetear a max_carga
+                                    nuevo_saldo = current_saldo + total_carga_actual
+                                    if nuevo_saldo > max_carga:
+                                        tarjeta['saldo'] = float(max_carga)
+                                        print(f'[Liquidación] Saldo de {uid_seen} reseteado a {max_carga} W (pasó el límite)')
+                                    else:
+                                        tarjeta['saldo'] = round(nuevo_saldo, 6)
                                 
-                                print(f'[Liquidación] {uid_seen}: saldo previo={current_saldo:.2f} W, carga={total_carga_actual:.2f} W, nuevo saldo={tarjeta["saldo"]:.2f} W')
+                                    print(f'[Liquidación] {uid_seen}: saldo previo={current_saldo:.2f} W, carga={total_carga_actual:.2f} W, nuevo saldo={tarjeta["saldo"]:.2f} W')
                                 
-                                asyncio.create_task(state.broadcast({'type': 'tarjetas:update', 'id': uid_seen, 'tarjeta': tarjeta}))
+                                    state.publish({'type': 'tarjetas:update', 'id': uid_seen, 'tarjeta': tarjeta})
                                 
-                                # Encender el breaker asociado después de liquidar (si tiene saldo)
-                                if tarjeta['saldo'] > 0:
-                                    breakers = models.get('breakers', [])
-                                    for b in breakers:
-                                        if b.get('tarjeta') == uid_seen:
-                                            try:
-                                                asyncio.create_task(set_breaker(DATA_PATH, b.get('id'), True))
-                                                print(f"[Liquidación] Encendiendo breaker {b.get('id')} de tarjeta {uid_seen} (estado previo: {b.get('estado')})")
-                                            except Exception as e:
-                                                print(f'Error encendiendo breaker al liquidar: {e}')
-                            except Exception as e:
-                                print(f'Error converting charge to balance: {e}')
+                                    # Encender los breakers asociados después de liquidar (si tiene saldo)
+                                    on_ids = [b.get('id') for b in idx['by_tarjeta'].get(uid_seen, ())]
+                                    if tarjeta['saldo'] > 0 and on_ids:
+                                        try:
+                                            asyncio.create_task(set_breakers_bulk(DATA_PATH, on_ids, True))
+                                            print(f"[Liquidación] Encendiendo breakers {on_ids} de tarjeta {uid_seen}")
+                                        except Exception as e:
+                                            print(f'Error encendiendo breaker al liquidar: {e}')
+                                except Exception as e:
+                                    print(f'Error converting charge to balance: {e}')
                         
-                        if save_models(models):
+                            _mark_dirty(models)
                             for ad in arduinos:
                                 if bool(ad.get('es_estacion_carga')):
-                                    asyncio.create_task(state.broadcast({'type': 'arduinos:update', 'id': ad.get('id'), 'arduino': ad}))
-                    matched['last'] = data
-                    save_models(models)
+                                    state.publish({'type': 'arduinos:update', 'id': ad.get('id'), 'arduino': ad})
+                        matched['last'] = data
+                        _mark_dirty(models)
         except Exception as e:
             print('rfid_post save arduino error', e)
 
     # asociar lectura con tarjeta si se detectó uid (soporta campo 'nfc' enviado por Arduino)
     if uid:
         try:
-            models = load_models()
-            tarjetas = models.get('tarjetas', [])
-            tarjeta = next((t for t in tarjetas if t.get('id') == uid), None)
+            models = await aload_models()
+            idx = models_index(models)
+            tarjeta = idx['tarjetas'].get(uid)
             if tarjeta:
                 # notificar escaneo de tarjeta
-                asyncio.create_task(state.broadcast({'type': 'tarjetas:scanned', 'tarjeta': tarjeta, 'origen': origen, 'arduino_last': matched.get('last') if matched else None}))
+                state.publish({'type': 'tarjetas:scanned', 'tarjeta': tarjeta, 'origen': origen, 'arduino_last': matched.get('last') if matched else None})
                 # controlar breakers asociados: si la tarjeta tiene saldo > 0 encender, si no apagar
                 try:
-                    for b in models.get('breakers', []):
-                        if b.get('tarjeta') == tarjeta.get('id'):
-                            desired = float(tarjeta.get('saldo') or 0.0) > 0.0
-                            if bool(b.get('estado')) != desired:
-                                # set_breaker_state persistirá y realizará acciones externas
-                                try:
-                                    set_breaker_state(DATA_PATH, b.get('id'), desired)
-                                except Exception:
-                                    print('rfid_post: set_breaker_state error')
-                                asyncio.create_task(state.broadcast({'type': 'breakers:update', 'id': b.get('id'), 'state': 'on' if desired else 'off'}))
+                    for b in idx['by_tarjeta'].get(tarjeta.get('id'), ()):
+                        desired = float(tarjeta.get('saldo') or 0.0) > 0.0
+                        if bool(b.get('estado')) != desired:
+                            # set_breaker_state persistirá y realizará acciones externas
+                            try:
+                                set_breaker_state(DATA_PATH, b.get('id'), desired)
+                            except Exception:
+                                print('rfid_post: set_breaker_state error')
+                            state.publish({'type': 'breakers:update', 'id': b.get('id'), 'state': 'on' if desired else 'off'})
                 except Exception as e:
                     print('rfid_post set_breaker error', e)
         except Exception as e:
             print('rfid_post tarjeta association error', e)
 
-    asyncio.create_task(state.broadcast({'type': 'rfid', 'uid': uid, 'origen': origen, 'data': data}))
+    state.publish({'type': 'rfid', 'uid': uid, 'origen': origen, 'data': data})
 
     return web.json_response({'ok': True, 'received': data, 'uid': uid, 'origen': origen})
 
 
+def _poke_consumption(app) -> None:
+    """Despertar al consumption manager tras un cambio de estado o saldo (si está activo)."""
+    mgr = app.get('cons_mgr')
+    if mgr is not None:
+        mgr.poke()
+
+
+def _device_ident(br: dict):
+    # identificador para Tuya: device_id, tuya_device o entity_id como respaldo
+    return br.get('device_id') or br.get('tuya_device') or br.get('entity_id')
+
+
+def _tuya_payload(bid, tuya: dict, device_ident=None, default_action=None) -> dict:
+    """Mensaje 'tuya' para la UI a partir del resultado del servicio."""
+    payload = {'type': 'tuya', 'breaker_id': bid, **tuya}
+    action = tuya.get('action') or default_action
+    if action:
+        payload['action'] = action
+    if device_ident:
+        payload['device'] = device_ident  # la UI muestra el id usado
+    return payload
+
+
+def _service_result_events(bid, svc_res: dict, device_ident=None, default_action=None) -> list:
+    """Eventos para la UI con los resultados Tuya/HA de toggle/set/pulse."""
+    events = []
+    if svc_res.get('tuya') is not None:
+        events.append(_tuya_payload(bid, svc_res['tuya'], device_ident, default_action))
+    if svc_res.get('ha') is not None:
+        events.append({'type': 'ha', 'breaker_id': bid, 'result': svc_res['ha']})
+    return events
+
+
 async def breaker_toggle_handler(request):
     bid = request.match_info.get('id')
     svc_res = await toggle_breaker_service(DATA_PATH, bid)
     if not svc_res.get('ok'):
         return web.json_response({'ok': False, 'error': svc_res.get('error')}, status=404)
     br = svc_res.get('breaker')
-    # device identifier for Tuya: device_id, tuya_device or entity_id as fallback
-    device_ident = br.get('device_id') or br.get('tuya_device') or br.get('entity_id')
-    # broadcast tuya/ha results for UI
-    if svc_res.get('tuya') is not None:
-        t = dict(svc_res['tuya'])
-        # ensure action key
-        action = t.get('action') or 'toggle'
-        # normalize ok -> success for frontend
-        if 'ok' in t:
-            t['success'] = t.pop('ok')
-        # include device identifier so UI can show the id used
-        payload = {'type': 'tuya', 'breaker_id': bid, 'action': action, **t}
-        if device_ident:
-            payload['device'] = device_ident
-        asyncio.create_task(state.broadcast(payload))
-    if svc_res.get('ha') is not None:
-        asyncio.create_task(state.broadcast({'type': 'ha', 'breaker_id': bid, 'result': svc_res['ha']}))
-    asyncio.create_task(state.broadcast({'type': 'breakers:update', 'id': br['id'], 'state': 'on' if br.get('estado') else 'off'}))
+    events = _service_result_events(bid, svc_res, _device_ident(br), 'toggle')
+    _poke_consumption(request.app)
+    events.append({'type': 'breakers:update', 'id': br['id'], 'state': 'on' if br.get('estado') else 'off'})
+    state.publish_batch(events)
     return web.json_response({'ok': True, 'id': br['id'], 'state': 'on' if br.get('estado') else 'off'})
 
 
 async def breaker_set_handler(request):
     bid = request.match_info.get('id')
-    try:
-        body = await request.json()
-    except Exception:
-        body = dict(await request.post())
+    body = await _read_body(request)
     state_req = body.get('state')
     if state_req not in ('on', 'off'):
         return web.json_response({'ok': False, 'error': 'invalid state'}, status=400)
@@ -522,22 +790,10 @@ async def breaker_set_handler(request):
     if not svc_res.get('ok'):
         return web.json_response({'ok': False, 'error': svc_res.get('error')}, status=404)
     br = svc_res.get('breaker')
-    device_ident = br.get('device_id') or br.get('tuya_device') or br.get('entity_id')
-    if svc_res.get('tuya') is not None:
-        t = dict(svc_res['tuya'])
-        if 'ok' in t:
-            t['success'] = t.pop('ok')
-        # ensure action present (set_breaker uses action key)
-        action = t.get('action')
-        payload = {'type': 'tuya', 'breaker_id': bid, **t}
-        if action:
-            payload['action'] = action
-        if device_ident:
-            payload['device'] = device_ident
-        asyncio.create_task(state.broadcast(payload))
-    if svc_res.get('ha') is not None:
-        asyncio.create_task(state.broadcast({'type': 'ha', 'breaker_id': bid, 'result': svc_res['ha']}))
-    asyncio.create_task(state.broadcast({'type': 'breakers:update', 'id': br['id'], 'state': state_req}))
+    events = _service_result_events(bid, svc_res, _device_ident(br))
+    _poke_consumption(request.app)
+    events.append({'type': 'breakers:update', 'id': br['id'], 'state': state_req})
+    state.publish_batch(events)
     return web.json_response({'ok': True, 'id': br['id'], 'state': state_req})
 
 
@@ -547,10 +803,7 @@ async def tarjeta_update_saldo(request):
     Se persiste en data.json y se hace broadcast de la tarjeta actualizada.
     """
     tid = request.match_info.get('id')
-    try:
-        body = await request.json()
-    except Exception:
-        body = dict(await request.post())
+    body = await _read_body(request)
     if 'saldo' not in body:
         return web.json_response({'ok': False, 'error': 'missing saldo'}, status=400)
     try:
@@ -566,15 +819,12 @@ async def tarjeta_update_saldo(request):
         if t is None:
             return web.json_response({'ok': False, 'error': 'unknown tarjeta'}, status=404)
 
-        # broadcast de la tarjeta y de breakers asociados (su estado pudo cambiar)
-        asyncio.create_task(state.broadcast({'type': 'tarjetas:update', 'id': t.get('id'), 'tarjeta': t}))
-        try:
-            models = load_models()
-            for b in models.get('breakers', []):
-                if b.get('tarjeta') == t.get('id'):
-                    asyncio.create_task(state.broadcast({'type': 'breakers:update', 'id': b.get('id'), 'state': 'on' if b.get('estado') else 'off'}))
-        except Exception:
-            pass
+        _poke_consumption(request.app)
+        # broadcast de la tarjeta y de breakers asociados (su estado pudo cambiar); los
+        # breakers salen del índice de models_loader, sin reparsear el data.json recién escrito
+        state.publish({'type': 'tarjetas:update', 'id': t.get('id'), 'tarjeta': t})
+        for b in get_breakers_for_tarjeta(DATA_PATH, t.get('id')):
+            state.publish({'type': 'breakers:update', 'id': b.get('id'), 'state': 'on' if b.get('estado') else 'off'})
 
         return web.json_response({'ok': True, 'tarjeta': t})
     except Exception as e:
@@ -591,10 +841,7 @@ async def tarjeta_adjust_saldo(request):
     - Si el saldo llega a 0, intenta apagar físicamente los breakers asociados
     """
     tid = request.match_info.get('id')
-    try:
-        body = await request.json()
-    except Exception:
-        body = dict(await request.post())
+    body = await _read_body(request)
     if 'delta' not in body:
         return web.json_response({'ok': False, 'error': 'missing delta'}, status=400)
     try:
@@ -606,32 +853,38 @@ async def tarjeta_adjust_saldo(request):
         return web.json_response({'ok': False, 'error': 'invalid delta'}, status=400)
 
     try:
+        # encendidos antes del ajuste: adjust_tarjeta_saldo ya los marca apagados si el saldo llega a 0
+        was_on = {b.get('id') for b in get_breakers_for_tarjeta(DATA_PATH, tid) if b.get('estado')}
         t = adjust_tarjeta_saldo(DATA_PATH, tid, delta)
         if t is None:
             return web.json_response({'ok': False, 'error': 'unknown tarjeta'}, status=404)
 
+        _poke_consumption(request.app)
         # broadcast tarjeta actualizada
-        asyncio.create_task(state.broadcast({'type': 'tarjetas:update', 'id': t.get('id'), 'tarjeta': t}))
+        state.publish({'type': 'tarjetas:update', 'id': t.get('id'), 'tarjeta': t})
 
         # revisar breakers asociados para notificar y apagar físicamente si corresponde
         try:
-            models = load_models()
-            for b in models.get('breakers', []):
-                if b.get('tarjeta') == t.get('id'):
-                    # notificar estado actual
-                    asyncio.create_task(state.broadcast({'type': 'breakers:update', 'id': b.get('id'), 'state': 'on' if b.get('estado') else 'off'}))
-                    # si saldo 0 y está ON, intentar apagado físico vía servicio
-                    try:
-                        saldo_val = float(t.get('saldo') or 0.0)
-                    except Exception:
-                        saldo_val = 0.0
-                    if saldo_val <= 0.0 and bool(b.get('estado')):
-                        try:
-                            svc_res = await set_breaker(DATA_PATH, b.get('id'), False)
-                            if svc_res.get('ok'):
-                                asyncio.create_task(state.broadcast({'type': 'breakers:update', 'id': b.get('id'), 'state': 'off', 'reason': 'saldo=0'}))
-                        except Exception:
-                            pass
+            # saldo ya normalizado por adjust_tarjeta_saldo: leerlo una vez, no por breaker
+            try:
+                saldo_val = float(t.get('saldo') or 0.0)
+            except Exception:
+                saldo_val = 0.0
+            off_ids = []
+            for b in get_breakers_for_tarjeta(DATA_PATH, t.get('id')):
+                # notificar estado actual
+                state.publish({'type': 'breakers:update', 'id': b.get('id'), 'state': 'on' if b.get('estado') else 'off'})
+                # si saldo 0 y está ON, apagarlo físicamente (todos en una llamada)
+                if saldo_val <= 0.0 and b.get('id') in was_on:
+                    off_ids.append(b.get('id'))
+            if off_ids:
+                try:
+                    svc_res = await set_breakers_bulk(DATA_PATH, off_ids, False)
+                    if svc_res.get('ok'):
+                        state.publish_batch([{'type': 'breakers:update', 'id': b.get('id'), 'state': 'off', 'reason': 'saldo=0'}
+                                             for b in svc_res.get('breakers', [])])
+                except Exception:
+                    pass
         except Exception:
             pass
 
@@ -646,24 +899,13 @@ async def breaker_pulse_handler(request):
     br = get_breaker(DATA_PATH, bid)
     if not br:
         return web.json_response({'ok': False, 'error': 'unknown breaker'}, status=404)
-    device_id = br.get('device_id') or br.get('tuya_device') or br.get('entity_id') or ''
+    device_ident = _device_ident(br)
 
     svc_res = await pulse_breaker_service(DATA_PATH, bid, 500)
     if not svc_res.get('ok'):
         return web.json_response({'ok': False, 'error': svc_res.get('error')}, status=404)
 
-    # broadcast resultados
-    if svc_res.get('tuya') is not None:
-        t = dict(svc_res.get('tuya', {}))
-        if 'ok' in t:
-            t['success'] = t.pop('ok')
-        t['action'] = t.get('action') or 'pulse'
-        payload = {'type': 'tuya', 'breaker_id': bid, **t}
-        if device_id:
-            payload['device'] = device_id
-        asyncio.create_task(state.broadcast(payload))
-    if svc_res.get('ha') is not None:
-        asyncio.create_task(state.broadcast({'type': 'ha', 'breaker_id': bid, 'result': svc_res['ha']}))
+    state.publish_batch(_service_result_events(bid, svc_res, device_ident, 'pulse'))
 
     return web.json_response({'ok': True, 'id': br.get('id'), 'pulse': True})
 
@@ -705,77 +947,87 @@ async def breaker_refresh_handler(request):
     if not entities_to_query:
         return web.json_response({'ok': False, 'error': 'no_entities_configured'}, status=400)
     
-    # Consultar Home Assistant
-    import aiohttp
+    # Consultar Home Assistant: un solo GET /api/states; solo las entidades que no aparezcan
+    # ahí se piden una a una (en paralelo, acotado) para reportar el status real (p.ej. 404)
     headers = {'Authorization': f'Bearer {HA_TOKEN}', 'Content-Type': 'application/json'}
-    
+    sem = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+    async def fetch(session, ent_id):
+        async with sem:
+            try:
+                async with session.get(f"{HA_URL}/api/states/{ent_id}", headers=headers) as resp:
+                    if resp.status != 200:
+                        return ent_id, None, f"status {resp.status}"
+                    return ent_id, await resp.json(), None
+            except Exception as e:
+                return ent_id, None, str(e)
+
     updated_fields = {}
     errors = []
-    
+
     try:
-        async with aiohttp.ClientSession() as session:
-            for ent_id in entities_to_query:
-                try:
-                    async with session.get(f"{HA_URL}/api/states/{ent_id}", headers=headers) as resp:
-                        if resp.status != 200:
-                            errors.append(f"{ent_id}: status {resp.status}")
-                            continue
-                        
-                        state_data = await resp.json()
-                        state = state_data.get('state')
-                        attrs = state_data.get('attributes') or {}
-                        
-                        # Función auxiliar para extraer numérico
-                        def extract_numeric(val):
-                            try:
-                                if val is None:
-                                    return None
-                                if isinstance(val, (int, float)):
-                                    return val
-                                return float(str(val))
-                            except Exception:
-                                return None
-                        
-                        # Actualizar estado si es el switch principal
-                        if ent_id == entity_id:
-                            if state in ('on', 'off'):
-                                new_state_bool = (state == 'on')
-                                if bool(br.get('estado')) != new_state_bool:
-                                    set_breaker_state(DATA_PATH, bid, new_state_bool)
-                                    updated_fields['estado'] = new_state_bool
-                        
-                        # Detectar tipo de sensor y actualizar métricas
-                        lower_eid = ent_id.lower()
-                        
-                        # Corriente
-                        if 'corriente' in lower_eid or 'current' in lower_eid:
-                            current = extract_numeric(state) or extract_numeric(attrs.get('current'))
-                            if current is not None:
-                                updated_fields['current'] = current
-                        
-                        # Voltaje
-                        if 'tension' in lower_eid or 'voltage' in lower_eid:
-                            voltage = extract_numeric(state) or extract_numeric(attrs.get('voltage'))
-                            if voltage is not None:
-                                updated_fields['voltage'] = voltage
-                        
-                        # Potencia
-                        if 'potencia' in lower_eid or 'power' in lower_eid:
-                            power = extract_numeric(state) or extract_numeric(attrs.get('power'))
-                            if power is not None:
-                                updated_fields['power'] = power
-                        
-                        # Energía
-                        if 'energia' in lower_eid or 'energy' in lower_eid:
-                            energy = extract_numeric(state) or extract_numeric(attrs.get('energy'))
-                            if energy is not None:
-                                updated_fields['energy'] = energy
-                        
-                except Exception as e:
-                    errors.append(f"{ent_id}: {str(e)}")
-    
+        # sesión compartida de la app (keep-alive, caché DNS); creada en on_startup
+        session = request.app['http']
+        by_id = {}
+        try:
+            async with session.get(f"{HA_URL}/api/states", headers=headers) as resp:
+                if resp.status == 200:
+                    all_states = _loads(await resp.read())
+                    by_id = {st.get('entity_id'): st for st in all_states if st.get('entity_id') in entities_to_query}
+        except Exception:
+            pass  # sin listado masivo: todo por GET individual
+        results = [(ent_id, by_id[ent_id], None) for ent_id in entities_to_query if ent_id in by_id]
+        missing = [ent_id for ent_id in entities_to_query if ent_id not in by_id]
+        if missing:
+            results += await asyncio.gather(*(fetch(session, ent_id) for ent_id in missing))
     except Exception as e:
         return web.json_response({'ok': False, 'error': f'ha_request_failed: {str(e)}'}, status=500)
+
+    for ent_id, state_data, err in results:
+        if err is not None:
+            errors.append(f"{ent_id}: {err}")
+            continue
+        try:
+            state = state_data.get('state')
+            attrs = state_data.get('attributes') or {}
+
+            # Actualizar estado si es el switch principal
+            if ent_id == entity_id:
+                if state in ('on', 'off'):
+                    new_state_bool = (state == 'on')
+                    if bool(br.get('estado')) != new_state_bool:
+                        set_breaker_state(DATA_PATH, bid, new_state_bool)
+                        updated_fields['estado'] = new_state_bool
+
+            # Detectar tipo de sensor y actualizar métricas
+            lower_eid = ent_id.lower()
+
+            # Corriente
+            if 'corriente' in lower_eid or 'current' in lower_eid:
+                current = _extract_numeric(state) or _extract_numeric(attrs.get('current'))
+                if current is not None:
+                    updated_fields['current'] = current
+
+            # Voltaje
+            if 'tension' in lower_eid or 'voltage' in lower_eid:
+                voltage = _extract_numeric(state) or _extract_numeric(attrs.get('voltage'))
+                if voltage is not None:
+                    updated_fields['voltage'] = voltage
+
+            # Potencia
+            if 'potencia' in lower_eid or 'power' in lower_eid:
+                power = _extract_numeric(state) or _extract_numeric(attrs.get('power'))
+                if power is not None:
+                    updated_fields['power'] = power
+
+            # Energía
+            if 'energia' in lower_eid or 'energy' in lower_eid:
+                energy = _extract_numeric(state) or _extract_numeric(attrs.get('energy'))
+                if energy is not None:
+                    updated_fields['energy'] = energy
+
+        except Exception as e:
+            errors.append(f"{ent_id}: {str(e)}")
     
     # Actualizar campos en data.json
     if updated_fields:
@@ -784,11 +1036,11 @@ async def breaker_refresh_handler(request):
             estado = updated_fields.pop('estado', None)
             if estado is not None:
                 # Ya se actualizó con set_breaker_state
-                asyncio.create_task(state.broadcast({'type': 'breakers:update', 'id': bid, 'state': 'on' if estado else 'off'}))
+                state.publish({'type': 'breakers:update', 'id': bid, 'state': 'on' if estado else 'off'})
             
             if updated_fields:  # Si quedan métricas
                 update_breaker_fields(DATA_PATH, bid, **updated_fields)
-                asyncio.create_task(state.broadcast({'type': 'breakers:consumption', 'id': bid, **updated_fields}))
+                state.publish({'type': 'breakers:consumption', 'id': bid, **updated_fields})
         except Exception as e:
             errors.append(f"save_error: {str(e)}")
     
@@ -801,19 +1053,15 @@ async def breaker_refresh_handler(request):
 
 async def breakers_consumption_handler(request):
     """Devuelve métricas básicas de consumo de todos los breakers."""
-    models = load_models()
-    out = []
-    for b in models.get('breakers', []):
-        entry = {
-            'id': b.get('id'),
-            'estado': bool(b.get('estado')),
-            'power': b.get('power'),
-            'energy': b.get('energy'),
-            'voltage': b.get('voltage'),
-            'current': b.get('current'),
-        }
-        out.append(entry)
-    return web.json_response({'ok': True, 'breakers': out})
+    models = await aload_models()
+    out = [
+        {'id': b.get('id'), 'estado': bool(b.get('estado')),
+         'power': b.get('power'), 'energy': b.get('energy'),
+         'voltage': b.get('voltage'), 'current': b.get('current')}
+        for b in models.get('breakers', [])
+    ]
+    # serializa directo a bytes (orjson si está disponible)
+    return web.Response(body=_dumps_bytes({'ok': True, 'breakers': out}), content_type='application/json')
 
 
 async def usage_limits_handler(request):
@@ -824,10 +1072,7 @@ async def usage_limits_handler(request):
 
 async def usage_limits_update_handler(request):
     """POST /usage-limits - Actualizar límites de uso"""
-    try:
-        body = await request.json()
-    except Exception:
-        body = dict(await request.post())
+    body = await _read_body(request)
     
     limits = load_usage_limits()
     
@@ -844,7 +1089,7 @@ async def usage_limits_update_handler(request):
         limits['max_carga_por_tarjeta'] = float(body['max_carga_por_tarjeta'])
     
     if save_usage_limits(limits):
-        asyncio.create_task(state.broadcast({'type': 'usage_limits:update', 'limits': limits}))
+        state.publish({'type': 'usage_limits:update', 'limits': limits})
         return web.json_response({'ok': True, 'limits': limits})
     else:
         return web.json_response({'ok': False, 'error': 'save failed'}, status=500)
@@ -883,10 +1128,7 @@ async def breaker_usage_update_handler(request):
     if not br:
         return web.json_response({'ok': False, 'error': 'unknown breaker'}, status=404)
     
-    try:
-        body = await request.json()
-    except Exception:
-        body = dict(await request.post())
+    body = await _read_body(request)
     
     fields = {}
     if 'usos_profe' in body:
@@ -902,7 +1144,7 @@ async def breaker_usage_update_handler(request):
     
     if fields:
         update_breaker_fields(DATA_PATH, bid, **fields)
-        asyncio.create_task(state.broadcast({'type': 'breakers:usage_update', 'id': bid, **fields}))
+        state.publish({'type': 'breakers:usage_update', 'id': bid, **fields})
         return web.json_response({'ok': True, 'id': bid, 'updated': fields})
     else:
         return web.json_response({'ok': False, 'error': 'no fields to update'}, status=400)
@@ -930,7 +1172,7 @@ async def breaker_usage_reset_handler(request):
         fields['usando_ia_desde'] = None
     
     update_breaker_fields(DATA_PATH, bid, **fields)
-    asyncio.create_task(state.broadcast({'type': 'breakers:usage_update', 'id': bid, **fields}))
+    state.publish({'type': 'breakers:usage_update', 'id': bid, **fields})
     
     return web.json_response({'ok': True, 'id': bid, 'reset': reset_type, 'fields': fields})
 
@@ -965,7 +1207,7 @@ async def breaker_start_timer_handler(request):
     }
     
     update_breaker_fields(DATA_PATH, bid, **fields)
-    asyncio.create_task(state.broadcast({'type': 'breakers:usage_update', 'id': bid, **fields}))
+    state.publish({'type': 'breakers:usage_update', 'id': bid, **fields})
     
     return web.json_response({
         'ok': True, 
@@ -997,7 +1239,7 @@ async def breaker_stop_timer_handler(request):
     }
     
     update_breaker_fields(DATA_PATH, bid, **fields)
-    asyncio.create_task(state.broadcast({'type': 'breakers:usage_update', 'id': bid, **fields}))
+    state.publish({'type': 'breakers:usage_update', 'id': bid, **fields})
     
     return web.json_response({'ok': True, 'id': bid, 'type': timer_type, 'stopped': True})
 
@@ -1026,7 +1268,7 @@ async def breakers_tick_consumption_handler(request):
     _last_tick_time = now
     
     try:
-        body = await request.json()
+        body = await request.json(loads=_loads)
     except Exception:
         body = {}
     
@@ -1042,6 +1284,9 @@ async def breakers_tick_consumption_handler(request):
     
     # Agrupar descuentos por tarjeta para hacer una sola actualización por tarjeta
     tarjeta_deltas = {}  # {tarjeta_id: total_ws}
+    # breakers encendidos por tarjeta, tomados antes de descontar (adjust_tarjeta_saldo
+    # los marca apagados en el mismo dict si el saldo llega a 0)
+    on_by_tarjeta = {}
     breaker_updates = {}  # {breaker_id: consumption_last_ws}
     
     for br in breakers:
@@ -1051,6 +1296,7 @@ async def breakers_tick_consumption_handler(request):
         tarjeta_id = br.get('tarjeta')
         if not tarjeta_id:
             continue  # sin tarjeta asociada
+        on_by_tarjeta.setdefault(tarjeta_id, []).append(br.get('id'))
         
         # Calcular potencia con lógica mejorada
         power = br.get('power')
@@ -1119,7 +1365,7 @@ async def breakers_tick_consumption_handler(request):
             try:
                 update_breaker_fields(DATA_PATH, bid, consumption_last_ws=ws_val)
                 # Broadcast actualización (este sí puede ser async)
-                asyncio.create_task(state.broadcast({'type': 'breakers:consumption', 'id': bid, 'ws': ws_val}))
+                state.publish({'type': 'breakers:consumption', 'id': bid, 'ws': ws_val})
             except Exception as e:
                 print(f"[Tick] Error actualizando breaker {bid}: {e}")
     
@@ -1129,7 +1375,7 @@ async def breakers_tick_consumption_handler(request):
             t = adjust_tarjeta_saldo(DATA_PATH, tarjeta_id, -total_ws)
             if t:
                 # Broadcast actualización de tarjeta
-                asyncio.create_task(state.broadcast({'type': 'tarjetas:update', 'id': t.get('id'), 'tarjeta': t}))
+                state.publish({'type': 'tarjetas:update', 'id': t.get('id'), 'tarjeta': t})
                 
                 # Si saldo llegó a 0, apagar breakers asociados
                 try:
@@ -1138,14 +1384,15 @@ async def breakers_tick_consumption_handler(request):
                     saldo_val = 0.0
                 
                 if saldo_val <= 0.0:
-                    # Apagar breakers asociados a esta tarjeta
-                    for br in breakers:
-                        if br.get('tarjeta') == tarjeta_id and bool(br.get('estado')):
-                            try:
-                                await set_breaker(DATA_PATH, br.get('id'), False)
-                                asyncio.create_task(state.broadcast({'type': 'breakers:update', 'id': br.get('id'), 'state': 'off'}))
-                            except Exception as e:
-                                errors.append({'breaker_id': br.get('id'), 'error': str(e)})
+                    # Apagar breakers asociados a esta tarjeta (una sola llamada)
+                    off_ids = on_by_tarjeta.get(tarjeta_id, [])
+                    if off_ids:
+                        try:
+                            svc_res = await set_breakers_bulk(DATA_PATH, off_ids, False)
+                            state.publish_batch([{'type': 'breakers:update', 'id': br.get('id'), 'state': 'off'}
+                                                 for br in svc_res.get('breakers', [])])
+                        except Exception as e:
+                            errors.extend({'breaker_id': bid, 'error': str(e)} for bid in off_ids)
         except Exception as e:
             errors.append({'tarjeta_id': tarjeta_id, 'error': str(e)})
     
@@ -1157,6 +1404,157 @@ async def breakers_tick_consumption_handler(request):
     })
 
 
+# breakers:consumption desde HA: cada métrica llega como un state_changed propio; se
+# agrupan por breaker durante CONSUMPTION_DEBOUNCE_SECONDS y se emite un mensaje por breaker
+CONSUMPTION_DEBOUNCE_SECONDS = 0.1
+_CONSUMPTION_PENDING: dict = {}
+
+
+def _queue_consumption(bid, fields: dict) -> None:
+    if not state.websockets:
+        return  # nadie escucha: ni agrupar ni agendar
+    pending = _CONSUMPTION_PENDING.get(bid)
+    if pending is not None:
+        pending.update(fields)
+        return
+    if not _CONSUMPTION_PENDING:
+        asyncio.get_running_loop().call_later(CONSUMPTION_DEBOUNCE_SECONDS, _flush_consumption)
+    _CONSUMPTION_PENDING[bid] = {'type': 'breakers:consumption', 'id': bid, **fields}
+
+
+def _flush_consumption() -> None:
+    for msg in _CONSUMPTION_PENDING.values():
+        state.publish(msg)
+    _CONSUMPTION_PENDING.clear()
+
+
+def _raw_recv(ws):
+    """recv que entrega los frames de texto como bytes sin decodificar (websockets >= 13):
+    orjson parsea bytes directo, sin el paso por str ni su validación UTF-8."""
+    try:
+        if 'decode' in inspect.signature(ws.recv).parameters:
+            return functools.partial(ws.recv, decode=False)
+    except (TypeError, ValueError):
+        pass
+    return ws.recv
+
+
+async def _ha_listener_once(on_auth):
+    """Una conexión WS a HA: autentica, se suscribe a state_changed y procesa eventos
+    hasta que la conexión se corta (retorna) o falla (excepción). Llama on_auth()
+    tras recibir auth_ok."""
+    # sin permessage-deflate: los frames de HA son chicos y descomprimir cuesta CPU
+    async with websockets.connect(HA_WS, ping_interval=20, ping_timeout=20, max_queue=1000, compression=None) as ws:
+        # handshake
+        hello = _loads(await ws.recv())
+        if hello.get('type') != 'auth_required':
+            print('[HA Listener] HA WS unexpected hello', hello)
+            await state.broadcast({'type': 'ha:status', 'status': 'disconnected', 'reason': 'unexpected_hello'})
+            raise RuntimeError('unexpected hello from HA')
+        await ws.send(_dumps({'type':'auth', 'access_token': HA_TOKEN}))
+        resp = _loads(await ws.recv())
+        if resp.get('type') != 'auth_ok':
+            print('[HA Listener] HA WS auth failed', resp)
+            await state.broadcast({'type': 'ha:status', 'status': 'disconnected', 'reason': 'auth_failed'})
+            raise RuntimeError('auth failed to HA')
+        on_auth()  # HA responde: el próximo corte reintenta rápido
+        # subscribe a state_changed
+        msg = {'id': 1, 'type': 'subscribe_events', 'event_type': 'state_changed'}
+        await ws.send(_dumps(msg))
+        ack = _loads(await ws.recv())
+        if not ack.get('success'):
+            print('[HA Listener] HA WS subscribe failed', ack)
+            await state.broadcast({'type': 'ha:status', 'status': 'disconnected', 'reason': 'subscribe_failed'})
+            raise RuntimeError('subscribe failed')
+        print('[HA Listener] ✓ Conectado y suscrito a state_changed')
+        await state.broadcast({'type': 'ha:status', 'status': 'connected'})
+        recv = _raw_recv(ws)
+        while True:
+            try:
+                raw = await recv()
+            except websockets.ConnectionClosedOK:
+                return  # cierre limpio de HA: ha_listener_forever reconecta
+            try:
+                evt = _loads(raw)
+            except Exception:
+                continue
+            if evt.get('type') == 'event' and evt.get('event', {}).get('event_type') == 'state_changed':
+                data = evt['event']['data']
+                entity_id = data.get('entity_id')
+                new_state = data.get('new_state')
+                print(f'[HA Event] state_changed: entity_id={entity_id} state={new_state.get("state") if isinstance(new_state, dict) else new_state}')
+                # forward raw HA event to clients
+                if state.websockets:
+                    state.publish({'type':'ha:state_changed','entity_id':entity_id,'new_state':new_state})
+                # descartar sin cargar modelos las entidades que ningún breaker referencia (la
+                # mayoría de los eventos de HA); el watcher renueva la caché si data.json cambia
+                known = _known_entities()
+                if entity_id and known is not None and entity_id not in known:
+                    if entity_id.startswith(('switch.', 'sensor.')):
+                        print(f"[HA Event] ⚠️  Entidad no asociada: {entity_id}")
+                    continue
+                # if the new state corresponds to a breaker entity, update local models and notify clients
+                st = None
+                attrs = {}
+                if isinstance(new_state, dict):
+                    st = new_state.get('state')
+                    attrs = new_state.get('attributes') or {}
+                # only proceed if we have an entity_id and a state string
+                if entity_id:
+                    models = await aload_models()
+                    breakers = models.get('breakers', [])
+                    # breakers que referencian la entidad (principal, *_entity o 'entities')
+                    matched = models_index(models)['entity'].get(entity_id, [])
+                    
+                    # Log resultado de búsqueda con valores recibidos
+                    if matched:
+                        b = matched[0]
+                        # Mostrar valores recibidos para breaker 9 específicamente
+                        if b.get('id') == 'eb9a238727302e4422hpdm':
+                            print(f'[HA Event] 🔍 BREAKER 9: entity_id={entity_id} state={st} attributes={attrs}')
+                        print(f'[HA Event] ✓ Matched entity_id={entity_id} -> breaker id={b.get("id")} nombre={b.get("nombre")}')
+                    else:
+                        # No se encontró match - loguear solo switches/sensors sin asignar automáticamente
+                        if entity_id.startswith(('switch.', 'sensor.')):
+                            # Mostrar breakers configurados para debugging
+                            breaker_info = [(b.get('id'), b.get('entity_id'), len(b.get('entities', []))) for b in breakers]
+                            print(f"[HA Event] ⚠️  Entidad no asociada: {entity_id} - Breakers: {breaker_info}")
+                    # dominio y métricas insinuadas por el nombre: una vez por evento
+                    domain = entity_id.split('.', 1)[0] if '.' in entity_id else ''
+                    lower_eid = entity_id.lower() if isinstance(entity_id, str) else ''
+                    hinted = {metric for metric, kws, _attrs in _METRIC_HINTS if any(k in lower_eid for k in kws)} if matched else ()
+                    for b in matched:
+                        # actualizar estado solo si la entidad es principal o un switch
+                        if st is not None and (entity_id == b.get('entity_id') or domain == 'switch'):
+                            new_state_bool = (st == 'on')
+                            if bool(b.get('estado')) != new_state_bool:
+                                set_breaker_state(DATA_PATH, b.get('id'), new_state_bool)
+                                state.publish({'type':'breakers:update','id': b.get('id'),'state': 'on' if new_state_bool else 'off'})
+                        # métricas: entidad *_entity explícita o palabra clave en el
+                        # entity_id leen el state; si no, atributos genéricos.
+                        # Entidad unknown/unavailable: sin métricas que actualizar
+                        fields = {}
+                        for metric, _kws, attr_keys in (() if st in _NO_VALUE_STATES else _METRIC_HINTS):
+                            val = None
+                            if metric in hinted or entity_id == b.get(metric + '_entity'):
+                                val = _extract_numeric(st)
+                            if val is None:
+                                # equivalente a attrs.get(a) or attrs.get(b) or ...
+                                for k in attr_keys:
+                                    raw_attr = attrs.get(k)
+                                    if raw_attr:
+                                        break
+                                val = _extract_numeric(raw_attr)
+                            if val is not None:
+                                fields[metric] = val
+                        if fields:
+                            # Log detallado para breaker 9
+                            if b.get('id') == 'eb9a238727302e4422hpdm':
+                                print(f'[HA Event] 📊 BREAKER 9 actualizando: entity_id={entity_id} fields={fields}')
+                            update_breaker_fields(DATA_PATH, b.get('id'), **fields)
+                            _queue_consumption(b.get('id'), fields)
+
+
 async def ha_listener_forever():
     """Mantiene conexión WS con HA con reconexión automática y reenvía state_changed.
 
@@ -1166,172 +1564,17 @@ async def ha_listener_forever():
         print('[HA Listener] NO INICIADO: HA_WS o HA_TOKEN no configurados')
         return
     print(f'[HA Listener] Iniciando conexión a {HA_WS[:50]}...')
-    backoff = 3
+    backoff = 1
+
+    def _reset_backoff():
+        nonlocal backoff
+        backoff = 1
+
     while True:
         try:
-            async with websockets.connect(HA_WS, ping_interval=20, ping_timeout=20, max_queue=1000) as ws:
-                # handshake
-                hello = json.loads(await ws.recv())
-                if hello.get('type') != 'auth_required':
-                    print('[HA Listener] HA WS unexpected hello', hello)
-                    await state.broadcast({'type': 'ha:status', 'status': 'disconnected', 'reason': 'unexpected_hello'})
-                    raise RuntimeError('unexpected hello from HA')
-                await ws.send(json.dumps({'type':'auth', 'access_token': HA_TOKEN}))
-                resp = json.loads(await ws.recv())
-                if resp.get('type') != 'auth_ok':
-                    print('[HA Listener] HA WS auth failed', resp)
-                    await state.broadcast({'type': 'ha:status', 'status': 'disconnected', 'reason': 'auth_failed'})
-                    raise RuntimeError('auth failed to HA')
-                # subscribe a state_changed
-                msg = {'id': 1, 'type': 'subscribe_events', 'event_type': 'state_changed'}
-                await ws.send(json.dumps(msg))
-                ack = json.loads(await ws.recv())
-                if not ack.get('success'):
-                    print('[HA Listener] HA WS subscribe failed', ack)
-                    await state.broadcast({'type': 'ha:status', 'status': 'disconnected', 'reason': 'subscribe_failed'})
-                    raise RuntimeError('subscribe failed')
-                print('[HA Listener] ✓ Conectado y suscrito a state_changed')
-                await state.broadcast({'type': 'ha:status', 'status': 'connected'})
-                backoff = 3  # resetear backoff al conectar
-                async for raw in ws:
-                    try:
-                        evt = json.loads(raw)
-                    except Exception:
-                        continue
-                    if evt.get('type') == 'event' and evt.get('event', {}).get('event_type') == 'state_changed':
-                        data = evt['event']['data']
-                        entity_id = data.get('entity_id')
-                        new_state = data.get('new_state')
-                        print(f'[HA Event] state_changed: entity_id={entity_id} state={new_state.get("state") if isinstance(new_state, dict) else new_state}')
-                        # forward raw HA event to clients
-                        asyncio.create_task(state.broadcast({'type':'ha:state_changed','entity_id':entity_id,'new_state':new_state}))
-                        # if the new state corresponds to a breaker entity, update local models and notify clients
-                        st = None
-                        attrs = {}
-                        if isinstance(new_state, dict):
-                            st = new_state.get('state')
-                            attrs = new_state.get('attributes') or {}
-                        # only proceed if we have an entity_id and a state string
-                        if entity_id:
-                            models = load_models()
-                            breakers = models.get('breakers', [])
-                            # Log: buscar breaker matching - construir conjunto completo de entidades
-                            matched = []
-                            for b in breakers:
-                                ids = set()
-                                if b.get('entity_id'):
-                                    ids.add(b.get('entity_id'))
-                                extra = b.get('entities') or []
-                                if isinstance(extra, list):
-                                    for e in extra:
-                                        if isinstance(e, str):
-                                            ids.add(e)
-                                for key in ('power_entity','energy_entity','voltage_entity','current_entity'):
-                                    val = b.get(key)
-                                    if isinstance(val, str):
-                                        ids.add(val)
-                                if entity_id in ids:
-                                    matched.append(b)
-                            
-                            # Log resultado de búsqueda con valores recibidos
-                            if matched:
-                                b = matched[0]
-                                # Mostrar valores recibidos para breaker 9 específicamente
-                                if b.get('id') == 'eb9a238727302e4422hpdm':
-                                    print(f'[HA Event] 🔍 BREAKER 9: entity_id={entity_id} state={st} attributes={attrs}')
-                                print(f'[HA Event] ✓ Matched entity_id={entity_id} -> breaker id={b.get("id")} nombre={b.get("nombre")}')
-                            else:
-                                # No se encontró match - loguear solo switches/sensors sin asignar automáticamente
-                                if entity_id.startswith(('switch.', 'sensor.')):
-                                    # Mostrar breakers configurados para debugging
-                                    breaker_info = [(b.get('id'), b.get('entity_id'), len(b.get('entities', []))) for b in breakers]
-                                    print(f"[HA Event] ⚠️  Entidad no asociada: {entity_id} - Breakers: {breaker_info}")
-                            for b in matched:
-                                # actualizar estado solo si la entidad es principal o un switch
-                                domain = entity_id.split('.',1)[0] if '.' in entity_id else ''
-                                if st is not None and (entity_id == b.get('entity_id') or domain == 'switch'):
-                                    new_state_bool = (st == 'on')
-                                    if bool(b.get('estado')) != new_state_bool:
-                                        set_breaker_state(DATA_PATH, b.get('id'), new_state_bool)
-                                        asyncio.create_task(state.broadcast({'type':'breakers:update','id': b.get('id'),'state': 'on' if new_state_bool else 'off'}))
-                                # métricas
-                                # reutilizar extractor numeric
-                                def extract_numeric(val):
-                                    try:
-                                        if val is None:
-                                            return None
-                                        if isinstance(val, (int, float)):
-                                            return val
-                                        return float(str(val))
-                                    except Exception:
-                                        return None
-
-                                # detectar sufijos de métricas, incluyendo phase_a_*
-                                metric_suffixes = {
-                                    'power': ['power_entity', 'power', 'power_w', 'current_power_w'],
-                                    'energy': ['energy_entity', 'energy', 'today_energy_kwh', 'energy_kwh'],
-                                    'voltage': ['voltage_entity', 'voltage', 'voltage_v'],
-                                    'current': ['current_entity', 'current', 'current_a'],
-                                }
-
-                                # añadimos heurísticas para phase_a_* que pueden venir como sensor.nombre_phase_a_current etc.
-                                # si la entidad_id contiene 'phase_a' o endswith relevant suffixes intentamos mapearlo.
-                                power = energy = voltage = current = None
-
-                                # si el entity_id corresponde exactamente con alguna entidad configurada explícitamente
-                                if entity_id == b.get('power_entity'):
-                                    power = extract_numeric(st)
-                                if entity_id == b.get('energy_entity'):
-                                    energy = extract_numeric(st)
-                                if entity_id == b.get('voltage_entity'):
-                                    voltage = extract_numeric(st)
-                                if entity_id == b.get('current_entity'):
-                                    current = extract_numeric(st)
-
-                                # si no hay coincidencia directa, intentar heurísticas con sufijos y palabras clave
-                                # soporta tanto inglés (phase_a, current, voltage, power) como español (fase_a, corriente, tension, potencia)
-                                try:
-                                    lower_eid = entity_id.lower() if isinstance(entity_id, str) else ''
-                                    # detectar corriente/current
-                                    if current is None and ('corriente' in lower_eid or 'current' in lower_eid):
-                                        current = extract_numeric(st)
-                                    # detectar tensión/voltage
-                                    if voltage is None and ('tension' in lower_eid or 'voltage' in lower_eid):
-                                        voltage = extract_numeric(st)
-                                    # detectar potencia/power
-                                    if power is None and ('potencia' in lower_eid or 'power' in lower_eid):
-                                        power = extract_numeric(st)
-                                    # detectar energía/energy
-                                    if energy is None and ('energia' in lower_eid or 'energy' in lower_eid):
-                                        energy = extract_numeric(st)
-                                except Exception:
-                                    pass
-
-                                # Caer a atributos genéricos si aún no tenemos valores
-                                if power is None:
-                                    power = extract_numeric(attrs.get('power') or attrs.get('current_power_w') or attrs.get('power_w'))
-                                if energy is None:
-                                    energy = extract_numeric(attrs.get('energy') or attrs.get('today_energy_kwh') or attrs.get('energy_kwh'))
-                                if voltage is None:
-                                    voltage = extract_numeric(attrs.get('voltage') or attrs.get('voltage_v'))
-                                if current is None:
-                                    current = extract_numeric(attrs.get('current') or attrs.get('current_a'))
-
-                                fields = {}
-                                if power is not None:
-                                    fields['power'] = power
-                                if energy is not None:
-                                    fields['energy'] = energy
-                                if voltage is not None:
-                                    fields['voltage'] = voltage
-                                if current is not None:
-                                    fields['current'] = current
-                                if fields:
-                                    # Log detallado para breaker 9
-                                    if b.get('id') == 'eb9a238727302e4422hpdm':
-                                        print(f'[HA Event] 📊 BREAKER 9 actualizando: entity_id={entity_id} fields={fields}')
-                                    update_breaker_fields(DATA_PATH, b.get('id'), **fields)
-                                    asyncio.create_task(state.broadcast({'type':'breakers:consumption','id': b.get('id'), **fields}))
+            await _ha_listener_once(_reset_backoff)
+            print(f'[HA Listener] Conexión cerrada por HA, reconectando en {backoff}s')
+            await state.broadcast({'type': 'ha:status', 'status': 'disconnected', 'reason': 'closed'})
         except asyncio.CancelledError:
             # detener definitivamente
             print('[HA Listener] Detenido (cancelled)')
@@ -1344,8 +1587,8 @@ async def ha_listener_forever():
                 await state.broadcast({'type': 'ha:status', 'status': 'disconnected', 'error': str(e)[:200]})
             except Exception:
                 pass
-            await asyncio.sleep(backoff)
-            backoff = min(backoff * 2, 30)
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, HA_RECONNECT_MAX_SECONDS)
 
 
 def make_app():
@@ -1413,9 +1656,29 @@ def make_app():
 
         app.on_startup.append(_start_ha)
         app.on_cleanup.append(_stop_ha)
+    # sesión HTTP compartida (pool keep-alive) para las consultas REST a HA: la misma de
+    # breaker_service (la cierra close_ha_session); propia solo si ese módulo no está
+    async def _start_http(app):
+        if get_ha_session is not None:
+            app['http'] = get_ha_session()
+            return
+        import aiohttp
+        app['http'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=REFRESH_CONCURRENCY, ttl_dns_cache=300))
+        app['own_http'] = True
+
+    async def _close_http(app):
+        session = app.get('http')
+        if session is not None and app.get('own_http'):
+            await session.close()
+
+    app.on_startup.append(_start_http)
+    app.on_cleanup.append(_close_http)
+    # páginas estáticas en memoria (se releen al reiniciar el servidor)
+    app['pages'] = _load_static_pages()
     # always load models and start watcher
     async def _init_models(app):
         init_models_startup()
+        app['stop_ev'] = asyncio.Event()  # detiene awatch en el cleanup
         app['watcher_task'] = asyncio.create_task(watch_data_file(app))
 
     # registrar init_models primero para que los demás startup hooks asuman modelos cargados
@@ -1431,10 +1694,8 @@ def make_app():
             # si el módulo tiene set_broadcaster, conectarlo para WS
             set_broadcaster = getattr(_mod, 'set_broadcaster', None)
             if set_broadcaster:
-                # broadcaster usa el state.broadcast pero puede aceptar sync o async
-                def _ws_emit(msg: dict):
-                    return state.broadcast(msg)
-                set_broadcaster(_ws_emit)
+                # state.broadcast es async: el manager lo agenda como tarea
+                set_broadcaster(state.broadcast)
             if create_manager:
                 break
         except Exception:
@@ -1457,6 +1718,8 @@ def make_app():
         app.on_cleanup.append(_stop_consumption)
 
     async def _cleanup_models(app):
+        if 'stop_ev' in app:
+            app['stop_ev'].set()
         t = app.get('watcher_task')
         if t:
             t.cancel()
@@ -1464,37 +1727,50 @@ def make_app():
                 await t
             except asyncio.CancelledError:
                 pass
+        # no perder lo marcado con _mark_dirty que siga en write-behind
+        await asyncio.to_thread(flush_pending, DATA_PATH)
     # sync inicial de breakers desde HA (estados y consumo)
     try:
-        from .breaker_service import sync_all_breakers_from_ha
+        from .breaker_service import sync_all_breakers_from_ha, close_ha_session, flush_pending_save
     except Exception:
         try:
-            from breaker_service import sync_all_breakers_from_ha
+            from breaker_service import sync_all_breakers_from_ha, close_ha_session, flush_pending_save
         except Exception:
             sync_all_breakers_from_ha = None
+            close_ha_session = None
+            flush_pending_save = None
 
     if HA_URL and HA_TOKEN:
         async def _sync_ha(app):
             if sync_all_breakers_from_ha:
                 print('[Startup] Sincronizando breakers desde Home Assistant...')
-                res = await sync_all_breakers_from_ha(DATA_PATH)
+                res = await sync_all_breakers_from_ha(DATA_PATH, session=app.get('http'))
                 if res.get('ok'):
                     updated = res.get('updated', [])
                     print(f'[Startup] ✓ Sincronizados {len(updated)} breakers desde HA')
-                    # broadcast de cada breaker actualizado
+                    # un solo frame con estado y consumo de todos los breakers actualizados
+                    events = []
                     for u in updated:
                         print(f"  - Breaker id={u['id']} estado={'on' if u.get('estado') else 'off'} power={u.get('power')} voltage={u.get('voltage')} current={u.get('current')}")
-                        await state.broadcast({'type': 'breakers:update', 'id': u['id'], 'state': 'on' if u.get('estado') else 'off'})
-                        m = {k:v for k,v in u.items() if k in ('power','energy','voltage','current') and v is not None}
+                        events.append({'type': 'breakers:update', 'id': u['id'], 'state': 'on' if u.get('estado') else 'off'})
+                        m = {k: u[k] for k in ('power', 'energy', 'voltage', 'current') if u.get(k) is not None}
                         if m:
                             m.update({'type':'breakers:consumption','id': u['id']})
-                            await state.broadcast(m)
+                            events.append(m)
+                    state.publish_batch(events)
                 else:
                     print(f'[Startup] ✗ Error en sync_all_breakers_from_ha: {res.get("error")}')
             else:
                 print('[Startup] sync_all_breakers_from_ha no disponible')
         app.on_startup.append(_sync_ha)
     app.on_cleanup.append(_cleanup_models)
+    # escribir cambios de sync pendientes y cerrar la sesión HTTP compartida con HA al apagar
+    if close_ha_session:
+        async def _close_ha_session(app):
+            if flush_pending_save:
+                await flush_pending_save()
+            await close_ha_session()
+        app.on_cleanup.append(_close_ha_session)
     # Ruta adicional para ajustar saldo (delta)
     app.router.add_post('/tarjetas/{id}/ajuste', tarjeta_adjust_saldo)
     return app
@@ -1503,4 +1779,11 @@ def make_app():
 if __name__ == '__main__':
     host = os.environ.get('UI_HOST', '0.0.0.0')
     port = int(os.environ.get('UI_PORT', '9111'))
-    web.run_app(make_app(), host=host, port=port)
+    loop = None  # run_app crea uno estándar
+    try:
+        import uvloop  # opcional (no disponible en Windows): event loop más rápido
+        # loop explícito en vez de set_event_loop_policy (las policies están deprecadas)
+        loop = uvloop.new_event_loop()
+    except ImportError:
+        pass
+    web.run_app(make_app(), host=host, port=port, loop=loop)
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from scripts import breaker_service, models_loader
+
+
+class SaveCoalescedTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = []
+        patcher = mock.patch.object(breaker_service, 'save_breakers_patch',
+                                    side_effect=lambda path, patches: self.saved.append((path, patches)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        state = {'pending': {}, 'path': None, 'last': None, 'handle': None, 'task': None}
+        patcher = mock.patch.dict(breaker_service._SAVE_STATE, state)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_first_save_is_immediate_and_later_ones_coalesce(self):
+        async def run():
+            await breaker_service._save_coalesced('a.json', {'b1': {'power': 1.0}})
+            await breaker_service._save_coalesced('a.json', {'b1': {'power': 2.0}})
+            await breaker_service._save_coalesced('a.json', {'b2': {'voltage': 220.0}})
+            self.assertIsNotNone(breaker_service._SAVE_STATE['handle'])
+            await breaker_service.flush_pending_save()
+        asyncio.run(run())
+        self.assertEqual(self.saved, [
+            ('a.json', {'b1': {'power': 1.0}}),
+            ('a.json', {'b1': {'power': 2.0}, 'b2': {'voltage': 220.0}}),
+        ])
+
+    def test_patches_after_path_switch_are_not_lost(self):
+        async def run():
+            await breaker_service._save_coalesced('a.json', {'b1': {'power': 1.0}})
+            await breaker_service._save_coalesced('a.json', {'b1': {'power': 2.0}})
+            # cambiar de archivo vuelca lo pendiente; el parche nuevo va al dict vigente
+            await breaker_service._save_coalesced('b.json', {'b9': {'power': 3.0}})
+            await breaker_service.flush_pending_save()
+        asyncio.run(run())
+        self.assertEqual(self.saved[-2:], [
+            ('a.json', {'b1': {'power': 2.0}}),
+            ('b.json', {'b9': {'power': 3.0}}),
+        ])
+
+    def test_deferred_save_task_runs_and_is_released(self):
+        async def run():
+            with mock.patch.object(breaker_service, 'SAVE_MIN_INTERVAL_S', 0.01):
+                await breaker_service._save_coalesced('a.json', {'b1': {'power': 1.0}})
+                await breaker_service._save_coalesced('a.json', {'b1': {'power': 2.0}})
+                await asyncio.sleep(0.05)
+        asyncio.run(run())
+        self.assertEqual(self.saved[-1], ('a.json', {'b1': {'power': 2.0}}))
+        self.assertIsNone(breaker_service._SAVE_STATE['task'])
+
+
+class CoerceTest(unittest.TestCase):
+    def test_plain_and_unit_strings(self):
+        self.assertEqual(breaker_service._coerce('123.4'), 123.4)
+        self.assertEqual(breaker_service._coerce('10,5 A'), 10.5)
+        self.assertEqual(breaker_service._coerce(' 230V'), 230.0)
+        self.assertEqual(breaker_service._coerce(7), 7.0)
+
+    def test_rejects_signed_exponent_and_non_finite_strings(self):
+        for val in ('-1e3', '+5', '-12.5', 'nan', 'inf', 'unavailable', ''):
+            self.assertIsNone(breaker_service._coerce(val), val)
+        # '1e3' conserva el prefijo numérico, como antes
+        self.assertEqual(breaker_service._coerce('1e3'), 1.0)
+
+
+class SetBreakersBulkTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'data.json')
+        with open(self.path, 'w', encoding='utf8') as f:
+            json.dump({
+                'tarjetas': [{'id': 'T', 'saldo': 300.0}],
+                'breakers': [
+                    {'id': 'b1', 'estado': False, 'tarjeta': 'T', 'entity_id': 'switch.b1'},
+                    {'id': 'b2', 'estado': False, 'tarjeta': 'T', 'entity_id': 'switch.b2'},
+                    {'id': 'b3', 'estado': False, 'tuya_id': 'dev3'},
+                ],
+                'arduinos': [],
+            }, f)
+        self.addCleanup(models_loader._CACHE.pop, self.path, None)
+        self.addCleanup(models_loader.flush_pending)
+        self.tuya = mock.AsyncMock(return_value={'success': True, 'msg': 'ok', 'action': 'encender'})
+        self.ha = mock.AsyncMock(return_value={'ok': True, 'result': []})
+        for name, value in (('_run_tuya_action', self.tuya), ('_call_ha_service', self.ha)):
+            patcher = mock.patch.object(breaker_service, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _run(self, ids, state):
+        return asyncio.run(breaker_service.set_breakers_bulk(self.path, ids, state))
+
+    def test_ha_entities_share_one_call_and_tuya_uses_device_target(self):
+        with mock.patch.multiple(breaker_service, HA_URL='http://ha', HA_TOKEN='x'):
+            res = self._run(['b1', 'b2', 'b3', 'zz'], True)
+        self.ha.assert_awaited_once_with(['switch.b1', 'switch.b2'], 'turn_on')
+        self.tuya.assert_awaited_once_with('dev3', 'encender')
+        self.assertEqual(res['unknown'], ['zz'])
+        self.assertTrue(all(models_loader.get_breaker(self.path, b)['estado'] for b in ('b1', 'b2', 'b3')))
+        # saldo de la tarjeta solo en la respuesta, como set_breaker
+        by_id = {b['id']: b for b in res['breakers']}
+        self.assertEqual(by_id['b1']['saldo'], 300.0)
+        self.assertNotIn('saldo', by_id['b3'])
+        self.assertNotIn('saldo', models_loader.get_breaker(self.path, 'b1'))
+
+    def test_without_ha_every_breaker_goes_through_tuya(self):
+        with mock.patch.multiple(breaker_service, HA_URL=None, HA_TOKEN=None):
+            res = self._run(['b1', 'b3'], False)
+        self.ha.assert_not_awaited()
+        self.assertEqual(sorted(c.args for c in self.tuya.await_args_list),
+                         [('dev3', 'apagar'), ('switch.b1', 'apagar')])
+        self.assertEqual(set(res['tuya']), {'b1', 'b3'})
+
+
+class SyncAllBreakersTest(unittest.TestCase):
+    def test_load_failure_returns_error_and_cancels_states_request(self):
+        async def slow_states(session, headers):
+            await asyncio.sleep(10)
+
+        async def run():
+            with mock.patch.multiple(breaker_service, aiohttp=object(), HA_URL='http://ha', HA_TOKEN='x',
+                                     get_ha_session=mock.Mock(), _fetch_states=slow_states,
+                                     load_data=mock.Mock(side_effect=OSError('boom'))):
+                res = await breaker_service.sync_all_breakers_from_ha('x.json')
+                await asyncio.sleep(0)
+            pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            return res, pending
+
+        res, pending = asyncio.run(run())
+        self.assertEqual(res, {'ok': False, 'error': 'boom'})
+        self.assertEqual(pending, [])
+
+
+class DiscardSessionTest(unittest.TestCase):
+    def test_session_of_finished_loop_is_detached_and_connector_closed(self):
+        old_loop = asyncio.new_event_loop()
+        old_loop.close()
+        session = mock.Mock(closed=False)
+        connector = session.connector
+        connector.close.return_value = None
+        breaker_service._discard_session(session, old_loop)
+        session.detach.assert_called_once_with()
+        connector.close.assert_called_once_with()
+
+    def test_async_connector_close_is_awaited(self):
+        closed = []
+
+        async def close():
+            closed.append(True)
+
+        async def run():
+            session = mock.Mock(closed=False)
+            session.connector.close.side_effect = close
+            breaker_service._discard_session(session, None)
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+        asyncio.run(run())
+        self.assertEqual(closed, [True])
+
+    def test_closed_session_is_left_alone(self):
+        session = mock.Mock(closed=True)
+        breaker_service._discard_session(session, None)
+        session.detach.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from scripts import consumption_manager, models_loader
+
+
+class ConsumptionTickTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'data.json')
+        with open(self.path, 'w', encoding='utf8') as f:
+            json.dump({
+                'tarjetas': [{'id': 'T', 'saldo': 1000.0}],
+                'breakers': [{'id': 'b1', 'estado': True, 'tarjeta': 'T', 'power': 100}],
+                'arduinos': [],
+            }, f)
+        patcher = mock.patch.object(consumption_manager, 'async_set_breakers_bulk', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cm = consumption_manager.ConsumptionManager(self.path)
+
+    def tearDown(self):
+        models_loader.flush_pending()
+        models_loader._CACHE.pop(self.path, None)
+        self.tmp.cleanup()
+
+    def _saldo_on_disk(self):
+        with open(self.path, encoding='utf8') as f:
+            return json.load(f)['tarjetas'][0]['saldo']
+
+    def test_tick_writes_saldo_to_disk(self):
+        self.cm._tick(1.0)
+        self.assertAlmostEqual(self._saldo_on_disk(), 900.0)
+
+    def test_absolute_saldo_between_ticks_is_kept(self):
+        self.cm._tick(1.0)
+        self.cm._tick(1.0)
+        models_loader.set_tarjeta_saldo(self.path, 'T', 500)
+        self.assertAlmostEqual(self._saldo_on_disk(), 500.0)
+        self.cm._tick(1.0)
+        # el descuento parte del saldo fijado, no se re-aplican los ticks anteriores
+        self.assertAlmostEqual(self._saldo_on_disk(), 400.0)
+
+    def test_breaker_without_saldo_is_turned_off(self):
+        models_loader.set_tarjeta_saldo(self.path, 'T', 50)
+        self.cm._tick(1.0)
+        with open(self.path, encoding='utf8') as f:
+            data = json.load(f)
+        self.assertEqual(data['tarjetas'][0]['saldo'], 0)
+        self.assertFalse(data['breakers'][0]['estado'])
+
+
+    def test_breakers_without_saldo_are_switched_off_in_one_call(self):
+        models_loader.set_tarjeta_saldo(self.path, 'T', 50)
+        with models_loader.data_lock():
+            data = models_loader.load_data(self.path)
+            data['breakers'].append({'id': 'b2', 'estado': True, 'tarjeta': 'T', 'power': 10})
+            models_loader.save_data(self.path, data)
+        bulk = mock.AsyncMock(return_value={'ok': True})
+
+        async def run():
+            with mock.patch.object(consumption_manager, 'async_set_breakers_bulk', bulk):
+                self.cm._tick(1.0)
+                await asyncio.sleep(0)
+        asyncio.run(run())
+        bulk.assert_awaited_once_with(self.path, ['b1', 'b2'], False)
+        self.assertEqual(self.cm._forced_off_ids, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from scripts import models_loader
+
+
+def _write(path, data):
+    with open(path, 'w', encoding='utf8') as f:
+        json.dump(data, f)
+
+
+def _read(path):
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+class ModelsLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'data.json')
+        _write(self.path, {
+            'tarjetas': [{'id': 'T', 'saldo': 1000.0}],
+            'breakers': [{'id': 'b1', 'estado': False, 'tarjeta': 'T'}],
+            'arduinos': [],
+        })
+
+    def tearDown(self):
+        models_loader.flush_pending()
+        models_loader._CACHE.pop(self.path, None)
+        self.tmp.cleanup()
+
+
+class SaveDataPendingTest(ModelsLoaderTestCase):
+    def test_save_of_other_dict_writes_pending_first(self):
+        models_loader.set_breaker_state(self.path, 'b1', True)
+        self.assertIn(self.path, models_loader._PENDING)
+        other = {'tarjetas': [], 'breakers': [{'id': 'b1', 'estado': True}], 'arduinos': []}
+        written = []
+        real_write = models_loader._write_atomic
+
+        def record(path, payload, durable=False):
+            written.append(json.loads(payload))
+            real_write(path, payload, durable)
+
+        with mock.patch.object(models_loader, '_write_atomic', side_effect=record):
+            models_loader.save_data(self.path, other)
+        # la escritura diferida no se descarta: sale antes que la del otro dict
+        self.assertEqual(len(written), 2)
+        self.assertEqual(written[0]['tarjetas'], [{'id': 'T', 'saldo': 1000.0}])
+        self.assertTrue(written[0]['breakers'][0]['estado'])
+        self.assertEqual(written[1], other)
+        self.assertNotIn(self.path, models_loader._PENDING)
+
+    def test_save_of_pending_dict_replaces_deferred_write(self):
+        models_loader.set_breaker_state(self.path, 'b1', True)
+        data = models_loader.load_data(self.path)
+        with mock.patch.object(models_loader, '_write_atomic', wraps=models_loader._write_atomic) as w:
+            models_loader.save_data(self.path, data)
+        self.assertEqual(w.call_count, 1)
+        self.assertNotIn(self.path, models_loader._PENDING)
+        self.assertTrue(_read(self.path)['breakers'][0]['estado'])
+
+
+class DataVersionTest(ModelsLoaderTestCase):
+    def test_version_changes_on_deferred_save_and_external_write(self):
+        data = models_loader.load_data(self.path)
+        v0 = models_loader.data_version(self.path)
+        self.assertIs(models_loader.load_data(self.path), data)
+        self.assertEqual(models_loader.data_version(self.path), v0)
+        models_loader.set_breaker_state(self.path, 'b1', True)
+        v1 = models_loader.data_version(self.path)
+        self.assertGreater(v1, v0)
+        models_loader.flush_pending(self.path)
+        # otro proceso reemplaza el archivo: se recarga y la versión vuelve a cambiar
+        _write(self.path + '.new', {'tarjetas': [], 'breakers': [], 'arduinos': []})
+        os.replace(self.path + '.new', self.path)
+        self.assertEqual(models_loader.load_data(self.path)['breakers'], [])
+        self.assertGreater(models_loader.data_version(self.path), v1)
+
+
+class TarjetaSaldoTest(ModelsLoaderTestCase):
+    def test_set_saldo_rounds_persists_and_turns_breakers_on(self):
+        t = models_loader.set_tarjeta_saldo(self.path, 'T', 12.34567891)
+        self.assertEqual(t['saldo'], 12.345679)
+        on_disk = _read(self.path)
+        self.assertEqual(on_disk['tarjetas'][0]['saldo'], 12.345679)
+        self.assertIs(on_disk['breakers'][0]['estado'], True)
+
+    def test_set_saldo_zero_turns_breakers_off(self):
+        models_loader.set_breaker_state(self.path, 'b1', True)
+        models_loader.set_tarjeta_saldo(self.path, 'T', 0)
+        self.assertIs(_read(self.path)['breakers'][0]['estado'], False)
+
+    def test_adjust_saldo_clamps_at_zero(self):
+        models_loader.set_breaker_state(self.path, 'b1', True)
+        t = models_loader.adjust_tarjeta_saldo(self.path, 'T', -5000)
+        self.assertEqual(t['saldo'], 0.0)
+        on_disk = _read(self.path)
+        self.assertEqual(on_disk['tarjetas'][0]['saldo'], 0.0)
+        self.assertIs(on_disk['breakers'][0]['estado'], False)
+        self.assertEqual(models_loader.adjust_tarjeta_saldo(self.path, 'T', 250)['saldo'], 250.0)
+
+    def test_unchanged_saldo_and_breakers_skip_the_write(self):
+        models_loader.set_tarjeta_saldo(self.path, 'T', 1000)
+        with mock.patch.object(models_loader, 'save_data') as save:
+            models_loader.set_tarjeta_saldo(self.path, 'T', 1000.0)
+            models_loader.adjust_tarjeta_saldo(self.path, 'T', 0)
+        save.assert_not_called()
+
+    def test_unknown_tarjeta_returns_none(self):
+        self.assertIsNone(models_loader.set_tarjeta_saldo(self.path, 'X', 10))
+        self.assertIsNone(models_loader.adjust_tarjeta_saldo(self.path, 'X', 10))
+
+
+if __name__ == '__main__':
+    unittest.main()